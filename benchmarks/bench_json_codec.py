@@ -0,0 +1,102 @@
+"""Microbenchmark for the JSON codec used by the Cloud Functions.
+
+Compares the standard library ``json`` module with ``json_codec`` on
+payloads shaped like a collection run: decoding a provider usage response,
+encoding the ``raw_response``/``metadata`` columns of every row, and
+encoding the resulting ``insertAll`` request body.
+
+Usage:
+    python benchmarks/bench_json_codec.py [--items 5000] [--repeat 5]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                                'cloud_functions', 'data_collection'))
+
+from adapters import json_codec  # noqa: E402
+
+MODELS = ('claude-3-opus', 'claude-3-sonnet', 'claude-3-haiku', 'gpt-4o', 'gpt-4o-mini')
+
+
+def make_response(items: int) -> bytes:
+    """Build a provider usage response with ``items`` usage items."""
+    rng = random.Random(42)
+    data = []
+    for i in range(items):
+        input_tokens = rng.randint(10, 20000)
+        output_tokens = rng.randint(10, 4000)
+        data.append({
+            "id": f"req_{i:08d}",
+            "model": rng.choice(MODELS),
+            "timestamp": f"2024-05-01T{i % 24:02d}:{i % 60:02d}:{(i * 7) % 60:02d}Z",
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "latency_ms": rng.randint(100, 30000),
+            "project": f"project-{i % 12}",
+            "user_id": f"user-{i % 250}",
+            "feature": "chat",
+            "metadata": {"region": "us-east-1", "stop_reason": "end_turn", "cached": i % 3 == 0},
+        })
+    return json.dumps({"data": data, "has_more": False, "next_page": None}).encode('utf-8')
+
+
+def make_rows(items: list) -> list:
+    """Shape decoded items like the rows sent to ``insert_rows_json``."""
+    return [{
+        "timestamp": item["timestamp"],
+        "service_name": "Claude",
+        "model": item["model"],
+        "request_id": item["id"],
+        "input_tokens": item["input_tokens"],
+        "output_tokens": item["output_tokens"],
+        "total_tokens": item["input_tokens"] + item["output_tokens"],
+        "cost": (item["input_tokens"] * 0.015 + item["output_tokens"] * 0.075) / 1000,
+        "raw_response": item,
+        "metadata": item["metadata"],
+    } for item in items]
+
+
+def bench(label: str, func, repeat: int) -> float:
+    best = min(timeit.repeat(func, number=1, repeat=repeat))
+    print(f"  {label:<34} {best * 1000:9.2f} ms")
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, default=5000, help="usage items per response")
+    parser.add_argument('--repeat', type=int, default=5, help="repetitions; the best run is reported")
+    args = parser.parse_args()
+
+    body = make_response(args.items)
+    rows = make_rows(json.loads(body)["data"])
+    print(f"Backend: {json_codec.BACKEND}; {args.items} items, {len(body) / 1024 / 1024:.1f} MiB response")
+
+    cases = (
+        ("decode provider response",
+         lambda: json.loads(body),
+         lambda: json_codec.loads(body)),
+        ("encode raw_response/metadata",
+         lambda: [(json.dumps(row["raw_response"]), json.dumps(row["metadata"])) for row in rows],
+         lambda: [(json_codec.encode_json_value(row["raw_response"]),
+                   json_codec.encode_json_value(row["metadata"])) for row in rows]),
+        ("encode insertAll body",
+         lambda: json.dumps({"rows": [{"json": row} for row in rows]}),
+         lambda: json_codec.dumps_bytes({"rows": [{"json": row} for row in rows]})),
+    )
+
+    for name, baseline, candidate in cases:
+        print(name)
+        stdlib = bench("json", baseline, args.repeat)
+        codec = bench("json_codec", candidate, args.repeat)
+        print(f"  {'speedup':<34} {stdlib / codec:9.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+"""Latency benchmark for the metering proxy.
+
+Starts a local fake upstream that answers like the OpenAI and Anthropic
+APIs, with and without streaming, and measures the latency of requests
+sent to it directly and through the proxy at a given concurrency. The
+difference is the latency the proxy adds. Usage is recorded with a no-op
+recorder that counts the metered events, so the numbers exclude the
+(background) delivery to the ingestion endpoint.
+
+Usage:
+    python benchmarks/bench_metering_proxy.py [--requests 2000] [--concurrency 50]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import aiohttp  # noqa: E402
+from aiohttp import web  # noqa: E402
+
+from metering_proxy import PricingSource, Upstream, create_app  # noqa: E402
+
+PRICES = {
+    "OpenAI": {"gpt-4o": {"input_price_per_1k": 0.005, "output_price_per_1k": 0.015}},
+    "Claude": {"claude-3-sonnet": {"input_price_per_1k": 0.003, "output_price_per_1k": 0.015}},
+}
+
+STREAM_CHUNKS = 20
+
+
+def _sse(document: dict) -> bytes:
+    return f"data: {json.dumps(document)}\n\n".encode('utf-8')
+
+
+async def fake_openai(request: web.Request) -> web.StreamResponse:
+    body = await request.json()
+    if not body.get('stream'):
+        return web.json_response({
+            "id": "chatcmpl-1", "model": "gpt-4o", "choices": [{"message": {"content": "hi " * 50}}],
+            "usage": {"prompt_tokens": 120, "completion_tokens": 50, "total_tokens": 170}
+        })
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+    await response.prepare(request)
+    for _ in range(STREAM_CHUNKS):
+        await response.write(_sse({"id": "chatcmpl-1", "model": "gpt-4o", "usage": None,
+                                   "choices": [{"delta": {"content": "hi "}}]}))
+    if body.get('stream_options', {}).get('include_usage'):
+        await response.write(_sse({"id": "chatcmpl-1", "model": "gpt-4o", "choices": [],
+                                   "usage": {"prompt_tokens": 120, "completion_tokens": STREAM_CHUNKS}}))
+    await response.write(b"data: [DONE]\n\n")
+    await response.write_eof()
+    return response
+
+
+async def fake_anthropic(request: web.Request) -> web.StreamResponse:
+    body = await request.json()
+    if not body.get('stream'):
+        return web.json_response({
+            "id": "msg_1", "type": "message", "model": "claude-3-sonnet",
+            "content": [{"type": "text", "text": "hi " * 50}],
+            "usage": {"input_tokens": 120, "output_tokens": 50}
+        })
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+    await response.prepare(request)
+    await response.write(b"event: message_start\n" + _sse({
+        "type": "message_start",
+        "message": {"id": "msg_1", "model": "claude-3-sonnet", "usage": {"input_tokens": 120, "output_tokens": 1}}
+    }))
+    for _ in range(STREAM_CHUNKS):
+        await response.write(b"event: content_block_delta\n" + _sse({
+            "type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": "hi "}
+        }))
+    await response.write(b"event: message_delta\n" + _sse({
+        "type": "message_delta", "delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": STREAM_CHUNKS}
+    }))
+    await response.write(b"event: message_stop\n" + _sse({"type": "message_stop"}))
+    await response.write_eof()
+    return response
+
+
+async def _start(app: web.Application) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner
+
+
+def _port(runner: web.AppRunner) -> int:
+    return runner.addresses[0][1]
+
+
+async def _measure(session: aiohttp.ClientSession, url: str, body: dict, requests: int,
+                   concurrency: int) -> list:
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one() -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            async with session.post(url, json=body) as response:
+                await response.read()
+                response.raise_for_status()
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    await asyncio.gather(*(one() for _ in range(requests)))
+    return latencies
+
+
+def _percentile(values: list, fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+async def run(requests: int, concurrency: int) -> None:
+    upstream = web.Application()
+    upstream.router.add_post('/v1/chat/completions', fake_openai)
+    upstream.router.add_post('/v1/messages', fake_anthropic)
+    upstream_runner = await _start(upstream)
+    upstream_url = f"http://127.0.0.1:{_port(upstream_runner)}"
+
+    events = []
+    proxy = create_app(
+        {
+            'openai': Upstream('openai', upstream_url, 'OpenAI'),
+            'anthropic': Upstream('anthropic', upstream_url, 'Claude'),
+        },
+        PricingSource(lambda: PRICES),
+        lambda service_name, **event: events.append((service_name, event))
+    )
+    proxy_runner = await _start(proxy)
+    proxy_url = f"http://127.0.0.1:{_port(proxy_runner)}"
+
+    cases = (
+        ('openai', '/v1/chat/completions', {"model": "gpt-4o", "messages": []}),
+        ('openai stream', '/v1/chat/completions', {"model": "gpt-4o", "messages": [], "stream": True,
+                                                   "stream_options": {"include_usage": True}}),
+        ('anthropic', '/v1/messages', {"model": "claude-3-sonnet", "messages": []}),
+        ('anthropic stream', '/v1/messages', {"model": "claude-3-sonnet", "messages": [], "stream": True}),
+    )
+    print(f"{'case':<18} {'direct p50':>11} {'proxied p50':>12} {'added p50':>10} "
+          f"{'direct p99':>11} {'proxied p99':>12} {'added p99':>10}")
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        for name, path, body in cases:
+            prefix = name.split()[0]
+            # Warm up the connection pools of the client and the proxy
+            await _measure(session, f"{proxy_url}/{prefix}{path}", body, concurrency, concurrency)
+            direct = await _measure(session, f"{upstream_url}{path}", body, requests, concurrency)
+            proxied = await _measure(session, f"{proxy_url}/{prefix}{path}", body, requests, concurrency)
+            direct_p50, proxied_p50 = statistics.median(direct), statistics.median(proxied)
+            direct_p99, proxied_p99 = _percentile(direct, 0.99), _percentile(proxied, 0.99)
+            print(f"{name:<18} {direct_p50:>9.2f}ms {proxied_p50:>10.2f}ms {proxied_p50 - direct_p50:>8.2f}ms "
+                  f"{direct_p99:>9.2f}ms {proxied_p99:>10.2f}ms {proxied_p99 - direct_p99:>8.2f}ms")
+
+    expected = len(cases) * (requests + concurrency)
+    print(f"\nmetered {len(events)} of {expected} responses; last event: {events[-1] if events else None}")
+
+    await proxy_runner.cleanup()
+    await upstream_runner.cleanup()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(run(args.requests, args.concurrency))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+"""Python client for recording AI usage events with CostWise AI."""
+
+from .client import CostWiseClient, DeliveryError, EVENT_FIELDS, encode_batch
+
+__all__ = ['CostWiseClient', 'DeliveryError', 'EVENT_FIELDS', 'encode_batch']
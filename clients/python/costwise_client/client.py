@@ -0,0 +1,296 @@
+"""Background-batching client for the CostWise AI ingestion endpoint.
+
+``record`` only appends a tuple to an in-memory queue, so it adds a few
+microseconds to the caller's LLM call. A daemon thread drains the queue in
+batches, encodes them as gzip-compressed NDJSON in the format accepted by
+the transformation function, and posts them with retries. Batches that
+cannot be delivered are spilled to a local directory and replayed once the
+endpoint is reachable again.
+"""
+
+import atexit
+import gzip
+import json
+import logging
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger('costwise_client')
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_FLUSH_INTERVAL = 1.0
+DEFAULT_MAX_QUEUE = 100000
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_TIMEOUT = 10.0
+
+# Statuses worth retrying; other client errors mean the batch will never be accepted
+RETRYABLE_STATUSES = frozenset({408, 425, 429, 500, 502, 503, 504})
+
+SPILL_SUFFIX = '.ndjson.gz'
+
+# Fields of a usage event, matching the cost_data columns the endpoint reads
+EVENT_FIELDS = ('feature', 'input_cost', 'output_cost', 'price_version', 'response_time_ms', 'project',
+                'user_id', 'raw_response', 'metadata')
+
+_Event = Tuple[float, Optional[str], str, int, int, Dict[str, Any]]
+
+
+class DeliveryError(Exception):
+    """A batch was rejected by the endpoint or could not be delivered."""
+
+    def __init__(self, message: str, retryable: bool):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def _encode_event(event: _Event) -> bytes:
+    timestamp, event_id, model, input_tokens, output_tokens, fields = event
+    document = {
+        "event_id": event_id or uuid.uuid4().hex,
+        "timestamp": datetime.fromtimestamp(timestamp, tz=timezone.utc).isoformat(),
+        "model": model,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+    }
+    document.update(fields)
+    return json.dumps(document, separators=(',', ':'), default=str).encode('utf-8')
+
+
+def encode_batch(events: List[_Event]) -> bytes:
+    """Encode events as gzip-compressed NDJSON."""
+    return gzip.compress(b'\n'.join(_encode_event(event) for event in events) + b'\n', compresslevel=6)
+
+
+class CostWiseClient:
+    """Records LLM usage events and delivers them to the ingestion endpoint in the background."""
+
+    def __init__(self, endpoint: str, service_name: str, batch_size: int = DEFAULT_BATCH_SIZE,
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL, max_queue: int = DEFAULT_MAX_QUEUE,
+                 max_retries: int = DEFAULT_MAX_RETRIES, timeout: float = DEFAULT_TIMEOUT,
+                 spill_dir: Optional[str] = None, headers: Optional[Dict[str, str]] = None,
+                 token_provider: Optional[Callable[[], str]] = None,
+                 sender: Optional[Callable[[bytes], None]] = None):
+        """Initialize the client and start its background thread.
+
+        Args:
+            endpoint: URL of the transformation function.
+            service_name: Service the events are recorded for, e.g. ``OpenAI``.
+            batch_size: Events per request.
+            flush_interval: Longest time in seconds an event waits in the queue.
+            max_queue: Events kept in memory; the oldest are dropped beyond this.
+            max_retries: Retries of a batch before it is spilled to disk.
+            timeout: Request timeout in seconds.
+            spill_dir: Directory for undeliverable batches. Without it they are dropped.
+            headers: Extra request headers.
+            token_provider: Returns a bearer token for each request, e.g. a
+                Google ID token for an authenticated Cloud Function.
+            sender: Replaces the HTTP transport; receives the encoded batch.
+        """
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = float(flush_interval)
+        self.max_retries = max(0, int(max_retries))
+        self.timeout = timeout
+        # Spilled batches carry no service name, so each service has its own directory
+        self.spill_dir = os.path.join(spill_dir, urllib.parse.quote(service_name, safe='')) if spill_dir else None
+        self.headers = dict(headers or {})
+        self.token_provider = token_provider
+        self.sender = sender or self._post
+        if self.spill_dir:
+            os.makedirs(self.spill_dir, exist_ok=True)
+
+        # deque.append is atomic, so record() needs no lock
+        self._queue: Deque[_Event] = deque(maxlen=max(1, int(max_queue)))
+        self._wake = threading.Event()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._closed = False
+        self._stats = {
+            'enqueued': 0, 'sent_events': 0, 'sent_batches': 0, 'rejected_events': 0,
+            'dropped_events': 0, 'retries': 0, 'spilled_batches': 0, 'replayed_batches': 0
+        }
+        self._last_error: Optional[str] = None
+        self._thread = threading.Thread(target=self._run, name='costwise-client', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def record(self, model: str, input_tokens: int = 0, output_tokens: int = 0,
+               event_id: Optional[str] = None, **fields: Any) -> None:
+        """Record the usage of one LLM call.
+
+        Args:
+            model: Model name as priced in the service configuration.
+            input_tokens: Prompt tokens.
+            output_tokens: Completion tokens.
+            event_id: Unique ID of the call, e.g. the provider request ID;
+                generated when omitted. It makes delivery idempotent.
+            **fields: Other event fields (see ``EVENT_FIELDS``).
+        """
+        if self._closed:
+            return
+        queue = self._queue
+        if len(queue) == queue.maxlen:
+            # The deque drops the oldest event to make room
+            self._stats['dropped_events'] += 1
+        queue.append((time.time(), event_id, model, input_tokens, output_tokens, fields))
+        self._stats['enqueued'] += 1
+        if len(queue) >= self.batch_size:
+            self._wake.set()
+
+    def metrics(self) -> Dict[str, Any]:
+        """Get delivery counters and the current queue depth."""
+        return {
+            **self._stats,
+            'queue_depth': len(self._queue),
+            'spilled_files': len(self._spilled_files()),
+            'last_error': self._last_error
+        }
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Deliver the queued events now.
+
+        Returns:
+            True if the queue was drained within the timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue or not self._idle.is_set():
+            self._wake.set()
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            time.sleep(0.01 if remaining is None else min(0.01, remaining))
+        return True
+
+    def close(self, timeout: float = 5.0) -> None:
+        """Flush the queue and stop the background thread."""
+        if self._closed:
+            return
+        self.flush(timeout)
+        self._closed = True
+        self._wake.set()
+        self._thread.join(timeout)
+        # Keep whatever could not be delivered in time for the next process
+        while self._queue:
+            batch = self._take_batch()
+            if self._spill(encode_batch(batch)):
+                self._stats['spilled_batches'] += 1
+            else:
+                self._stats['dropped_events'] += len(batch)
+
+    def _take_batch(self) -> List[_Event]:
+        batch = []
+        queue = self._queue
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(queue.popleft())
+            except IndexError:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self._idle.clear()
+            try:
+                self._replay_spilled()
+                while self._queue:
+                    batch = self._take_batch()
+                    self._deliver(encode_batch(batch), len(batch))
+            except Exception as e:  # pragma: no cover - keep the thread alive
+                self._last_error = f"{type(e).__name__}: {e}"
+                logger.exception("CostWise client flush failed")
+            finally:
+                self._idle.set()
+
+    def _post(self, body: bytes) -> None:
+        headers = {
+            'Content-Type': 'application/x-ndjson',
+            'Content-Encoding': 'gzip',
+            **self.headers
+        }
+        if self.token_provider is not None:
+            headers['Authorization'] = f"Bearer {self.token_provider()}"
+        separator = '&' if '?' in self.endpoint else '?'
+        url = f"{self.endpoint}{separator}{urllib.parse.urlencode({'service_name': self.service_name})}"
+        request = urllib.request.Request(url, data=body, headers=headers, method='POST')
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                response.read()
+        except urllib.error.HTTPError as e:
+            raise DeliveryError(f"HTTP {e.code}: {e.read()[:200]!r}", e.code in RETRYABLE_STATUSES) from None
+        except (urllib.error.URLError, OSError) as e:
+            raise DeliveryError(str(e), True) from None
+
+    def _send_with_retries(self, body: bytes) -> None:
+        attempt = 0
+        while True:
+            try:
+                self.sender(body)
+                return
+            except DeliveryError as e:
+                self._last_error = str(e)
+                if not e.retryable or attempt >= self.max_retries or self._closed:
+                    raise
+            attempt += 1
+            self._stats['retries'] += 1
+            # Exponential backoff with full jitter, capped at 30 seconds
+            time.sleep(random.uniform(0, min(30.0, 0.5 * 2 ** attempt)))
+
+    def _deliver(self, body: bytes, count: int) -> None:
+        try:
+            self._send_with_retries(body)
+        except DeliveryError as e:
+            if not e.retryable:
+                self._stats['rejected_events'] += count
+                logger.error("CostWise endpoint rejected a batch of %d events: %s", count, e)
+            elif self._spill(body):
+                self._stats['spilled_batches'] += 1
+            else:
+                self._stats['dropped_events'] += count
+                logger.error("Dropped a batch of %d undeliverable events: %s", count, e)
+            return
+        self._stats['sent_batches'] += 1
+        self._stats['sent_events'] += count
+
+    def _spill(self, body: bytes) -> bool:
+        if not self.spill_dir:
+            return False
+        name = f"{time.time_ns():020d}-{uuid.uuid4().hex[:8]}{SPILL_SUFFIX}"
+        temp_path = os.path.join(self.spill_dir, f".{name}.tmp")
+        with open(temp_path, 'wb') as spill_file:
+            spill_file.write(body)
+        os.replace(temp_path, os.path.join(self.spill_dir, name))
+        return True
+
+    def _spilled_files(self) -> List[str]:
+        if not self.spill_dir or not os.path.isdir(self.spill_dir):
+            return []
+        return sorted(name for name in os.listdir(self.spill_dir) if name.endswith(SPILL_SUFFIX))
+
+    def _replay_spilled(self) -> None:
+        """Resend spilled batches, oldest first, stopping at the first failure."""
+        for name in self._spilled_files():
+            path = os.path.join(self.spill_dir, name)
+            with open(path, 'rb') as spill_file:
+                body = spill_file.read()
+            try:
+                self.sender(body)
+            except DeliveryError as e:
+                self._last_error = str(e)
+                if e.retryable:
+                    return
+                logger.error("CostWise endpoint rejected spilled batch %s: %s", name, e)
+            else:
+                self._stats['replayed_batches'] += 1
+            os.remove(path)
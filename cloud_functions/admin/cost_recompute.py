@@ -0,0 +1,235 @@
+"""Server-side cost recomputation for the admin function.
+
+Rebuilds ``input_cost``, ``output_cost``, ``cost`` and ``price_version`` for
+the rows of one service/model in place, one daily partition at a time, using
+set-based UPDATE statements generated from the current pricing config.
+"""
+
+import logging
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+import google.cloud.bigquery as bigquery
+from google.api_core.exceptions import GoogleAPICallError
+
+from pricing import PriceVersion, PricingIndex
+
+logger = logging.getLogger('costwise-admin')
+
+# Upper bound on the number of partitions a single request may touch
+MAX_PARTITIONS = 366
+
+
+def load_price_versions(model: str, model_info: Dict[str, Any]) -> List[Tuple[Optional[datetime], PriceVersion]]:
+    """Get a model's (effective_from, PriceVersion) pairs, base version first.
+
+    The versions come from the same pricing module the collectors use, so a
+    recomputed row gets exactly the price a freshly collected row would.
+    """
+    return PricingIndex({model: model_info}).versions(model)
+
+
+def build_recompute_query(table: str, versions: List[Tuple[Optional[datetime], PriceVersion]]
+                          ) -> Tuple[str, List[Any]]:
+    """Build the parameterized UPDATE statement for one partition.
+
+    Returns:
+        The SQL text and the price query parameters. The caller adds the
+        partition bounds, service_name and model parameters.
+    """
+    params: List[Any] = []
+    input_case, output_case, version_case = [], [], []
+
+    # Newest version first so the first matching WHEN wins
+    for index in range(len(versions) - 1, 0, -1):
+        effective_from, (version, input_price, output_price) = versions[index]
+        params.extend([
+            bigquery.ScalarQueryParameter(f"effective_from_{index}", "TIMESTAMP", effective_from),
+            bigquery.ScalarQueryParameter(f"version_{index}", "STRING", version),
+            bigquery.ScalarQueryParameter(f"input_price_{index}", "FLOAT64", input_price),
+            bigquery.ScalarQueryParameter(f"output_price_{index}", "FLOAT64", output_price),
+        ])
+        input_case.append(f"WHEN timestamp >= @effective_from_{index} THEN @input_price_{index}")
+        output_case.append(f"WHEN timestamp >= @effective_from_{index} THEN @output_price_{index}")
+        version_case.append(f"WHEN timestamp >= @effective_from_{index} THEN @version_{index}")
+
+    _, (base_version, base_input, base_output) = versions[0]
+    params.extend([
+        bigquery.ScalarQueryParameter("version_0", "STRING", base_version),
+        bigquery.ScalarQueryParameter("input_price_0", "FLOAT64", base_input),
+        bigquery.ScalarQueryParameter("output_price_0", "FLOAT64", base_output),
+    ])
+
+    def case(whens: List[str], default: str) -> str:
+        if not whens:
+            return default
+        return "CASE " + " ".join(whens) + f" ELSE {default} END"
+
+    input_cost = f"IFNULL(input_tokens, 0) / 1000 * ({case(input_case, '@input_price_0')})"
+    output_cost = f"IFNULL(output_tokens, 0) / 1000 * ({case(output_case, '@output_price_0')})"
+
+    query = f"""UPDATE `{table}`
+SET
+  input_cost = {input_cost},
+  output_cost = {output_cost},
+  cost = {input_cost} + {output_cost},
+  price_version = {case(version_case, '@version_0')}
+WHERE
+  timestamp >= @partition_start
+  AND timestamp < @partition_end
+  AND service_name = @service_name
+  AND model = @model"""
+
+    return query, params
+
+
+def partition_dates(start_date: date, end_date: date) -> List[date]:
+    """List the daily partitions between two dates, inclusive."""
+    if end_date < start_date:
+        raise ValueError("end_date must not be before start_date")
+    days = (end_date - start_date).days + 1
+    if days > MAX_PARTITIONS:
+        raise ValueError(f"Date range spans {days} partitions; the maximum is {MAX_PARTITIONS}")
+    return [start_date + timedelta(days=offset) for offset in range(days)]
+
+
+def streaming_buffer_start(bq_client: bigquery.Client, table: str) -> Optional[datetime]:
+    """Get the arrival time of the oldest row still in a table's streaming buffer.
+
+    DML is refused for partitions that are not older than this, so callers
+    skip them up front instead of issuing statements that would fail.
+
+    Returns:
+        The oldest entry time in UTC, or None when the buffer is empty.
+    """
+    streaming_buffer = bq_client.get_table(table).streaming_buffer
+    if streaming_buffer is None or streaming_buffer.oldest_entry_time is None:
+        return None
+    return streaming_buffer.oldest_entry_time.astimezone(timezone.utc)
+
+
+def is_streaming_buffer_error(error: Exception) -> bool:
+    """Whether a DML error was caused by rows still in the streaming buffer."""
+    return 'streaming buffer' in str(error).lower()
+
+
+def recompute_costs(bq_client: bigquery.Client, table: str, service_name: str, model: str,
+                    model_info: Dict[str, Any], start_date: date, end_date: date,
+                    dry_run: bool = False, request_id: Optional[str] = None) -> Dict[str, Any]:
+    """Recompute costs for one service/model over a date range, partition by partition.
+
+    Args:
+        bq_client: BigQuery client.
+        table: Fully qualified cost data table ID.
+        service_name: Service whose rows are recomputed.
+        model: Model whose rows are recomputed.
+        model_info: The model's entry from the service ``models`` config.
+        start_date: First partition date (inclusive).
+        end_date: Last partition date (inclusive).
+        dry_run: Only estimate the bytes each statement would process.
+        request_id: Request ID for log correlation.
+
+    Returns:
+        A summary with per-partition status, affected rows and byte estimates.
+        Partitions not older than the streaming buffer are skipped without
+        running DML; they and partitions whose UPDATE failed are listed in
+        ``retry_partitions``.
+    """
+    versions = load_price_versions(model, model_info)
+    query, price_params = build_recompute_query(table, versions)
+    dates = partition_dates(start_date, end_date)
+    buffer_start = streaming_buffer_start(bq_client, table)
+
+    partitions = []
+    total_bytes = 0
+    total_rows = 0
+
+    for position, partition_date in enumerate(dates, start=1):
+        partition_id = partition_date.strftime('%Y%m%d')
+        partition_start = datetime.combine(partition_date, time.min, tzinfo=timezone.utc)
+        partition_end = partition_start + timedelta(days=1)
+        if buffer_start is not None and partition_end > buffer_start:
+            logger.info(f"Skipping partition {partition_id}: not older than the streaming buffer", extra={
+                "request_id": request_id,
+                "partition": partition_id,
+                "service_name": service_name,
+                "model": model,
+                "streaming_buffer_start": buffer_start.isoformat(),
+                "event_type": "recompute_partition_skipped"
+            })
+            partitions.append({"partition": partition_id, "status": "skipped_streaming_buffer"})
+            continue
+
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=price_params + [
+                bigquery.ScalarQueryParameter("partition_start", "TIMESTAMP", partition_start),
+                bigquery.ScalarQueryParameter("partition_end", "TIMESTAMP", partition_end),
+                bigquery.ScalarQueryParameter("service_name", "STRING", service_name),
+                bigquery.ScalarQueryParameter("model", "STRING", model),
+            ],
+            dry_run=dry_run,
+            use_query_cache=False
+        )
+
+        # Rows streamed with an older timestamp (backfills, replays) still block DML on
+        # that partition, so a failing partition is reported and the rest of the range runs
+        try:
+            query_job = bq_client.query(query, job_config=job_config)
+            if not dry_run:
+                query_job.result()
+            bytes_processed = query_job.total_bytes_processed or 0
+        except GoogleAPICallError as e:
+            status = "skipped_streaming_buffer" if is_streaming_buffer_error(e) else "failed"
+            logger.warning(f"Could not recompute partition {partition_id}: {str(e)}", extra={
+                "request_id": request_id,
+                "partition": partition_id,
+                "service_name": service_name,
+                "model": model,
+                "error": str(e),
+                "error_type": type(e).__name__,
+                "event_type": "recompute_partition_skipped"
+            })
+            partitions.append({"partition": partition_id, "status": status, "error": str(e)})
+            continue
+        total_bytes += bytes_processed
+
+        if dry_run:
+            partitions.append({
+                "partition": partition_id,
+                "status": "dry_run",
+                "estimated_bytes": bytes_processed
+            })
+        else:
+            affected_rows = query_job.num_dml_affected_rows or 0
+            total_rows += affected_rows
+            partitions.append({
+                "partition": partition_id,
+                "status": "recomputed",
+                "rows_updated": affected_rows,
+                "bytes_processed": bytes_processed
+            })
+
+        logger.info(f"Recompute progress: partition {position}/{len(dates)}", extra={
+            "request_id": request_id,
+            "partition": partition_id,
+            "service_name": service_name,
+            "model": model,
+            "dry_run": dry_run,
+            "bytes_processed": bytes_processed,
+            "event_type": "recompute_partition_complete"
+        })
+
+    return {
+        "service_name": service_name,
+        "model": model,
+        "dry_run": dry_run,
+        "price_versions": [price.version for _, price in versions],
+        "partitions": partitions,
+        "partitions_skipped": sum(1 for p in partitions if p["status"] == "skipped_streaming_buffer"),
+        "partitions_failed": sum(1 for p in partitions if p["status"] == "failed"),
+        # Partitions to run again once their streaming buffer was flushed or the error was fixed
+        "retry_partitions": [p["partition"] for p in partitions
+                             if p["status"] in ("skipped_streaming_buffer", "failed")],
+        "total_bytes_processed": total_bytes,
+        "rows_updated": total_rows
+    }
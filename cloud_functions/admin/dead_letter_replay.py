@@ -0,0 +1,317 @@
+"""Replay of dead-lettered rows for the admin function.
+
+Reads dead-letter objects oldest first, re-validates their rows against the
+current table schema, drops rows whose ``row_id`` is already in the table
+(e.g. because the client retried the request that failed), and loads the
+rest with batch load jobs, which unlike streaming inserts are free. An
+object is deleted once all of its rows are loaded.
+
+A load job is atomic, so when a job fails, each of its objects is loaded
+again on its own. Objects that still fail, and the rows of an object that
+fail validation, are moved to the quarantine prefix with the problems
+found, so they never block the objects after them::
+
+    dead_letters_quarantine/<table>/<yyyy>/<mm>/<dd>/
+
+Once the cause is fixed, move the objects back under ``dead_letters/`` to
+replay them.
+
+Each call handles at most ``max_objects`` objects, so a large backlog is
+worked off by calling the action again while ``objects_remaining`` is
+non-zero.
+"""
+
+import gzip
+import json
+import logging
+import math
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+import google.cloud.bigquery as bigquery
+from google.api_core.exceptions import GoogleAPICallError
+
+from blob_store import BlobStore
+from dead_letters import DEAD_LETTER_PREFIX, dead_letter_prefix, parse_dead_letters
+
+logger = logging.getLogger('costwise-admin')
+
+DEFAULT_MAX_OBJECTS = 100
+
+# Rows per load job; objects are never split across jobs
+DEFAULT_BATCH_ROWS = 10000
+
+# Upper bound on the days one request may scan for dead letters
+MAX_DAYS = 366
+
+QUARANTINE_PREFIX = 'dead_letters_quarantine'
+
+_INT64_MIN = -(1 << 63)
+_INT64_MAX = (1 << 63) - 1
+
+_INTEGER_TYPES = ('INTEGER', 'INT64')
+_FLOAT_TYPES = ('FLOAT', 'FLOAT64', 'NUMERIC', 'BIGNUMERIC')
+
+
+def _parse_timestamp(value: Any) -> Optional[datetime]:
+    if not isinstance(value, str) or not value:
+        return None
+    text = value.strip().replace(' ', 'T', 1)
+    if text.endswith('Z'):
+        text = text[:-1] + '+00:00'
+    try:
+        parsed = datetime.fromisoformat(text)
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def validate_row(row: Any, schema: Sequence[bigquery.SchemaField]) -> Tuple[Optional[Dict[str, Any]], List[str]]:
+    """Check a row against a table schema.
+
+    Returns:
+        The row prepared for a load job (JSON columns decoded) and an empty
+        list, or None and the problems found.
+    """
+    if not isinstance(row, dict):
+        return None, ["row is not an object"]
+    fields = {field.name: field for field in schema}
+    problems = [f"unknown column {name}" for name in row if name not in fields]
+    prepared = {}
+    for name, field in fields.items():
+        value = row.get(name)
+        if value is None:
+            if field.mode == 'REQUIRED':
+                problems.append(f"missing required column {name}")
+            continue
+        field_type = field.field_type
+        if field_type in _INTEGER_TYPES:
+            valid = isinstance(value, int) and not isinstance(value, bool) and _INT64_MIN <= value <= _INT64_MAX
+        elif field_type in _FLOAT_TYPES:
+            # Dead letters are written with json.dumps, which lets NaN and infinities through
+            valid = (isinstance(value, (int, float)) and not isinstance(value, bool)
+                     and math.isfinite(value))
+        elif field_type in ('BOOLEAN', 'BOOL'):
+            valid = isinstance(value, bool)
+        elif field_type == 'TIMESTAMP':
+            valid = _parse_timestamp(value) is not None
+        elif field_type == 'STRING':
+            valid = isinstance(value, str)
+        elif field_type == 'JSON':
+            # Streaming inserts take JSON columns as encoded strings, load jobs as values
+            if isinstance(value, str):
+                try:
+                    value = json.loads(value)
+                except ValueError:
+                    pass
+            valid = True
+        else:
+            valid = True
+        if not valid:
+            problems.append(f"invalid {field_type} value in column {name}")
+        prepared[name] = value
+    return (None, problems) if problems else (prepared, [])
+
+
+def _existing_row_ids(bq_client: bigquery.Client, table: str, rows: List[Dict[str, Any]]) -> Set[str]:
+    """Get the row IDs of ``rows`` that are already in the table, scanning only their days."""
+    row_ids = sorted({row['row_id'] for row in rows if row.get('row_id')})
+    if not row_ids:
+        return set()
+    days = [_parse_timestamp(row['timestamp']).date() for row in rows]
+    query = f"""SELECT DISTINCT row_id FROM `{table}`
+WHERE timestamp >= TIMESTAMP(@start_date) AND timestamp < TIMESTAMP(DATE_ADD(@end_date, INTERVAL 1 DAY))
+  AND row_id IN UNNEST(@row_ids)"""
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("start_date", "DATE", min(days)),
+        bigquery.ScalarQueryParameter("end_date", "DATE", max(days)),
+        bigquery.ArrayQueryParameter("row_ids", "STRING", row_ids),
+    ])
+    return {row['row_id'] for row in bq_client.query(query, job_config=job_config).result()}
+
+
+def quarantine_name(name: str) -> str:
+    """Get the quarantine name of a dead-letter object."""
+    return QUARANTINE_PREFIX + name[len(DEAD_LETTER_PREFIX):]
+
+
+def list_dead_letters(store: BlobStore, table_id: str, start_date: Optional[date] = None,
+                      end_date: Optional[date] = None) -> List[str]:
+    """List the dead-letter objects of a table, oldest first, optionally for a range of failure days."""
+    if start_date is None or end_date is None:
+        return store.list(dead_letter_prefix(table_id))
+    if end_date < start_date:
+        raise ValueError("end_date must not be before start_date")
+    if (end_date - start_date).days + 1 > MAX_DAYS:
+        raise ValueError(f"Date range spans more than {MAX_DAYS} days")
+    names = []
+    day = start_date
+    while day <= end_date:
+        names.extend(store.list(dead_letter_prefix(table_id, day)))
+        day += timedelta(days=1)
+    return names
+
+
+def replay_dead_letters(bq_client: bigquery.Client, store: BlobStore, tables: Dict[str, str],
+                        start_date: Optional[date] = None, end_date: Optional[date] = None,
+                        max_objects: int = DEFAULT_MAX_OBJECTS, batch_rows: int = DEFAULT_BATCH_ROWS,
+                        dry_run: bool = False, request_id: Optional[str] = None) -> Dict[str, Any]:
+    """Load dead-lettered rows back into their tables.
+
+    Args:
+        bq_client: BigQuery client.
+        store: Blob store of the data bucket.
+        tables: Fully qualified table of each dead-lettered table ID to replay.
+        start_date: First failure day to replay; all days when omitted.
+        end_date: Last failure day to replay.
+        max_objects: Most objects handled by this call.
+        batch_rows: Rows per load job.
+        dry_run: Validate and count without loading or deleting anything.
+        request_id: For logging.
+
+    Returns:
+        A summary of the replay, including the days loaded per service of
+        each table so callers can refresh dependent rollups, and the objects
+        moved to quarantine.
+    """
+    max_objects = max(1, int(max_objects))
+    batch_rows = max(1, int(batch_rows))
+    summary = {
+        "dry_run": dry_run,
+        "objects_processed": 0,
+        "objects_remaining": 0,
+        "rows_loaded": 0,
+        "rows_already_present": 0,
+        "rows_invalid": 0,
+        "rows_failed_load": 0,
+        "objects_quarantined": 0,
+        "load_jobs": 0,
+        "loaded_dates": {},
+        "invalid_samples": []
+    }
+    budget = max_objects
+
+    for table_id, table in tables.items():
+        names = list_dead_letters(store, table_id, start_date, end_date)
+        selected, skipped = names[:budget], names[budget:]
+        budget -= len(selected)
+        summary["objects_remaining"] += len(skipped)
+        if not selected:
+            continue
+        schema = bq_client.get_table(table).schema
+        loaded_dates: Dict[str, Set[date]] = {}
+
+        # Valid rows, their entries and the invalid entries of each object waiting for a load job
+        pending_objects: List[Tuple[str, List[Dict[str, Any]], List[Dict[str, Any]], List[Dict[str, Any]]]] = []
+
+        def load(rows: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], int]:
+            # Skip rows already in the table and rows dead-lettered more than once
+            seen = _existing_row_ids(bq_client, table, rows)
+            new_rows = []
+            for row in rows:
+                row_id = row.get('row_id')
+                if row_id in seen:
+                    continue
+                if row_id:
+                    seen.add(row_id)
+                new_rows.append(row)
+            if new_rows and not dry_run:
+                job_config = bigquery.LoadJobConfig(
+                    schema=schema,
+                    source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+                    write_disposition=bigquery.WriteDisposition.WRITE_APPEND
+                )
+                summary["load_jobs"] += 1
+                bq_client.load_table_from_json(new_rows, table, job_config=job_config).result()
+            return new_rows, len(rows) - len(new_rows)
+
+        def loaded(new_rows: List[Dict[str, Any]], already_present: int) -> None:
+            summary["rows_loaded"] += len(new_rows)
+            summary["rows_already_present"] += already_present
+            for row in new_rows:
+                loaded_dates.setdefault(row['service_name'], set()).add(_parse_timestamp(row['timestamp']).date())
+
+        def quarantine(name: str, entries: List[Dict[str, Any]]) -> None:
+            body = b'\n'.join(json.dumps(entry, separators=(',', ':'), default=str).encode('utf-8')
+                              for entry in entries) + b'\n'
+            store.put(quarantine_name(name), gzip.compress(body), content_type='application/gzip')
+
+        def load_pending() -> None:
+            objects = list(pending_objects)
+            pending_objects.clear()
+            failed: Dict[str, str] = {}
+            try:
+                loaded(*load([row for _, rows, _, _ in objects for row in rows]))
+            except GoogleAPICallError as e:
+                if len(objects) == 1:
+                    failed[objects[0][0]] = str(e)
+                else:
+                    # Find the objects whose rows BigQuery rejects; the others load on their own
+                    for name, rows, _, _ in objects:
+                        try:
+                            loaded(*load(rows))
+                        except GoogleAPICallError as object_error:
+                            failed[name] = str(object_error)
+
+            for name, rows, entries, invalid_entries in objects:
+                summary["objects_processed"] += 1
+                if name in failed:
+                    summary["objects_quarantined"] += 1
+                    summary["rows_failed_load"] += len(rows)
+                    if len(summary["invalid_samples"]) < 10:
+                        summary["invalid_samples"].append({"object": name, "problems": [failed[name][:1000]]})
+                    logger.warning(f"Quarantined dead letter object {name} after a failed load", extra={
+                        "request_id": request_id,
+                        "table_id": table_id,
+                        "object": name,
+                        "records_count": len(rows),
+                        "error": failed[name][:1000],
+                        "event_type": "dead_letters_quarantined"
+                    })
+                    for entry in entries:
+                        entry["replay_problems"] = [failed[name][:1000]]
+                    invalid_entries = entries + invalid_entries
+                elif invalid_entries:
+                    summary["objects_quarantined"] += 1
+                if dry_run:
+                    continue
+                if invalid_entries:
+                    # Move the rows that could not be replayed out of the way of later replays
+                    quarantine(name, invalid_entries)
+                store.delete(name)
+
+        for name in selected:
+            data = store.get(name)
+            if data is None:
+                continue
+            rows = []
+            entries = []
+            invalid_entries = []
+            for entry in parse_dead_letters(data):
+                row, problems = validate_row(entry.get('row'), schema)
+                if row is None:
+                    summary["rows_invalid"] += 1
+                    entry["replay_problems"] = problems
+                    invalid_entries.append(entry)
+                    if len(summary["invalid_samples"]) < 10:
+                        summary["invalid_samples"].append({"object": name, "problems": problems})
+                else:
+                    rows.append(row)
+                    entries.append(entry)
+            pending_objects.append((name, rows, entries, invalid_entries))
+            if sum(len(object_rows) for _, object_rows, _, _ in pending_objects) >= batch_rows:
+                load_pending()
+        load_pending()
+
+        summary["loaded_dates"][table_id] = {
+            service_name: sorted(day.isoformat() for day in days) for service_name, days in loaded_dates.items()
+        }
+        logger.info(f"Replayed dead letters for {table_id}", extra={
+            "request_id": request_id,
+            "table_id": table_id,
+            "objects": len(selected),
+            "dry_run": dry_run,
+            "event_type": "dead_letters_replayed"
+        })
+
+    return summary
@@ -1,13 +1,20 @@
 import functions_framework
 import os
-import json
 import logging
 import traceback
-from datetime import datetime
+from datetime import date, datetime
 import google.cloud.bigquery as bigquery
 import google.cloud.secretmanager as secretmanager
 import google.cloud.logging
 
+import json_codec
+from blob_store import open_blob_store
+from cost_recompute import partition_dates, recompute_costs
+from cost_rollup import refresh_daily_rollup
+from dead_letter_replay import DEFAULT_BATCH_ROWS, DEFAULT_MAX_OBJECTS, replay_dead_letters
+from partition_compaction import (COST_LAYOUT, DEFAULT_MAX_BYTES, DEFAULT_MAX_PARTITIONS, DEFAULT_MIN_AGE_DAYS,
+                                  RAW_LAYOUT, compact_partitions)
+
 # Setup structured logging
 logging_client = google.cloud.logging.Client()
 logging_client.setup_logging()
@@ -36,12 +43,18 @@ def admin_handler(request):
         project_id = os.environ.get('PROJECT_ID')
         dataset_id = os.environ.get('DATASET_ID')
         service_config_table_id = os.environ.get('SERVICE_CONFIG_TABLE_ID')
+        cost_data_table_id = os.environ.get('COST_DATA_TABLE_ID')
+        cost_data_raw_table_id = os.environ.get('COST_DATA_RAW_TABLE_ID') or f"{cost_data_table_id}_raw"
+        cost_rollup_table_id = os.environ.get('COST_ROLLUP_TABLE_ID') or f"{cost_data_table_id}_daily"
         
         logger.info(f"Configuration loaded", extra={
             "request_id": request_id,
             "project_id": project_id,
             "dataset_id": dataset_id,
-            "service_config_table_id": service_config_table_id
+            "service_config_table_id": service_config_table_id,
+            "cost_data_table_id": cost_data_table_id,
+            "cost_data_raw_table_id": cost_data_raw_table_id,
+            "cost_rollup_table_id": cost_rollup_table_id
         })
         
         # Initialize clients
@@ -56,7 +69,7 @@ def admin_handler(request):
                 "request_body": request.data.decode('utf-8') if request.data else None,
                 "event_type": "admin_request_error"
             })
-            return json.dumps({"error": "Invalid request: missing action"}), 400, {'Content-Type': 'application/json'}
+            return json_codec.dumps({"error": "Invalid request: missing action"}), 400, {'Content-Type': 'application/json'}
         
         action = request_json['action']
         logger.info(f"Processing admin action: {action}", extra={
@@ -77,7 +90,7 @@ def admin_handler(request):
                         "field": field,
                         "event_type": "validation_error"
                     })
-                    return json.dumps({"error": f"Missing required field: {field}"}), 400, {'Content-Type': 'application/json'}
+                    return json_codec.dumps({"error": f"Missing required field: {field}"}), 400, {'Content-Type': 'application/json'}
             
             # Prepare service configuration
             service_config = {
@@ -87,12 +100,12 @@ def admin_handler(request):
                 "api_base_url": request_json['api_base_url'],
                 "data_collection_endpoint": request_json['data_collection_endpoint'],
                 "secret_name": request_json['secret_name'],
-                "models": json.dumps(request_json['models']),
+                "models": json_codec.dumps(request_json['models']),
                 "adapter_module": request_json['adapter_module'],
                 "active": request_json.get('active', True),
                 "data_collection_frequency": request_json.get('data_collection_frequency', None),
                 "updated_at": datetime.utcnow().isoformat(),
-                "additional_config": json.dumps(request_json.get('additional_config', {}))
+                "additional_config": json_codec.dumps(request_json.get('additional_config', {}))
             }
             
             logger.info(f"Adding new service configuration", extra={
@@ -130,7 +143,7 @@ def admin_handler(request):
                     "secret_version_path": secret_version_path
                 })
                 
-                return json.dumps({
+                return json_codec.dumps({
                     "error": f"Error accessing secret '{secret_name}': {str(e)}",
                     "secret_name": secret_name,
                     "secret_version_path": secret_version_path
@@ -150,7 +163,7 @@ def admin_handler(request):
                     "request_id": request_id,
                     "errors": errors
                 })
-                return json.dumps({"error": f"Error inserting service configuration: {errors}"}), 500, {'Content-Type': 'application/json'}
+                return json_codec.dumps({"error": f"Error inserting service configuration: {errors}"}), 500, {'Content-Type': 'application/json'}
             
             logger.info(f"Service added successfully", extra={
                 "request_id": request_id,
@@ -159,7 +172,7 @@ def admin_handler(request):
                 "event_type": "service_added"
             })
             
-            return json.dumps({
+            return json_codec.dumps({
                 "success": True,
                 "message": f"Service {service_config['service_name']} added successfully",
                 "service_id": service_config['service_id']
@@ -171,7 +184,7 @@ def admin_handler(request):
                 logger.error("Missing service_id in update request", extra={
                     "request_id": request_id
                 })
-                return json.dumps({"error": "Missing service_id"}), 400, {'Content-Type': 'application/json'}
+                return json_codec.dumps({"error": "Missing service_id"}), 400, {'Content-Type': 'application/json'}
             
             service_id = request_json['service_id']
             logger.info(f"Updating service", extra={
@@ -195,7 +208,7 @@ def admin_handler(request):
                     "request_id": request_id,
                     "service_id": service_id
                 })
-                return json.dumps({"error": f"Service with ID {service_id} not found"}), 404, {'Content-Type': 'application/json'}
+                return json_codec.dumps({"error": f"Service with ID {service_id} not found"}), 404, {'Content-Type': 'application/json'}
             
             # Check if secret needs to be verified
             if 'secret_name' in request_json:
@@ -225,7 +238,7 @@ def admin_handler(request):
                         "secret_version_path": secret_version_path
                     })
                     
-                    return json.dumps({
+                    return json_codec.dumps({
                         "error": f"Error accessing secret '{secret_name}': {str(e)}",
                         "secret_name": secret_name,
                         "secret_version_path": secret_version_path
@@ -246,7 +259,7 @@ def admin_handler(request):
                 if field in request_json:
                     value = request_json[field]
                     if field in ['models', 'additional_config']:
-                        value = json.dumps(value)
+                        value = json_codec.dumps(value)
                     update_parts.append(f"{field} = '{value}'")
             
             # Add updated_at timestamp
@@ -257,7 +270,7 @@ def admin_handler(request):
                     "request_id": request_id,
                     "service_id": service_id
                 })
-                return json.dumps({"error": "No fields to update"}), 400, {'Content-Type': 'application/json'}
+                return json_codec.dumps({"error": "No fields to update"}), 400, {'Content-Type': 'application/json'}
             
             update_query += ", ".join(update_parts)
             update_query += f" WHERE service_id = '{service_id}'"
@@ -276,7 +289,7 @@ def admin_handler(request):
                 "event_type": "service_updated"
             })
             
-            return json.dumps({
+            return json_codec.dumps({
                 "success": True,
                 "message": f"Service {service_id} updated successfully"
             }), 200, {'Content-Type': 'application/json'}
@@ -287,7 +300,7 @@ def admin_handler(request):
                 logger.error("Missing service_id in delete request", extra={
                     "request_id": request_id
                 })
-                return json.dumps({"error": "Missing service_id"}), 400, {'Content-Type': 'application/json'}
+                return json_codec.dumps({"error": "Missing service_id"}), 400, {'Content-Type': 'application/json'}
             
             service_id = request_json['service_id']
             logger.info(f"Deleting service", extra={
@@ -312,7 +325,7 @@ def admin_handler(request):
                 "event_type": "service_deleted"
             })
             
-            return json.dumps({
+            return json_codec.dumps({
                 "success": True,
                 "message": f"Service {service_id} deleted successfully"
             }), 200, {'Content-Type': 'application/json'}
@@ -338,9 +351,9 @@ def admin_handler(request):
                 
                 # Parse JSON fields
                 if 'models' in service_data:
-                    service_data['models'] = json.loads(service_data['models'])
+                    service_data['models'] = json_codec.loads(service_data['models'])
                 if 'additional_config' in service_data and service_data['additional_config']:
-                    service_data['additional_config'] = json.loads(service_data['additional_config'])
+                    service_data['additional_config'] = json_codec.loads(service_data['additional_config'])
                 
                 services.append(service_data)
             
@@ -350,7 +363,7 @@ def admin_handler(request):
                 "event_type": "services_listed"
             })
             
-            return json.dumps({
+            return json_codec.dumps({
                 "success": True,
                 "services": services
             }), 200, {'Content-Type': 'application/json'}
@@ -361,7 +374,7 @@ def admin_handler(request):
                 logger.error("Missing secret_name in check_secret request", extra={
                     "request_id": request_id
                 })
-                return json.dumps({"error": "Missing secret_name"}), 400, {'Content-Type': 'application/json'}
+                return json_codec.dumps({"error": "Missing secret_name"}), 400, {'Content-Type': 'application/json'}
             
             secret_name = request_json['secret_name']
             logger.info(f"Checking if secret is accessible", extra={
@@ -387,7 +400,7 @@ def admin_handler(request):
                     "value_preview": value_preview
                 })
                 
-                return json.dumps({
+                return json_codec.dumps({
                     "success": True,
                     "message": f"Secret '{secret_name}' exists and is accessible",
                     "secret_name": secret_name,
@@ -403,18 +416,287 @@ def admin_handler(request):
                     "secret_version_path": secret_version_path
                 })
                 
-                return json.dumps({
+                return json_codec.dumps({
                     "error": f"Error accessing secret '{secret_name}': {str(e)}",
                     "secret_name": secret_name,
                     "secret_version_path": secret_version_path
                 }), 400, {'Content-Type': 'application/json'}
+        elif action == 'recompute_costs':
+            # Recompute stored costs in place from the current pricing config
+            required_fields = ['service_name', 'model', 'start_date', 'end_date']
+            
+            for field in required_fields:
+                if field not in request_json:
+                    logger.error(f"Missing required field", extra={
+                        "request_id": request_id,
+                        "field": field,
+                        "event_type": "validation_error"
+                    })
+                    return json_codec.dumps({"error": f"Missing required field: {field}"}), 400, {'Content-Type': 'application/json'}
+            
+            service_name = request_json['service_name']
+            model = request_json['model']
+            dry_run = bool(request_json.get('dry_run', False))
+            
+            try:
+                start_date = date.fromisoformat(request_json['start_date'])
+                end_date = date.fromisoformat(request_json['end_date'])
+            except (TypeError, ValueError) as e:
+                return json_codec.dumps({"error": f"Invalid date range: {str(e)}"}), 400, {'Content-Type': 'application/json'}
+            
+            logger.info(f"Recomputing costs", extra={
+                "request_id": request_id,
+                "service_name": service_name,
+                "model": model,
+                "start_date": start_date.isoformat(),
+                "end_date": end_date.isoformat(),
+                "dry_run": dry_run
+            })
+            
+            # Load the current pricing for the service
+            query = f"""SELECT models FROM `{project_id}.{dataset_id}.{service_config_table_id}`
+                     WHERE service_name = @service_name"""
+            job_config = bigquery.QueryJobConfig(query_parameters=[
+                bigquery.ScalarQueryParameter("service_name", "STRING", service_name)
+            ])
+            results = list(bq_client.query(query, job_config=job_config).result())
+            
+            if not results:
+                logger.error(f"Service not found", extra={
+                    "request_id": request_id,
+                    "service_name": service_name
+                })
+                return json_codec.dumps({"error": f"Service {service_name} not found"}), 404, {'Content-Type': 'application/json'}
+            
+            models = results[0]['models']
+            if isinstance(models, str):
+                models = json_codec.loads(models)
+            
+            if model not in models:
+                return json_codec.dumps({"error": f"Model {model} has no pricing configured for {service_name}"}), 400, {'Content-Type': 'application/json'}
+            
+            try:
+                summary = recompute_costs(
+                    bq_client,
+                    f"{project_id}.{dataset_id}.{cost_data_table_id}",
+                    service_name,
+                    model,
+                    models[model],
+                    start_date,
+                    end_date,
+                    dry_run=dry_run,
+                    request_id=request_id
+                )
+            except ValueError as e:
+                return json_codec.dumps({"error": str(e)}), 400, {'Content-Type': 'application/json'}
+            
+            # Keep the daily rollup in line with the recomputed partitions
+            recomputed_dates = [
+                datetime.strptime(p['partition'], '%Y%m%d').date()
+                for p in summary['partitions'] if p['status'] == 'recomputed'
+            ]
+            summary['rollup'] = refresh_daily_rollup(
+                bq_client,
+                f"{project_id}.{dataset_id}.{cost_data_table_id}",
+                f"{project_id}.{dataset_id}.{cost_rollup_table_id}",
+                service_name,
+                recomputed_dates
+            )
+            
+            logger.info(f"Cost recompute finished", extra={
+                "request_id": request_id,
+                "service_name": service_name,
+                "model": model,
+                "dry_run": dry_run,
+                "rows_updated": summary['rows_updated'],
+                "total_bytes_processed": summary['total_bytes_processed'],
+                "partitions_skipped": summary['partitions_skipped'],
+                "partitions_failed": summary['partitions_failed'],
+                "event_type": "costs_recomputed"
+            })
+            
+            return json_codec.dumps({
+                "success": True,
+                **summary
+            }), 200, {'Content-Type': 'application/json'}
+            
+        elif action == 'refresh_rollup':
+            # Rebuild the daily rollup rows of a service for a date range, e.g. to backfill it
+            required_fields = ['service_name', 'start_date', 'end_date']
+            
+            for field in required_fields:
+                if field not in request_json:
+                    logger.error(f"Missing required field", extra={
+                        "request_id": request_id,
+                        "field": field,
+                        "event_type": "validation_error"
+                    })
+                    return json_codec.dumps({"error": f"Missing required field: {field}"}), 400, {'Content-Type': 'application/json'}
+            
+            service_name = request_json['service_name']
+            try:
+                dates = partition_dates(date.fromisoformat(request_json['start_date']),
+                                        date.fromisoformat(request_json['end_date']))
+            except (TypeError, ValueError) as e:
+                return json_codec.dumps({"error": f"Invalid date range: {str(e)}"}), 400, {'Content-Type': 'application/json'}
+            
+            summary = refresh_daily_rollup(
+                bq_client,
+                f"{project_id}.{dataset_id}.{cost_data_table_id}",
+                f"{project_id}.{dataset_id}.{cost_rollup_table_id}",
+                service_name,
+                dates
+            )
+            
+            logger.info(f"Daily rollup refreshed", extra={
+                "request_id": request_id,
+                **summary,
+                "event_type": "rollup_refreshed"
+            })
+            
+            return json_codec.dumps({
+                "success": True,
+                **summary
+            }), 200, {'Content-Type': 'application/json'}
+            
+        elif action == 'replay_dead_letters':
+            # Load rows that BigQuery rejected back into their tables from the dead-letter store
+            data_store = open_blob_store(os.environ.get('DATA_BUCKET_NAME'))
+            if data_store is None:
+                return json_codec.dumps({"error": "DATA_BUCKET_NAME is not configured"}), 400, {'Content-Type': 'application/json'}
+            
+            tables = {
+                cost_data_table_id: f"{project_id}.{dataset_id}.{cost_data_table_id}",
+                cost_data_raw_table_id: f"{project_id}.{dataset_id}.{cost_data_raw_table_id}"
+            }
+            if request_json.get('table_id'):
+                if request_json['table_id'] not in tables:
+                    return json_codec.dumps({"error": f"Unknown table_id: {request_json['table_id']}"}), 400, {'Content-Type': 'application/json'}
+                tables = {request_json['table_id']: tables[request_json['table_id']]}
+            
+            try:
+                start_date = date.fromisoformat(request_json['start_date']) if request_json.get('start_date') else None
+                end_date = date.fromisoformat(request_json['end_date']) if request_json.get('end_date') else start_date
+                max_objects = int(request_json.get('max_objects', DEFAULT_MAX_OBJECTS))
+                batch_rows = int(request_json.get('batch_rows', DEFAULT_BATCH_ROWS))
+                summary = replay_dead_letters(
+                    bq_client,
+                    data_store,
+                    tables,
+                    start_date=start_date,
+                    end_date=end_date,
+                    max_objects=max_objects,
+                    batch_rows=batch_rows,
+                    dry_run=bool(request_json.get('dry_run', False)),
+                    request_id=request_id
+                )
+            except (TypeError, ValueError) as e:
+                return json_codec.dumps({"error": f"Invalid replay request: {str(e)}"}), 400, {'Content-Type': 'application/json'}
+            
+            # Count the replayed cost rows in the daily rollup
+            summary['rollup'] = {}
+            if not summary['dry_run']:
+                for service_name, days in summary['loaded_dates'].get(cost_data_table_id, {}).items():
+                    summary['rollup'][service_name] = refresh_daily_rollup(
+                        bq_client,
+                        f"{project_id}.{dataset_id}.{cost_data_table_id}",
+                        f"{project_id}.{dataset_id}.{cost_rollup_table_id}",
+                        service_name,
+                        [date.fromisoformat(day) for day in days]
+                    )
+            
+            logger.info(f"Dead letter replay finished", extra={
+                "request_id": request_id,
+                "rows_loaded": summary['rows_loaded'],
+                "rows_already_present": summary['rows_already_present'],
+                "rows_invalid": summary['rows_invalid'],
+                "rows_failed_load": summary['rows_failed_load'],
+                "objects_quarantined": summary['objects_quarantined'],
+                "objects_remaining": summary['objects_remaining'],
+                "event_type": "dead_letter_replay_complete"
+            })
+            
+            return json_codec.dumps({
+                "success": True,
+                **summary
+            }), 200, {'Content-Type': 'application/json'}
+            
+        elif action == 'compact_partitions':
+            # Deduplicate and rewrite the daily partitions of a cost table
+            required_fields = ['start_date', 'end_date']
+            
+            for field in required_fields:
+                if field not in request_json:
+                    logger.error(f"Missing required field", extra={
+                        "request_id": request_id,
+                        "field": field,
+                        "event_type": "validation_error"
+                    })
+                    return json_codec.dumps({"error": f"Missing required field: {field}"}), 400, {'Content-Type': 'application/json'}
+            
+            layouts = {
+                cost_data_table_id: COST_LAYOUT,
+                cost_data_raw_table_id: RAW_LAYOUT
+            }
+            table_id = request_json.get('table_id') or cost_data_table_id
+            if table_id not in layouts:
+                return json_codec.dumps({"error": f"Unknown table_id: {table_id}"}), 400, {'Content-Type': 'application/json'}
+            
+            try:
+                summary = compact_partitions(
+                    bq_client,
+                    f"{project_id}.{dataset_id}.{table_id}",
+                    layouts[table_id],
+                    date.fromisoformat(request_json['start_date']),
+                    date.fromisoformat(request_json['end_date']),
+                    max_partitions=int(request_json.get('max_partitions', DEFAULT_MAX_PARTITIONS)),
+                    max_bytes=int(request_json.get('max_bytes', DEFAULT_MAX_BYTES)),
+                    min_age_days=int(request_json.get('min_age_days', DEFAULT_MIN_AGE_DAYS)),
+                    force=bool(request_json.get('force', False)),
+                    dry_run=bool(request_json.get('dry_run', False)),
+                    request_id=request_id
+                )
+            except (TypeError, ValueError) as e:
+                return json_codec.dumps({"error": f"Invalid compaction request: {str(e)}"}), 400, {'Content-Type': 'application/json'}
+            
+            # Removing duplicate cost rows changes the daily totals
+            summary['table_id'] = table_id
+            summary['rollup'] = {}
+            if table_id == cost_data_table_id:
+                for service_name, days in summary['compacted_dates'].items():
+                    summary['rollup'][service_name] = refresh_daily_rollup(
+                        bq_client,
+                        f"{project_id}.{dataset_id}.{cost_data_table_id}",
+                        f"{project_id}.{dataset_id}.{cost_rollup_table_id}",
+                        service_name,
+                        [date.fromisoformat(day) for day in days]
+                    )
+            
+            logger.info(f"Partition compaction finished", extra={
+                "request_id": request_id,
+                "table_id": table_id,
+                "dry_run": summary['dry_run'],
+                "partitions_compacted": summary['partitions_compacted'],
+                "rows_removed": summary['rows_removed'],
+                "total_bytes_processed": summary['total_bytes_processed'],
+                "partitions_failed": summary['partitions_failed'],
+                "retry_partitions": summary['retry_partitions'],
+                "next_start_date": summary['next_start_date'],
+                "event_type": "partitions_compacted"
+            })
+            
+            return json_codec.dumps({
+                "success": True,
+                **summary
+            }), 200, {'Content-Type': 'application/json'}
+            
         else:
             logger.error(f"Unknown action", extra={
                 "request_id": request_id,
                 "action": action
             })
             
-            return json.dumps({"error": f"Unknown action: {action}"}), 400, {'Content-Type': 'application/json'}
+            return json_codec.dumps({"error": f"Unknown action: {action}"}), 400, {'Content-Type': 'application/json'}
             
     except Exception as e:
         tb = traceback.format_exc()
@@ -426,7 +708,7 @@ def admin_handler(request):
             "event_type": "admin_unhandled_error"
         })
         
-        return json.dumps({
+        return json_codec.dumps({
             "error": str(e),
             "error_type": type(e).__name__,
             "traceback": tb
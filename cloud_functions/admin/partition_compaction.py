@@ -0,0 +1,270 @@
+"""Partition compaction for the admin function.
+
+Overlapping collection windows and retried inserts leave duplicate rows in
+the cost tables. Compaction handles one daily partition at a time in a
+single DML transaction: the winning row of every duplicated row key is
+copied to a temporary table, all rows of those keys are deleted from the
+partition, and the winners are inserted again. Rows that are not
+duplicated are left in place, and rows streamed into the partition
+meanwhile are never overwritten. BigQuery rejects DML on rows still in the
+streaming buffer, so such a partition fails as a whole, is reported as
+``skipped_streaming_buffer`` and can be compacted by a later call.
+
+Rows are duplicates when they share a row key:
+
+- cost table: the service, model, request ID, timestamp and feature the
+  ``row_id`` of a request is derived from (rows migrated from before row
+  IDs existed have random ones), or the ``row_id`` of rows without a
+  request ID, together with the row's request count and token counts, so
+  two hourly aggregates of the same bucket with different contents are
+  both kept
+- raw payload table: ``row_id``
+
+Rows without any key are never treated as duplicates. Among duplicates the
+row with a ``price_version`` wins, then the smallest JSON encoding of the
+whole row, so every run picks the same winner.
+
+A partition is first checked with a query on the key columns only; clean
+partitions are skipped unless ``force`` is set, which rewrites every row of
+the partition. Each call stops after ``max_partitions`` rewrites or when
+the next job would exceed ``max_bytes`` (both estimated with free dry
+runs), and reports the date to resume from.
+"""
+
+import logging
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import google.cloud.bigquery as bigquery
+from google.api_core.exceptions import GoogleAPICallError
+
+from cost_recompute import is_streaming_buffer_error, partition_dates, streaming_buffer_start
+
+logger = logging.getLogger('costwise-admin')
+
+# Partitions rewritten per call, to stay within the function timeout
+DEFAULT_MAX_PARTITIONS = 31
+
+# Bytes processed per call, counting the duplicate checks and the rewrites
+DEFAULT_MAX_BYTES = 200 * 1024 ** 3
+
+# Partitions newer than this may still receive rows from collection lookbacks
+DEFAULT_MIN_AGE_DAYS = 2
+
+
+class CompactionLayout(NamedTuple):
+    """How the rows of a table are keyed and which duplicate wins."""
+    key: str
+    order: str
+
+
+COST_LAYOUT = CompactionLayout(
+    key="""TO_JSON_STRING(STRUCT(
+      IF(IFNULL(request_id, '') = '', IFNULL(row_id, GENERATE_UUID()),
+         FORMAT('%s|%s|%s|%t|%s', service_name, model, request_id, timestamp, IFNULL(feature, ''))) AS id,
+      request_count, input_tokens, output_tokens))""",
+    order="price_version IS NULL, TO_JSON_STRING(s)"
+)
+
+RAW_LAYOUT = CompactionLayout(
+    key="IFNULL(row_id, GENERATE_UUID())",
+    order="TO_JSON_STRING(metadata), TO_JSON_STRING(raw_response)"
+)
+
+
+def build_stats_query(table: str, layout: CompactionLayout) -> str:
+    """Build the query counting the rows and distinct row keys of one partition by service."""
+    return f"""SELECT service_name, COUNT(*) AS row_count, COUNT(DISTINCT row_key) AS key_count
+FROM (
+  SELECT service_name, {layout.key} AS row_key
+  FROM `{table}`
+  WHERE timestamp >= @partition_start AND timestamp < @partition_end
+)
+GROUP BY service_name"""
+
+
+def build_compaction_query(table: str, layout: CompactionLayout) -> str:
+    """Build the query selecting the winning row of each duplicated row key of one partition.
+
+    With ``@force`` set, the winner of every row key is selected.
+    """
+    return f"""SELECT * EXCEPT (row_key_count)
+FROM (
+  SELECT s.*, COUNT(*) OVER (PARTITION BY row_key) AS row_key_count
+  FROM (
+    SELECT t.*, {layout.key} AS row_key
+    FROM `{table}` t
+    WHERE timestamp >= @partition_start AND timestamp < @partition_end
+  ) s
+  WHERE TRUE
+  QUALIFY ROW_NUMBER() OVER (PARTITION BY row_key ORDER BY {layout.order}) = 1
+)
+WHERE @force OR row_key_count > 1"""
+
+
+def build_compaction_script(table: str, layout: CompactionLayout) -> str:
+    """Build the transaction replacing the rows of duplicated row keys with their winners."""
+    return f"""BEGIN TRANSACTION;
+CREATE TEMP TABLE compaction_winners AS
+{build_compaction_query(table, layout)};
+DELETE FROM `{table}`
+WHERE timestamp >= @partition_start AND timestamp < @partition_end
+  AND (@force OR {layout.key} IN (SELECT row_key FROM compaction_winners));
+INSERT INTO `{table}`
+SELECT * EXCEPT (row_key) FROM compaction_winners;
+COMMIT TRANSACTION;"""
+
+
+def compact_partitions(bq_client: bigquery.Client, table: str, layout: CompactionLayout,
+                       start_date: date, end_date: date,
+                       max_partitions: int = DEFAULT_MAX_PARTITIONS, max_bytes: int = DEFAULT_MAX_BYTES,
+                       min_age_days: int = DEFAULT_MIN_AGE_DAYS, force: bool = False,
+                       dry_run: bool = False, today: Optional[date] = None,
+                       request_id: Optional[str] = None) -> Dict[str, Any]:
+    """Deduplicate and rewrite the daily partitions of a table over a date range.
+
+    Args:
+        bq_client: BigQuery client.
+        table: Fully qualified table ID.
+        layout: Row key and winner order of the table's rows.
+        start_date: First partition date (inclusive).
+        end_date: Last partition date (inclusive).
+        max_partitions: Most partitions rewritten by this call.
+        max_bytes: Most bytes processed by this call.
+        min_age_days: Partitions newer than this many days are skipped.
+        force: Rewrite every row of the partitions, including those without duplicates.
+        dry_run: Only estimate the bytes each job would process.
+        today: Current UTC date; defaults to the system clock.
+        request_id: Request ID for log correlation.
+
+    Returns:
+        A summary with per-partition status and row counts, the days
+        rewritten per service (so callers can refresh dependent rollups),
+        the partitions to retry because their transaction failed, and
+        ``next_start_date``, the date to resume from, or None when the whole
+        range was handled.
+    """
+    dates = partition_dates(start_date, end_date)
+    max_partitions = max(1, int(max_partitions))
+    max_bytes = max(0, int(max_bytes))
+    today = today or datetime.now(timezone.utc).date()
+    newest_allowed = today - timedelta(days=max(0, int(min_age_days)))
+    stats_query = build_stats_query(table, layout)
+    compaction_query = build_compaction_query(table, layout)
+    compaction_script = build_compaction_script(table, layout)
+    buffer_start = streaming_buffer_start(bq_client, table)
+
+    partitions = []
+    compacted_dates: Dict[str, List[str]] = {}
+    total_bytes = 0
+    rewritten = 0
+    next_start_date = None
+
+    def estimate(query: str, params: List[Any]) -> int:
+        job_config = bigquery.QueryJobConfig(query_parameters=params, dry_run=True, use_query_cache=False)
+        return bq_client.query(query, job_config=job_config).total_bytes_processed or 0
+
+    for partition_date in dates:
+        partition_id = partition_date.strftime('%Y%m%d')
+
+        if partition_date > newest_allowed:
+            partitions.append({"partition": partition_id, "status": "skipped_recent"})
+            continue
+        if rewritten >= max_partitions:
+            next_start_date = partition_date
+            break
+
+        partition_start = datetime.combine(partition_date, time.min, tzinfo=timezone.utc)
+        partition_end = partition_start + timedelta(days=1)
+        if buffer_start is not None and partition_end > buffer_start:
+            # DML is refused for partitions that are not older than the streaming buffer
+            partitions.append({"partition": partition_id, "status": "skipped_streaming_buffer"})
+            continue
+
+        params = [
+            bigquery.ScalarQueryParameter("partition_start", "TIMESTAMP", partition_start),
+            bigquery.ScalarQueryParameter("partition_end", "TIMESTAMP", partition_end),
+        ]
+        compaction_params = params + [bigquery.ScalarQueryParameter("force", "BOOL", force)]
+
+        stats_bytes = estimate(stats_query, params)
+        compaction_bytes = estimate(compaction_query, compaction_params)
+        if dry_run:
+            total_bytes += stats_bytes + compaction_bytes
+            partitions.append({
+                "partition": partition_id,
+                "status": "dry_run",
+                "estimated_bytes": stats_bytes + compaction_bytes
+            })
+            continue
+        if total_bytes + stats_bytes + compaction_bytes > max_bytes:
+            next_start_date = partition_date
+            break
+
+        stats_job = bq_client.query(stats_query, job_config=bigquery.QueryJobConfig(
+            query_parameters=params, use_query_cache=False))
+        counts = {row['service_name']: (row['row_count'], row['key_count']) for row in stats_job.result()}
+        total_bytes += stats_job.total_bytes_processed or 0
+        row_count = sum(rows for rows, _ in counts.values())
+        duplicates = sum(rows - keys for rows, keys in counts.values())
+
+        if not row_count or (not duplicates and not force):
+            partitions.append({"partition": partition_id, "status": "clean", "rows": row_count})
+            continue
+
+        job_config = bigquery.QueryJobConfig(query_parameters=compaction_params, use_query_cache=False)
+        try:
+            query_job = bq_client.query(compaction_script, job_config=job_config)
+            query_job.result()
+        except GoogleAPICallError as e:
+            # Rows streamed with an older timestamp still block DML; the transaction was
+            # rolled back, so the partition is unchanged and can be retried
+            status = "skipped_streaming_buffer" if is_streaming_buffer_error(e) else "failed"
+            logger.warning(f"Could not compact partition {partition_id}: {str(e)}", extra={
+                "request_id": request_id,
+                "table": table,
+                "partition": partition_id,
+                "error": str(e),
+                "error_type": type(e).__name__,
+                "event_type": "compaction_partition_skipped"
+            })
+            partitions.append({"partition": partition_id, "status": status, "error": str(e)})
+            continue
+        bytes_processed = query_job.total_bytes_processed or 0
+        total_bytes += bytes_processed
+        rewritten += 1
+
+        for service_name, (rows, keys) in counts.items():
+            if rows > keys:
+                compacted_dates.setdefault(service_name, []).append(partition_date.isoformat())
+        partitions.append({
+            "partition": partition_id,
+            "status": "compacted",
+            "rows_before": row_count,
+            "rows_removed": duplicates,
+            "bytes_processed": bytes_processed
+        })
+
+        logger.info(f"Compacted partition {partition_id}", extra={
+            "request_id": request_id,
+            "table": table,
+            "partition": partition_id,
+            "rows_before": row_count,
+            "rows_removed": duplicates,
+            "bytes_processed": bytes_processed,
+            "event_type": "compaction_partition_complete"
+        })
+
+    return {
+        "dry_run": dry_run,
+        "partitions": partitions,
+        "partitions_compacted": rewritten,
+        "rows_removed": sum(p.get("rows_removed", 0) for p in partitions),
+        "total_bytes_processed": total_bytes,
+        "compacted_dates": compacted_dates,
+        "partitions_failed": sum(1 for p in partitions if p["status"] == "failed"),
+        # Partitions to run again once their streaming buffer was flushed or the error was fixed
+        "retry_partitions": [p["partition"] for p in partitions
+                             if p["status"] in ("skipped_streaming_buffer", "failed")],
+        "next_start_date": next_start_date.isoformat() if next_start_date else None
+    }
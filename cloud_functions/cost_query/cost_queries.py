@@ -0,0 +1,179 @@
+"""Parameterized cost queries behind the cost query API.
+
+Questions are answered from the dataset's table functions, which take an
+inclusive date range and prune to its partitions. Totals, breakdowns and
+time series read ``cost_summary`` over the daily rollup. Breakdowns by user
+and user filters need per-row data and read ``cost_details`` instead.
+"""
+
+from datetime import date
+from typing import Any, Dict, List, Optional, Tuple
+
+import google.cloud.bigquery as bigquery
+
+QUERY_TYPES = ('totals', 'breakdown', 'timeseries')
+
+# Dimensions a breakdown or time series can group by, and their columns
+DIMENSIONS = {
+    'service': 'service_name',
+    'model': 'model',
+    'feature': 'feature',
+    'project': 'project',
+    'user': 'user_id'
+}
+
+# Filters accepted by the API; service_name and model are passed to the
+# table functions so they can use the clustering of the tables
+FILTERS = ('service_name', 'model', 'feature', 'project', 'user_id')
+
+GRANULARITIES = {
+    'day': None,
+    'week': 'WEEK(MONDAY)',
+    'month': 'MONTH'
+}
+
+MAX_RANGE_DAYS = 366
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+_ROLLUP_MEASURES = """SUM(request_count) AS request_count,
+  SUM(total_input_tokens) AS input_tokens,
+  SUM(total_output_tokens) AS output_tokens,
+  SUM(total_tokens) AS total_tokens,
+  SUM(total_cost) AS cost,
+  SAFE_DIVIDE(SUM(total_response_time_ms), SUM(response_time_count)) AS avg_response_time_ms"""
+
+# Pre-aggregated rows count as request_count requests, with response_time_ms as their mean
+_DETAIL_MEASURES = """SUM(IFNULL(request_count, 1)) AS request_count,
+  SUM(IFNULL(input_tokens, 0)) AS input_tokens,
+  SUM(IFNULL(output_tokens, 0)) AS output_tokens,
+  SUM(IFNULL(total_tokens, 0)) AS total_tokens,
+  SUM(IFNULL(cost, 0)) AS cost,
+  SAFE_DIVIDE(SUM(response_time_ms * IFNULL(request_count, 1)),
+              SUM(IF(response_time_ms IS NULL, 0, IFNULL(request_count, 1)))) AS avg_response_time_ms"""
+
+
+class CostQuery:
+    """A validated cost question: what to compute, over which days, for which rows."""
+
+    def __init__(self, query_type: str, start_date: date, end_date: date, group_by: Optional[str] = None,
+                 granularity: str = 'day', filters: Optional[Dict[str, str]] = None,
+                 limit: int = DEFAULT_LIMIT):
+        if query_type not in QUERY_TYPES:
+            raise ValueError(f"Unknown query {query_type!r}; expected one of {', '.join(QUERY_TYPES)}")
+        if end_date < start_date:
+            raise ValueError("end_date must not be before start_date")
+        days = (end_date - start_date).days + 1
+        if days > MAX_RANGE_DAYS:
+            raise ValueError(f"Date range spans {days} days; the maximum is {MAX_RANGE_DAYS}")
+        if query_type == 'breakdown' and not group_by:
+            raise ValueError("A breakdown needs group_by")
+        if group_by is not None and group_by not in DIMENSIONS:
+            raise ValueError(f"Unknown group_by {group_by!r}; expected one of {', '.join(DIMENSIONS)}")
+        if granularity not in GRANULARITIES:
+            raise ValueError(f"Unknown granularity {granularity!r}; expected one of {', '.join(GRANULARITIES)}")
+        if not 1 <= limit <= MAX_LIMIT:
+            raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+
+        self.query_type = query_type
+        self.start_date = start_date
+        self.end_date = end_date
+        self.group_by = group_by if query_type != 'totals' else None
+        self.granularity = granularity
+        self.filters = {key: value for key, value in (filters or {}).items() if value not in (None, '')}
+        self.limit = limit
+
+    @classmethod
+    def from_params(cls, params: Dict[str, Any]) -> 'CostQuery':
+        """Build a query from request parameters (query string or JSON body).
+
+        Raises:
+            ValueError: If a parameter is missing or invalid.
+        """
+        for field in ('start_date', 'end_date'):
+            if not params.get(field):
+                raise ValueError(f"Missing required field: {field}")
+        unknown = set(params) - {'query', 'start_date', 'end_date', 'group_by', 'granularity', 'limit', *FILTERS}
+        if unknown:
+            raise ValueError(f"Unknown parameters: {', '.join(sorted(unknown))}")
+        return cls(
+            query_type=params.get('query') or 'totals',
+            start_date=date.fromisoformat(str(params['start_date'])),
+            end_date=date.fromisoformat(str(params['end_date'])),
+            group_by=params.get('group_by') or None,
+            granularity=params.get('granularity') or 'day',
+            filters={key: str(params[key]) for key in FILTERS if params.get(key) is not None},
+            limit=int(params.get('limit') or DEFAULT_LIMIT)
+        )
+
+    @property
+    def uses_details(self) -> bool:
+        """Whether the query needs per-row data rather than the daily rollup."""
+        return self.group_by == 'user' or 'user_id' in self.filters
+
+    def cache_key(self) -> Tuple[Any, ...]:
+        """Get a key identifying the question, independent of parameter order."""
+        return (self.query_type, self.start_date, self.end_date, self.group_by, self.granularity,
+                tuple(sorted(self.filters.items())), self.limit)
+
+    def describe(self) -> Dict[str, Any]:
+        """Echo the normalized question for the response."""
+        return {
+            "query": self.query_type,
+            "start_date": self.start_date.isoformat(),
+            "end_date": self.end_date.isoformat(),
+            "group_by": self.group_by,
+            "granularity": self.granularity if self.query_type == 'timeseries' else None,
+            "filters": self.filters
+        }
+
+    def build(self, dataset: str) -> Tuple[str, List[bigquery.ScalarQueryParameter]]:
+        """Build the SQL and query parameters.
+
+        Args:
+            dataset: Fully qualified dataset ID (``project.dataset``).
+
+        Returns:
+            The SQL text and its query parameters.
+        """
+        if self.uses_details:
+            source = f"`{dataset}.cost_details`(@start_date, @end_date, @service_name, @model)"
+            measures = _DETAIL_MEASURES
+            day = "DATE(timestamp)"
+        else:
+            source = f"`{dataset}.cost_summary`(@start_date, @end_date, @service_name, @model)"
+            measures = _ROLLUP_MEASURES
+            day = "date"
+
+        parameters = [
+            bigquery.ScalarQueryParameter("start_date", "DATE", self.start_date),
+            bigquery.ScalarQueryParameter("end_date", "DATE", self.end_date),
+            bigquery.ScalarQueryParameter("service_name", "STRING", self.filters.get('service_name')),
+            bigquery.ScalarQueryParameter("model", "STRING", self.filters.get('model')),
+        ]
+        conditions = []
+        for key in ('feature', 'project', 'user_id'):
+            if key in self.filters:
+                conditions.append(f"{key} = @{key}")
+                parameters.append(bigquery.ScalarQueryParameter(key, "STRING", self.filters[key]))
+        where = f"\nWHERE {' AND '.join(conditions)}" if conditions else ""
+
+        if self.query_type == 'totals':
+            return f"SELECT\n  {measures}\nFROM {source}{where}", parameters
+
+        dimension = DIMENSIONS[self.group_by] if self.group_by else None
+        if self.query_type == 'breakdown':
+            parameters.append(bigquery.ScalarQueryParameter("limit", "INT64", self.limit))
+            return (f"SELECT\n  {dimension} AS {self.group_by},\n  {measures}\nFROM {source}{where}\n"
+                    f"GROUP BY 1\nORDER BY cost DESC\nLIMIT @limit"), parameters
+
+        unit = GRANULARITIES[self.granularity]
+        period = f"DATE_TRUNC({day}, {unit})" if unit else day
+        columns = f"{period} AS period,\n  "
+        group = "GROUP BY 1"
+        order = "ORDER BY period"
+        if dimension:
+            columns += f"{dimension} AS {self.group_by},\n  "
+            group = "GROUP BY 1, 2"
+            order = "ORDER BY period, cost DESC"
+        return f"SELECT\n  {columns}{measures}\nFROM {source}{where}\n{group}\n{order}", parameters
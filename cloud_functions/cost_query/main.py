@@ -0,0 +1,114 @@
+import functions_framework
+import os
+import logging
+import threading
+import time
+from datetime import datetime
+import google.cloud.bigquery as bigquery
+import google.cloud.logging
+
+import json_codec
+from cost_queries import CostQuery
+from query_cache import DEFAULT_MAX_ENTRIES, DEFAULT_TTL_SECONDS, MISS, QueryCache
+
+# Setup structured logging
+logging_client = google.cloud.logging.Client()
+logging_client.setup_logging()
+logger = logging.getLogger('costwise-cost-query')
+logger.setLevel(logging.INFO)
+
+# Kept at module level so a warm instance reuses the client and cached results
+cache = QueryCache(
+    max_entries=int(os.environ.get('QUERY_CACHE_MAX_ENTRIES') or DEFAULT_MAX_ENTRIES),
+    ttl_seconds=float(os.environ.get('QUERY_CACHE_TTL_SECONDS') or DEFAULT_TTL_SECONDS)
+)
+_bq_client = None
+_bq_client_lock = threading.Lock()
+
+
+def get_bq_client(project_id):
+    """Get the BigQuery client shared by all requests of this instance."""
+    global _bq_client
+    with _bq_client_lock:
+        if _bq_client is None:
+            _bq_client = bigquery.Client(project=project_id)
+        return _bq_client
+
+
+@functions_framework.http
+def query_costs(request):
+    """HTTP Cloud Function answering cost questions as JSON.
+
+    Parameters are read from the query string of a GET request or the JSON
+    body of a POST request; see ``CostQuery.from_params``.
+    Args:
+        request (flask.Request): The request object.
+    Returns:
+        The response text, or any set of values that can be turned into a
+        Response object using `make_response`
+    """
+    request_id = request.headers.get('X-Request-Id', datetime.utcnow().isoformat())
+    started = time.monotonic()
+
+    try:
+        # Get environment variables
+        project_id = os.environ.get('PROJECT_ID')
+        dataset_id = os.environ.get('DATASET_ID')
+        dataset = f"{project_id}.{dataset_id}"
+
+        if request.method == 'POST':
+            params = request.get_json(silent=True) or {}
+        else:
+            params = request.args.to_dict()
+
+        try:
+            query = CostQuery.from_params(params)
+        except (TypeError, ValueError) as e:
+            logger.warning("Invalid cost query", extra={
+                "request_id": request_id,
+                "error": str(e),
+                "event_type": "validation_error"
+            })
+            return json_codec.dumps({"error": str(e)}), 400, {'Content-Type': 'application/json'}
+
+        def run_query():
+            sql, parameters = query.build(dataset)
+            query_job = get_bq_client(project_id).query(
+                sql, job_config=bigquery.QueryJobConfig(query_parameters=parameters))
+            rows = [dict(row.items()) for row in query_job.result()]
+            return {
+                "rows": rows,
+                "bytes_processed": query_job.total_bytes_processed or 0,
+                "computed_at": datetime.utcnow().isoformat()
+            }
+
+        result, cache_status = cache.get_or_load((dataset,) + query.cache_key(), run_query)
+
+        logger.info("Cost query served", extra={
+            "request_id": request_id,
+            **query.describe(),
+            "cache": cache_status,
+            "rows": len(result['rows']),
+            "bytes_processed": result['bytes_processed'] if cache_status == MISS else 0,
+            "duration_ms": round((time.monotonic() - started) * 1000, 1),
+            "event_type": "cost_query_served"
+        })
+
+        return json_codec.dumps({
+            **query.describe(),
+            **result,
+            "cache": cache_status
+        }), 200, {'Content-Type': 'application/json'}
+
+    except Exception as e:
+        logger.error("Unhandled exception in cost query handler", extra={
+            "request_id": request_id,
+            "error": str(e),
+            "error_type": type(e).__name__,
+            "event_type": "cost_query_error"
+        }, exc_info=True)
+
+        return json_codec.dumps({
+            "error": str(e),
+            "error_type": type(e).__name__
+        }), 500, {'Content-Type': 'application/json'}
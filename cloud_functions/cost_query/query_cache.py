@@ -0,0 +1,116 @@
+"""In-memory LRU cache with a TTL and request coalescing.
+
+Cloud Functions instances serve many requests while they are warm, so a
+module-level cache answers repeated questions without starting another
+BigQuery job. Concurrent requests for a key that is being loaded wait for
+that load instead of starting their own.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_TTL_SECONDS = 300
+
+# How a value was obtained, as reported by ``get_or_load``
+HIT = 'hit'
+MISS = 'miss'
+COALESCED = 'coalesced'
+
+
+class _Pending:
+    """A load in progress that other callers can wait on."""
+
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class QueryCache:
+    """Thread-safe LRU cache whose entries expire after a fixed TTL."""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, ttl_seconds: float = DEFAULT_TTL_SECONDS,
+                 clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max(1, int(max_entries))
+        self.ttl_seconds = float(ttl_seconds)
+        self.clock = clock
+        self._entries: 'OrderedDict[Hashable, Tuple[float, Any]]' = OrderedDict()
+        self._pending: Dict[Hashable, _Pending] = {}
+        self._lock = threading.Lock()
+        self.stats = {HIT: 0, MISS: 0, COALESCED: 0, 'evicted': 0}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _lookup(self, key: Hashable) -> Tuple[bool, Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        expires_at, value = entry
+        if expires_at <= self.clock():
+            del self._entries[key]
+            return False, None
+        self._entries.move_to_end(key)
+        return True, value
+
+    def _store(self, key: Hashable, value: Any) -> None:
+        self._entries[key] = (self.clock() + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.stats['evicted'] += 1
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any]) -> Tuple[Any, str]:
+        """Get a cached value, loading it at most once across concurrent callers.
+
+        Args:
+            key: Hashable cache key.
+            loader: Computes the value on a miss. Errors are raised to every
+                caller waiting on the load and nothing is cached.
+
+        Returns:
+            The value and how it was obtained: ``hit``, ``miss`` or ``coalesced``.
+        """
+        with self._lock:
+            found, value = self._lookup(key)
+            if found:
+                self.stats[HIT] += 1
+                return value, HIT
+            pending = self._pending.get(key)
+            leader = pending is None
+            if leader:
+                pending = _Pending()
+                self._pending[key] = pending
+                self.stats[MISS] += 1
+            else:
+                self.stats[COALESCED] += 1
+
+        if not leader:
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.value, COALESCED
+
+        try:
+            value = loader()
+            pending.value = value
+            with self._lock:
+                self._store(key, value)
+            return value, MISS
+        except BaseException as e:
+            pending.error = e
+            raise
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+            pending.done.set()
+
+    def clear(self) -> None:
+        """Drop all cached entries."""
+        with self._lock:
+            self._entries.clear()
@@ -12,10 +12,12 @@ __all__ = [
     'OpenAIAdapter',
     'PerplexityAdapter',
     'AdapterFactory',
+    'UsageRecord',
     'get_adapter_class'
 ]
 
 # Import the base adapter first since others depend on it
+from .usage_record import UsageRecord
 from .base_adapter import BaseServiceAdapter
 
 # Import service-specific adapters
@@ -3,8 +3,46 @@
 This module defines the base adapter interface that all service-specific adapters must implement.
 """
 
+import logging
+import time
 from abc import ABC, abstractmethod
-from typing import Dict, List, Any, Optional
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterator, List, Any, Optional, Tuple
+
+import requests
+
+try:
+    from .json_stream import STREAM_CHUNK_BYTES, iter_array_items, iter_response_items
+    from .pricing import PricingIndex, parse_timestamp
+    from .usage_record import UsageRecord
+except ImportError:
+    from adapters.json_stream import STREAM_CHUNK_BYTES, iter_array_items, iter_response_items
+    from adapters.pricing import PricingIndex, parse_timestamp
+    from adapters.usage_record import UsageRecord
+
+logger = logging.getLogger('costwise-data-collection')
+
+# additional_config keys consumed by the collector itself, never sent to provider APIs
+COLLECTOR_CONFIG_KEYS = frozenset({
+    'hours_lookback',
+    'limit',
+    'insert_chunk_size',
+    'max_pending_pages',
+    'stream_page_size',
+    'raw_response_policy',
+    'aggregate_hourly',
+    'aggregate_max_samples',
+    'spool',
+    'dedup_index',
+    'start_time',
+    'end_time',
+    'response_cache',
+    'finality_hours',
+    'reconcile_windows',
+})
+
+# Number of streamed usage items grouped into one page for the collector
+DEFAULT_STREAM_PAGE_SIZE = 500
 
 
 class BaseServiceAdapter(ABC):
@@ -14,6 +52,9 @@ class BaseServiceAdapter(ABC):
     Concrete implementations should handle the specifics of each AI service API.
     """
     
+    # Set by the collector to reuse provider responses for finalized windows
+    response_cache = None
+    
     def __init__(self, api_key: str, api_base_url: str, models: Dict[str, Any]):
         """Initialize the service adapter.
         
@@ -24,10 +65,11 @@ class BaseServiceAdapter(ABC):
         """
         self.api_key = api_key
         self.api_base_url = api_base_url
-        self.models = models
+        self.pricing = PricingIndex(models)
+        self.models = self.pricing.models
     
     @abstractmethod
-    def collect_data(self, endpoint: str, additional_config: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    def collect_data(self, endpoint: str, additional_config: Optional[Dict[str, Any]] = None) -> List[UsageRecord]:
         """Collect usage and cost data from the AI service API.
         
         Args:
@@ -35,20 +77,183 @@ class BaseServiceAdapter(ABC):
             additional_config: Additional service-specific configuration.
             
         Returns:
-            A list of dictionaries containing usage and cost data.
+            A list of UsageRecord objects containing usage and cost data.
         """
         pass
     
+    def iter_pages(self, endpoint: str, additional_config: Optional[Dict[str, Any]] = None) -> Iterator[List[UsageRecord]]:
+        """Collect usage and cost data one API page at a time.
+        
+        Adapters for paginated APIs override this so the collector can insert
+        each page while the next one is being fetched. The default yields
+        everything ``collect_data`` returns as a single page.
+        
+        Args:
+            endpoint: The specific API endpoint to collect data from.
+            additional_config: Additional service-specific configuration.
+            
+        Yields:
+            Lists of UsageRecord objects, one per API page.
+        """
+        yield self.collect_data(endpoint, additional_config)
+    
+    def collection_window(self, additional_config: Dict[str, Any]) -> Tuple[datetime, datetime]:
+        """Get the time range to collect, as naive UTC datetimes.
+        
+        ``start_time`` and ``end_time`` in ``additional_config`` (ISO 8601)
+        select a fixed window, e.g. for a backfill; otherwise the window ends
+        now and starts ``hours_lookback`` hours earlier.
+        
+        Args:
+            additional_config: Additional service-specific configuration.
+            
+        Returns:
+            The start and end of the window.
+        """
+        def config_time(key: str) -> Optional[datetime]:
+            value = additional_config.get(key)
+            if value is None or value == '':
+                return None
+            parsed = parse_timestamp(value)
+            if parsed is None:
+                raise ValueError(f"Invalid {key} in additional_config: {value!r}")
+            return parsed.astimezone(timezone.utc).replace(tzinfo=None)
+        
+        end_time = config_time('end_time') or datetime.utcnow()
+        start_time = config_time('start_time') or end_time - timedelta(hours=additional_config.get('hours_lookback', 24))
+        if start_time >= end_time:
+            raise ValueError("start_time must be before end_time")
+        return start_time, end_time
+    
+    def _get_with_retry(self, url: str, headers: Dict[str, str], params: Dict[str, Any],
+                        max_retries: int = 3, stream: bool = False) -> requests.Response:
+        """Fetch one API page, retrying transient failures with exponential backoff.
+        
+        Args:
+            url: The request URL.
+            headers: The request headers.
+            params: The query parameters.
+            max_retries: Maximum number of attempts.
+            stream: Defer downloading the body so it can be parsed incrementally.
+            
+        Returns:
+            The successful response.
+        """
+        retry_count = 0
+        while True:
+            try:
+                response = requests.get(url, headers=headers, params=params, stream=stream)
+                response.raise_for_status()
+                return response
+            except requests.exceptions.RequestException as e:
+                retry_count += 1
+                if retry_count >= max_retries:
+                    raise
+                logger.warning(f"API request attempt {retry_count} failed: {str(e)}", extra={
+                    "url": url,
+                    "error": str(e),
+                    "error_type": type(e).__name__,
+                    "retry_count": retry_count,
+                    "max_retries": max_retries
+                })
+                # Wait before retrying (exponential backoff)
+                time.sleep(2 ** retry_count)
+    
+    def _iter_item_pages(self, url: str, headers: Dict[str, str], params: Dict[str, Any],
+                         items_key: str, page_size: int = DEFAULT_STREAM_PAGE_SIZE,
+                         window_end: Optional[datetime] = None) -> Iterator[List[Any]]:
+        """Stream the items of a cursor-paginated API in fixed-size pages.
+        
+        Each response body is parsed incrementally, so items are handed out
+        before the download finishes. The ``has_more``/``next_page`` cursor
+        returned by the provider is passed back as the ``page`` query parameter.
+        When the window ending at ``window_end`` is finalized and a response
+        cache is set, responses are read from and written to the cache.
+        
+        Args:
+            url: The request URL.
+            headers: The request headers.
+            params: The query parameters for the first request.
+            items_key: Top-level key holding the array of usage items.
+            page_size: Maximum number of items per yielded page.
+            window_end: End of the window the request covers.
+            
+        Yields:
+            Lists of raw usage items.
+        """
+        params = dict(params)
+        page_size = max(1, int(page_size))
+        cache = self.response_cache
+        if cache is not None and (window_end is None or not cache.is_final(window_end)):
+            cache = None
+        while True:
+            fields: Dict[str, Any] = {}
+            cache_name = cache.name(type(self).__name__, self.api_key, url, params) if cache is not None else None
+            body = cache.get(cache_name) if cache_name is not None else None
+            response = chunks = None
+            if body is not None:
+                items = iter_array_items(body, (items_key,), fields)
+            else:
+                response = self._get_with_retry(url, headers, params, stream=True)
+                if cache_name is not None:
+                    chunks = self._tee(response, cache, cache_name)
+                    items = iter_array_items(chunks, (items_key,), fields)
+                else:
+                    items = iter_response_items(response, (items_key,), fields)
+            try:
+                page = []
+                for item in items:
+                    page.append(item)
+                    if len(page) >= page_size:
+                        yield page
+                        page = []
+                if page:
+                    yield page
+                if chunks is not None:
+                    # The parser stops at the closing brace; read to the end so the body is cached
+                    for _ in chunks:
+                        pass
+            finally:
+                # Closing the generators releases the cache reader, or discards a partly read body
+                if body is not None:
+                    body.close()
+                if chunks is not None:
+                    chunks.close()
+                if response is not None:
+                    response.close()
+            
+            if not fields.get('has_more') or not fields.get('next_page'):
+                break
+            params['page'] = fields['next_page']
+    
+    @staticmethod
+    def _tee(response: Any, cache: Any, cache_name: str) -> Iterator[bytes]:
+        """Yield the body chunks of a response, caching the body once it was read to the end."""
+        writer = cache.writer(cache_name)
+        committed = False
+        try:
+            for chunk in response.iter_content(chunk_size=STREAM_CHUNK_BYTES):
+                writer.write(chunk)
+                yield chunk
+            writer.commit()
+            committed = True
+        finally:
+            if not committed:
+                writer.abort()
+    
     @abstractmethod
-    def calculate_cost(self, model: str, input_tokens: int, output_tokens: int) -> Dict[str, float]:
+    def calculate_cost(self, model: str, input_tokens: int, output_tokens: int,
+                       timestamp: Any = None) -> Dict[str, Any]:
         """Calculate the cost for a specific API request.
         
         Args:
             model: The model name used for the request.
             input_tokens: Number of input/prompt tokens.
             output_tokens: Number of output/completion tokens.
+            timestamp: When the request was made; selects the effective price version.
             
         Returns:
-            A dictionary containing input_cost, output_cost, and total cost in USD.
+            A dictionary containing input_cost, output_cost, total cost in USD
+            and the price_version used.
         """
         pass
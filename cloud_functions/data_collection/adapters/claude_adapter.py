@@ -5,18 +5,19 @@ This module provides the adapter implementation for the Anthropic Claude API.
 
 import requests
 import time
-from datetime import datetime, timedelta
 import logging
 
 # Get a logger specific to this adapter
 logger = logging.getLogger('costwise-data-collection')
-from typing import Dict, List, Any, Optional
+from typing import Dict, Iterator, List, Any, Optional
 
 # Try importing with different approaches to handle both deployment and local development
 try:
-    from .base_adapter import BaseServiceAdapter
+    from .base_adapter import BaseServiceAdapter, DEFAULT_STREAM_PAGE_SIZE
+    from .usage_record import UsageRecord
 except ImportError:
-    from adapters.base_adapter import BaseServiceAdapter
+    from adapters.base_adapter import BaseServiceAdapter, DEFAULT_STREAM_PAGE_SIZE
+    from adapters.usage_record import UsageRecord
 
 
 class ClaudeAdapter(BaseServiceAdapter):
@@ -32,7 +33,7 @@ class ClaudeAdapter(BaseServiceAdapter):
         """
         super().__init__(api_key, api_base_url, models)
         
-    def collect_data(self, endpoint: str, additional_config: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    def collect_data(self, endpoint: str, additional_config: Optional[Dict[str, Any]] = None) -> List[UsageRecord]:
         """Collect usage and cost data from the Claude API.
         
         Args:
@@ -40,14 +41,25 @@ class ClaudeAdapter(BaseServiceAdapter):
             additional_config: Additional service-specific configuration.
             
         Returns:
-            A list of dictionaries containing usage and cost data.
+            A list of UsageRecord objects containing usage and cost data.
+        """
+        return [record for page in self.iter_pages(endpoint, additional_config) for record in page]
+    
+    def iter_pages(self, endpoint: str, additional_config: Optional[Dict[str, Any]] = None) -> Iterator[List[UsageRecord]]:
+        """Collect usage and cost data from the Claude API one page at a time.
+        
+        Args:
+            endpoint: The specific API endpoint to collect data from.
+            additional_config: Additional service-specific configuration.
+            
+        Yields:
+            Lists of UsageRecord objects, one per API page.
         """
         if additional_config is None:
             additional_config = {}
             
         # Configure the time range for data collection
-        end_time = datetime.utcnow()
-        start_time = end_time - timedelta(hours=additional_config.get('hours_lookback', 24))
+        start_time, end_time = self.collection_window(additional_config)
         
         # Format timestamps for API request
         start_timestamp = start_time.isoformat() + 'Z'
@@ -66,41 +78,42 @@ class ClaudeAdapter(BaseServiceAdapter):
         }
         
         try:
-            response = requests.get(url, headers=headers, params=params)
-            response.raise_for_status()
-            raw_data = response.json()
-            
-            # Process the API response into standardized format
-            result = []
-            for item in raw_data.get('data', []):
-                model = item.get('model')
-                input_tokens = item.get('input_tokens', 0)
-                output_tokens = item.get('output_tokens', 0)
+            page_size = additional_config.get('stream_page_size', DEFAULT_STREAM_PAGE_SIZE)
+            for items in self._iter_item_pages(url, headers, params, 'data', page_size, window_end=end_time):
+                # Process the API response into standardized format
+                result = []
+                for item in items:
+                    model = item.get('model')
+                    input_tokens = item.get('input_tokens', 0)
+                    output_tokens = item.get('output_tokens', 0)
+                    timestamp = item.get('timestamp') or item.get('created_at')
                 
-                # Calculate costs based on model pricing
-                cost_details = self.calculate_cost(model, input_tokens, output_tokens)
+                    # Calculate costs based on the model pricing in effect at request time
+                    cost_details = self.calculate_cost(model, input_tokens, output_tokens, timestamp)
                 
-                # Create standardized record
-                record = {
-                    'model': model,
-                    'feature': item.get('endpoint', 'chat'),
-                    'request_id': item.get('id'),
-                    'input_tokens': input_tokens,
-                    'output_tokens': output_tokens,
-                    'total_tokens': input_tokens + output_tokens,
-                    'input_cost': cost_details['input_cost'],
-                    'output_cost': cost_details['output_cost'],
-                    'cost': cost_details['total_cost'],
-                    'response_time_ms': item.get('response_time_ms', 0),
-                    'project': item.get('metadata', {}).get('project'),
-                    'user_id': item.get('metadata', {}).get('user_id'),
-                    'raw_response': item,
-                    'metadata': item.get('metadata', {})
-                }
+                    # Create standardized record
+                    record = UsageRecord(
+                        model=model,
+                        feature=item.get('endpoint', 'chat'),
+                        request_id=item.get('id'),
+                        input_tokens=input_tokens,
+                        output_tokens=output_tokens,
+                        total_tokens=input_tokens + output_tokens,
+                        input_cost=cost_details['input_cost'],
+                        output_cost=cost_details['output_cost'],
+                        cost=cost_details['total_cost'],
+                        price_version=cost_details['price_version'],
+                        timestamp=timestamp,
+                        response_time_ms=item.get('response_time_ms', 0),
+                        project=item.get('metadata', {}).get('project'),
+                        user_id=item.get('metadata', {}).get('user_id'),
+                        raw_response=item,
+                        metadata=item.get('metadata', {})
+                    )
                 
-                result.append(record)
+                    result.append(record)
                 
-            return result
+                yield result
             
         except requests.exceptions.RequestException as e:
             logger.error(f"Error collecting data from Claude API: {e}", extra={
@@ -109,29 +122,19 @@ class ClaudeAdapter(BaseServiceAdapter):
             })
             raise
     
-    def calculate_cost(self, model: str, input_tokens: int, output_tokens: int) -> Dict[str, float]:
+    def calculate_cost(self, model: str, input_tokens: int, output_tokens: int,
+                       timestamp: Any = None) -> Dict[str, Any]:
         """Calculate the cost for a Claude API request.
         
         Args:
             model: The Claude model name used for the request.
             input_tokens: Number of input/prompt tokens.
             output_tokens: Number of output/completion tokens.
+            timestamp: When the request was made; selects the effective price version.
             
         Returns:
-            A dictionary containing input_cost, output_cost, and total cost in USD.
+            A dictionary containing input_cost, output_cost, total cost in USD
+            and the price_version used.
         """
-        # Get model pricing information
-        model_info = self.models.get(model, {})
-        input_price_per_1k = model_info.get('input_price_per_1k', 0.0)
-        output_price_per_1k = model_info.get('output_price_per_1k', 0.0)
-        
-        # Calculate costs
-        input_cost = (input_tokens / 1000) * input_price_per_1k
-        output_cost = (output_tokens / 1000) * output_price_per_1k
-        total_cost = input_cost + output_cost
-        
-        return {
-            'input_cost': input_cost,
-            'output_cost': output_cost,
-            'total_cost': total_cost
-        }
+        # Look up the price version in effect when the request was made
+        return self.pricing.calculate_cost(model, input_tokens, output_tokens, timestamp)
@@ -0,0 +1,143 @@
+"""Compact usage record type produced by the service adapters.
+
+A ``UsageRecord`` holds one row of the ``cost_data`` table. It uses
+``__slots__`` instead of a per-instance ``__dict__`` and interns the
+low-cardinality string columns, so large collection windows fit in the
+memory of a small Cloud Functions instance.
+
+The analytic columns are written to ``cost_data``; the raw payload and
+metadata go to the ``cost_data_raw`` sibling table, joined on ``row_id``.
+"""
+
+import hashlib
+import sys
+import uuid
+from typing import Any, Dict, Optional, Sequence
+
+try:
+    from .json_codec import encode_json_value
+except ImportError:
+    from adapters.json_codec import encode_json_value
+
+# Column order matches terraform/modules/bigquery/schemas/cost_data_schema.json,
+# followed by the columns that only exist in cost_data_raw_schema.json
+FIELDS = (
+    'timestamp',
+    'service_name',
+    'model',
+    'feature',
+    'request_id',
+    'input_tokens',
+    'output_tokens',
+    'total_tokens',
+    'input_cost',
+    'output_cost',
+    'cost',
+    'price_version',
+    'response_time_ms',
+    'project',
+    'user_id',
+    'row_id',
+    'request_count',
+    'min_response_time_ms',
+    'max_response_time_ms',
+    'raw_response',
+    'metadata',
+)
+
+# Columns of the cost data table
+COST_FIELDS = FIELDS[:-2]
+
+# Columns of the raw payload table
+RAW_FIELDS = ('row_id', 'timestamp', 'service_name', 'raw_response', 'metadata')
+
+# Columns stored as BigQuery JSON values
+JSON_FIELDS = frozenset(('raw_response', 'metadata'))
+
+# Low-cardinality columns that are interned to share one string object per value
+INTERNED_FIELDS = frozenset(('service_name', 'model', 'feature', 'price_version'))
+
+
+def _intern(value: Any) -> Any:
+    return sys.intern(value) if type(value) is str else value
+
+
+def make_row_id(service_name: Optional[str], model: Optional[str], request_id: Any, timestamp: Any,
+                feature: Any = None) -> str:
+    """Build the row ID that links a cost row to its raw payload.
+
+    Rows with a provider request ID get a deterministic ID, so the same usage
+    item collected twice maps to the same row. Other rows get a random ID.
+    The feature (usage type) is part of the key, because some providers
+    report several line items per request ID and timestamp, one per usage type.
+    """
+    if request_id is None:
+        return uuid.uuid4().hex
+    parts = [service_name or '', model or '', str(request_id), str(timestamp or '')]
+    if feature is not None and feature != '':
+        parts.append(str(feature))
+    return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()[:32]
+
+class UsageRecord:
+    """A single usage and cost record for the cost data table."""
+
+    __slots__ = FIELDS
+
+    def __init__(self, timestamp: Any = None, service_name: Optional[str] = None,
+                 model: Optional[str] = None, feature: Optional[str] = None,
+                 request_id: Optional[str] = None, input_tokens: Any = None,
+                 output_tokens: Any = None, total_tokens: Any = None,
+                 input_cost: Any = None, output_cost: Any = None, cost: Any = None,
+                 price_version: Optional[str] = None, response_time_ms: Any = None,
+                 project: Optional[str] = None, user_id: Optional[str] = None,
+                 row_id: Optional[str] = None, request_count: Any = None,
+                 min_response_time_ms: Any = None, max_response_time_ms: Any = None,
+                 raw_response: Any = None, metadata: Any = None):
+        self.timestamp = timestamp
+        self.service_name = _intern(service_name)
+        self.model = _intern(model)
+        self.feature = _intern(feature)
+        self.request_id = request_id
+        self.input_tokens = input_tokens
+        self.output_tokens = output_tokens
+        self.total_tokens = total_tokens
+        self.input_cost = input_cost
+        self.output_cost = output_cost
+        self.cost = cost
+        self.price_version = _intern(price_version)
+        self.response_time_ms = response_time_ms
+        self.project = project
+        self.user_id = user_id
+        self.row_id = row_id
+        self.request_count = request_count
+        self.min_response_time_ms = min_response_time_ms
+        self.max_response_time_ms = max_response_time_ms
+        self.raw_response = raw_response
+        self.metadata = metadata
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'UsageRecord':
+        """Build a record from a dict, ignoring keys that are not table columns."""
+        return cls(**{name: data[name] for name in FIELDS if name in data})
+
+    def to_row(self, fields: Sequence[str] = FIELDS) -> Dict[str, Any]:
+        """Convert the record into a row for ``insert_rows_json``.
+
+        JSON columns are encoded to strings; missing values are omitted.
+
+        Args:
+            fields: The columns to include, e.g. ``COST_FIELDS`` or ``RAW_FIELDS``.
+        """
+        row = {}
+        for name in fields:
+            value = getattr(self, name)
+            if value is None:
+                continue
+            if name in JSON_FIELDS:
+                value = encode_json_value(value)
+            row[name] = value
+        return row
+
+    def __repr__(self) -> str:
+        return (f"UsageRecord(service_name={self.service_name!r}, model={self.model!r}, "
+                f"request_id={self.request_id!r}, timestamp={self.timestamp!r})")
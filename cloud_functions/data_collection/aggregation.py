@@ -0,0 +1,183 @@
+"""Hourly pre-aggregation of normalized usage records.
+
+Services that report one row per request can set ``aggregate_hourly`` in
+their ``additional_config``. Normalized records are then collapsed into one
+row per (hour, model, feature, project, user, price version) with summed
+tokens and costs, a request count and min/max/mean latency, and only those
+rows are inserted. Each row keeps up to ``aggregate_max_samples`` raw
+payloads of its requests (after the raw_response policy has been applied),
+so a few examples remain available for debugging.
+
+A bucket row's ``row_id``, which is also its streaming insert ID, covers
+the bucket key and an order-independent digest of the ``row_id`` of every
+record in it. Collecting the same records again gives the same row, while a
+bucket holding other records of the same hour (a partial flush, or new
+records of a re-collected hour) gets a row of its own that adds to it.
+"""
+
+import hashlib
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from adapters import json_codec
+from adapters.usage_record import UsageRecord, make_row_id
+
+DEFAULT_MAX_SAMPLES = 3
+
+# Open buckets kept in memory before the oldest hours are flushed as partial
+# rows; rows of the same bucket are additive, so an early flush only costs extra rows
+DEFAULT_MAX_OPEN_BUCKETS = 10000
+
+_MEMBER_MODULUS = 1 << 128
+
+
+class _Bucket:
+    """Running totals for one aggregation key."""
+
+    __slots__ = ('timestamp', 'service_name', 'model', 'feature', 'project', 'user_id', 'price_version',
+                 'request_count', 'input_tokens', 'output_tokens', 'total_tokens', 'input_cost',
+                 'output_cost', 'cost', 'response_time_total', 'response_time_count',
+                 'min_response_time_ms', 'max_response_time_ms', 'samples', 'members')
+
+    def __init__(self, timestamp: str, record: UsageRecord):
+        self.timestamp = timestamp
+        self.service_name = record.service_name
+        self.model = record.model
+        self.feature = record.feature
+        self.project = record.project
+        self.user_id = record.user_id
+        self.price_version = record.price_version
+        self.request_count = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.total_tokens = 0
+        self.input_cost = None
+        self.output_cost = None
+        self.cost = 0.0
+        self.response_time_total = 0
+        self.response_time_count = 0
+        self.min_response_time_ms = None
+        self.max_response_time_ms = None
+        self.samples: List[str] = []
+        # Sum of the member records' row IDs, so the bucket row's ID depends on its contents
+        self.members = 0
+
+
+def _add_cost(total: Optional[float], value: Optional[float]) -> Optional[float]:
+    if value is None:
+        return total
+    return value if total is None else total + value
+
+
+class HourlyAggregator:
+    """Collapses normalized usage records into hourly buckets."""
+
+    def __init__(self, max_samples: int = DEFAULT_MAX_SAMPLES,
+                 max_open_buckets: int = DEFAULT_MAX_OPEN_BUCKETS):
+        self.max_samples = max(0, int(max_samples))
+        self.max_open_buckets = max(1, int(max_open_buckets))
+        self.buckets: Dict[Tuple[Any, ...], _Bucket] = {}
+        self.records_in = 0
+        self.rows_out = 0
+
+    @classmethod
+    def from_config(cls, additional_config: Dict[str, Any]) -> Optional['HourlyAggregator']:
+        """Build the aggregator if the service enables ``aggregate_hourly``."""
+        if not additional_config.get('aggregate_hourly'):
+            return None
+        return cls(max_samples=additional_config.get('aggregate_max_samples', DEFAULT_MAX_SAMPLES))
+
+    def __len__(self) -> int:
+        return len(self.buckets)
+
+    def is_full(self) -> bool:
+        """Whether the open buckets should be drained before adding more records."""
+        return len(self.buckets) >= self.max_open_buckets
+
+    def add(self, record: UsageRecord) -> None:
+        """Add a normalized record to its hourly bucket."""
+        # Normalized timestamps are UTC ISO strings, so the hour is a prefix
+        hour = record.timestamp[:13]
+        key = (hour, record.model, record.feature, record.project, record.user_id, record.price_version)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = _Bucket(f"{hour}:00:00+00:00", record)
+            self.buckets[key] = bucket
+
+        self.records_in += 1
+        member = hashlib.blake2b(str(record.row_id).encode('utf-8'), digest_size=16).digest()
+        bucket.members = (bucket.members + int.from_bytes(member, 'big')) % _MEMBER_MODULUS
+        bucket.request_count += 1
+        bucket.input_tokens += record.input_tokens
+        bucket.output_tokens += record.output_tokens
+        bucket.total_tokens += record.total_tokens
+        bucket.input_cost = _add_cost(bucket.input_cost, record.input_cost)
+        bucket.output_cost = _add_cost(bucket.output_cost, record.output_cost)
+        bucket.cost += record.cost
+
+        latency = record.response_time_ms
+        if latency is not None:
+            bucket.response_time_total += latency
+            bucket.response_time_count += 1
+            if bucket.min_response_time_ms is None or latency < bucket.min_response_time_ms:
+                bucket.min_response_time_ms = latency
+            if bucket.max_response_time_ms is None or latency > bucket.max_response_time_ms:
+                bucket.max_response_time_ms = latency
+
+        if record.raw_response is not None and len(bucket.samples) < self.max_samples:
+            bucket.samples.append(json_codec.encode_json_value(record.raw_response))
+
+    def drain(self) -> Iterator[UsageRecord]:
+        """Yield one record per open bucket and clear the buckets."""
+        buckets, self.buckets = self.buckets, {}
+        for key, bucket in buckets.items():
+            yield self._row(key, bucket)
+
+    def evict(self) -> Iterator[UsageRecord]:
+        """Yield the buckets of the oldest hours until at most half of the limit stays open.
+
+        Providers mostly report usage in time order, so the oldest hours are
+        the least likely to receive more records and split into partial rows.
+        """
+        keep = self.max_open_buckets // 2
+        for key in sorted(self.buckets, key=lambda key: key[0]):
+            if len(self.buckets) <= keep:
+                break
+            yield self._row(key, self.buckets.pop(key))
+
+    def _row(self, key: Tuple[Any, ...], bucket: _Bucket) -> UsageRecord:
+        self.rows_out += 1
+        raw_response = None
+        if bucket.samples:
+            # Samples are already encoded, so splice them instead of encoding twice
+            raw_response = json_codec.EncodedJSON(f'{{"samples":[{",".join(bucket.samples)}]}}')
+        bucket_id = '|'.join([str(part) for part in key] + [f"{bucket.members:032x}"])
+        return UsageRecord(
+            timestamp=bucket.timestamp,
+            service_name=bucket.service_name,
+            model=bucket.model,
+            feature=bucket.feature,
+            input_tokens=bucket.input_tokens,
+            output_tokens=bucket.output_tokens,
+            total_tokens=bucket.total_tokens,
+            input_cost=bucket.input_cost,
+            output_cost=bucket.output_cost,
+            cost=bucket.cost,
+            price_version=bucket.price_version,
+            response_time_ms=(round(bucket.response_time_total / bucket.response_time_count)
+                              if bucket.response_time_count else None),
+            project=bucket.project,
+            user_id=bucket.user_id,
+            row_id=make_row_id(bucket.service_name, bucket.model, bucket_id, bucket.timestamp),
+            request_count=bucket.request_count,
+            min_response_time_ms=bucket.min_response_time_ms,
+            max_response_time_ms=bucket.max_response_time_ms,
+            raw_response=raw_response,
+            metadata={"aggregation": "hour", "requests": bucket.request_count}
+        )
+
+    def summary(self) -> Dict[str, Any]:
+        """Summarize the aggregation for a structured log entry."""
+        return {
+            "aggregated_records": self.records_in,
+            "aggregated_rows": self.rows_out
+        }
@@ -0,0 +1,271 @@
+"""Incremental maintenance of the daily cost rollup table.
+
+The rollup holds one row per day, service, model, feature and project. After
+rows are inserted into (or updated in) the cost table, ``refresh_daily_rollup``
+recomputes the rollup rows of the touched days for that service from the cost
+table with a single MERGE. Because the touched keys are recomputed from the
+source rather than incremented, the refresh is idempotent and safe to retry.
+
+Writers that must not wait for a MERGE, such as the real-time ingestion
+endpoint, record the days they wrote instead with ``RollupMarkers``: an
+empty marker object per service, day, minute and instance in the data
+bucket::
+
+    pending_rollups/<service>/<yyyy-mm-dd>/<minute>-<instance>
+
+A marker is written after the rows of its minute were inserted, and only
+the first time an instance writes a day in that minute, so each instance
+writes at most one object per service and day per minute. The collector
+refreshes the days of markers whose minute ended a while ago, when every
+insert the marker stands for has completed, and deletes the markers
+afterwards.
+
+This module is duplicated in each Cloud Function source directory, since
+the functions are deployed independently.
+"""
+
+import threading
+import time
+import urllib.parse
+import uuid
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import google.cloud.bigquery as bigquery
+from google.api_core import exceptions as api_exceptions
+
+# Attempts made when concurrent DML on the rollup table conflicts
+MAX_ATTEMPTS = 3
+
+ROLLUP_MARKER_PREFIX = 'pending_rollups'
+
+# Markers are only refreshed once their minute ended this long ago, so the
+# inserts they stand for have completed and clock skew is covered
+DEFAULT_MARKER_SETTLE_SECONDS = 120
+
+
+def rollup_dates(timestamps: Iterable[Any]) -> Set[date]:
+    """Get the UTC days of a collection of ISO timestamps or datetimes."""
+    dates = set()
+    for value in timestamps:
+        if value is None:
+            continue
+        if isinstance(value, datetime):
+            if value.tzinfo is not None:
+                value = value.astimezone(timezone.utc)
+            dates.add(value.date())
+        elif isinstance(value, date):
+            dates.add(value)
+        else:
+            dates.add(date.fromisoformat(str(value)[:10]))
+    return dates
+
+
+def build_rollup_merge_query(cost_table: str, rollup_table: str) -> str:
+    """Build the MERGE that recomputes the rollup rows of some days of one service.
+
+    Expects the ``service_name``, ``dates`` (ARRAY<DATE>), ``range_start``
+    and ``range_end`` query parameters; the timestamp range prunes the cost
+    table partitions. Rollup rows whose key no longer appears in the source
+    are deleted. NULL features and projects are stored as empty strings so
+    they can be part of the merge key. Pre-aggregated rows count as
+    ``request_count`` requests, with ``response_time_ms`` as their mean.
+    """
+    return f"""
+MERGE `{rollup_table}` T
+USING (
+  SELECT
+    DATE(timestamp) AS date,
+    service_name,
+    model,
+    IFNULL(feature, '') AS feature,
+    IFNULL(project, '') AS project,
+    SUM(IFNULL(request_count, 1)) AS request_count,
+    SUM(IFNULL(input_tokens, 0)) AS total_input_tokens,
+    SUM(IFNULL(output_tokens, 0)) AS total_output_tokens,
+    SUM(IFNULL(total_tokens, 0)) AS total_tokens,
+    SUM(IFNULL(cost, 0)) AS total_cost,
+    SUM(IFNULL(response_time_ms * IFNULL(request_count, 1), 0)) AS total_response_time_ms,
+    SUM(IF(response_time_ms IS NULL, 0, IFNULL(request_count, 1))) AS response_time_count
+  FROM `{cost_table}`
+  WHERE timestamp >= @range_start AND timestamp < @range_end
+    AND DATE(timestamp) IN UNNEST(@dates)
+    AND service_name = @service_name
+  GROUP BY date, service_name, model, feature, project
+) S
+ON T.date = S.date
+  AND T.service_name = S.service_name
+  AND T.model = S.model
+  AND T.feature = S.feature
+  AND T.project = S.project
+WHEN MATCHED THEN UPDATE SET
+  request_count = S.request_count,
+  total_input_tokens = S.total_input_tokens,
+  total_output_tokens = S.total_output_tokens,
+  total_tokens = S.total_tokens,
+  total_cost = S.total_cost,
+  total_response_time_ms = S.total_response_time_ms,
+  response_time_count = S.response_time_count,
+  updated_at = CURRENT_TIMESTAMP()
+WHEN NOT MATCHED BY TARGET THEN INSERT (
+  date, service_name, model, feature, project, request_count, total_input_tokens,
+  total_output_tokens, total_tokens, total_cost, total_response_time_ms, response_time_count, updated_at
+) VALUES (
+  S.date, S.service_name, S.model, S.feature, S.project, S.request_count, S.total_input_tokens,
+  S.total_output_tokens, S.total_tokens, S.total_cost, S.total_response_time_ms, S.response_time_count,
+  CURRENT_TIMESTAMP()
+)
+WHEN NOT MATCHED BY SOURCE AND T.date IN UNNEST(@dates) AND T.service_name = @service_name THEN DELETE
+"""
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, (api_exceptions.Conflict, api_exceptions.InternalServerError,
+                          api_exceptions.ServiceUnavailable)):
+        return True
+    # Concurrent DML on the same partitions fails with a serialization error
+    return isinstance(error, api_exceptions.BadRequest) and 'serialize' in str(error).lower()
+
+
+def refresh_daily_rollup(bq_client: bigquery.Client, cost_table: str, rollup_table: str,
+                         service_name: str, dates: Iterable[date],
+                         max_attempts: int = MAX_ATTEMPTS) -> Optional[Dict[str, Any]]:
+    """Recompute the rollup rows of the given days for one service.
+
+    Args:
+        bq_client: BigQuery client.
+        cost_table: Fully qualified cost data table ID.
+        rollup_table: Fully qualified daily rollup table ID.
+        service_name: Service whose rows changed.
+        dates: UTC days that received new or changed rows.
+        max_attempts: Attempts made when the MERGE conflicts with another DML job.
+
+    Returns:
+        A summary with the refreshed days, affected rollup rows and bytes
+        processed, or None if there was nothing to refresh.
+    """
+    dates = sorted(set(dates))
+    if not dates:
+        return None
+
+    range_start = datetime.combine(dates[0], datetime.min.time(), tzinfo=timezone.utc)
+    range_end = datetime.combine(dates[-1], datetime.min.time(), tzinfo=timezone.utc) + timedelta(days=1)
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("service_name", "STRING", service_name),
+        bigquery.ArrayQueryParameter("dates", "DATE", dates),
+        bigquery.ScalarQueryParameter("range_start", "TIMESTAMP", range_start),
+        bigquery.ScalarQueryParameter("range_end", "TIMESTAMP", range_end),
+    ])
+    query = build_rollup_merge_query(cost_table, rollup_table)
+
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            query_job = bq_client.query(query, job_config=job_config)
+            query_job.result()
+            break
+        except Exception as e:
+            if attempt >= max_attempts or not _is_retryable(e):
+                raise
+            time.sleep(2 ** attempt)
+
+    return {
+        "service_name": service_name,
+        "dates": [day.isoformat() for day in dates],
+        "rows_affected": query_job.num_dml_affected_rows or 0,
+        "bytes_processed": query_job.total_bytes_processed or 0,
+        "attempts": attempt
+    }
+
+
+class RollupMarkers:
+    """Days written per service, recorded in the data bucket for a later rollup refresh."""
+
+    def __init__(self, store: Any, clock: Callable[[], float] = time.time):
+        """Initialize the markers.
+
+        Args:
+            store: Blob store of the data bucket.
+            clock: Returns the current time in epoch seconds.
+        """
+        self.store = store
+        self.clock = clock
+        self.instance = uuid.uuid4().hex[:12]
+        self._minute = None
+        self._marked: Set[Tuple[str, date]] = set()
+        self._lock = threading.Lock()
+
+    def mark(self, service_name: str, dates: Iterable[date]) -> int:
+        """Record days that received rows; call after the rows were inserted.
+
+        Returns:
+            The number of marker objects written.
+        """
+        minute = int(self.clock() // 60)
+        with self._lock:
+            if minute != self._minute:
+                self._minute = minute
+                self._marked = set()
+            new = [day for day in set(dates) if (service_name, day) not in self._marked]
+            self._marked.update((service_name, day) for day in new)
+        service = urllib.parse.quote(service_name, safe='')
+        for day in sorted(new):
+            try:
+                self.store.put(f"{ROLLUP_MARKER_PREFIX}/{service}/{day.isoformat()}/{minute}-{self.instance}", b'')
+            except Exception:
+                # Let a later write of the day in this minute try again
+                with self._lock:
+                    if minute == self._minute:
+                        self._marked.discard((service_name, day))
+                raise
+        return len(new)
+
+    def pending(self, settle_seconds: float = DEFAULT_MARKER_SETTLE_SECONDS) -> Dict[str, Tuple[Set[date], List[str]]]:
+        """Get the marked days of every service whose markers have settled.
+
+        Returns:
+            For each service, its marked days and the names of the markers.
+        """
+        newest_minute = int((self.clock() - settle_seconds) // 60) - 1
+        pending: Dict[str, Tuple[Set[date], List[str]]] = {}
+        for name in self.store.list(f"{ROLLUP_MARKER_PREFIX}/"):
+            parts = name.split('/')
+            if len(parts) != 4:
+                continue
+            try:
+                day = date.fromisoformat(parts[2])
+                minute = int(parts[3].split('-', 1)[0])
+            except ValueError:
+                continue
+            if minute > newest_minute:
+                continue
+            dates, names = pending.setdefault(urllib.parse.unquote(parts[1]), (set(), []))
+            dates.add(day)
+            names.append(name)
+        return pending
+
+    def delete(self, names: Iterable[str]) -> None:
+        """Delete markers whose days were refreshed."""
+        for name in names:
+            self.store.delete(name)
+
+
+def refresh_marked_rollups(bq_client: bigquery.Client, cost_table: str, rollup_table: str,
+                           markers: RollupMarkers,
+                           settle_seconds: float = DEFAULT_MARKER_SETTLE_SECONDS) -> Dict[str, Any]:
+    """Refresh the rollup of every marked day and delete the markers of refreshed services.
+
+    Returns:
+        The refresh summary of each marked service, or ``{"error": ...}`` if
+        its refresh failed; the markers of a failed service are kept.
+    """
+    results = {}
+    for service_name, (dates, names) in sorted(markers.pending(settle_seconds).items()):
+        try:
+            results[service_name] = refresh_daily_rollup(bq_client, cost_table, rollup_table, service_name, dates)
+        except Exception as e:
+            results[service_name] = {"error": str(e), "error_type": type(e).__name__}
+            continue
+        markers.delete(names)
+    return results
@@ -0,0 +1,188 @@
+"""Cross-run membership index of ingested records.
+
+Collection runs look back over overlapping windows, so most records of a
+run were already inserted by an earlier one. BigQuery only deduplicates
+streaming insert IDs for a few minutes, so the collector keeps its own
+index of the records it has ingested: one file per service and day in the
+data bucket, holding the sorted 64-bit fingerprints of the day's record keys::
+
+    dedup_index/<service>/<yyyy>/<mm>/<dd>.fp
+
+At 8 bytes per request a day of a million requests is an 8 MB file, and a
+lookup is a binary search. With 64-bit fingerprints the chance of a false
+positive (a new request dropped as seen) stays below one in a billion per
+lookup for a few million requests per day. Day files are cached in memory
+between invocations of a warm instance.
+
+A record's key is its deterministic ``row_id``, which covers the service,
+model, request ID, timestamp and feature: some providers report several line
+items under one synthetic request ID. Records without a request ID cannot be
+matched and always pass through; only normalized records are looked up.
+"""
+
+import bisect
+import hashlib
+import heapq
+import sys
+import threading
+import time
+import urllib.parse
+from array import array
+from datetime import date
+from typing import Any, Callable, Dict, Iterable, Optional, Set, Tuple
+
+from blob_store import BlobStore
+
+INDEX_PREFIX = 'dedup_index'
+INDEX_SUFFIX = '.fp'
+
+# Format marker and version at the start of every index file
+_MAGIC = b'CWFP\x01'
+
+# Cached day files are re-read after this long, to pick up other instances' writes
+DEFAULT_CACHE_TTL_SECONDS = 900
+
+# Day files cached per instance
+MAX_CACHED_DAYS = 64
+
+# Shared by all runs of an instance: name -> (loaded_at, fingerprints)
+_cache: Dict[str, Tuple[float, array]] = {}
+_cache_lock = threading.Lock()
+
+
+def fingerprint(key: Any) -> int:
+    """Get the 64-bit fingerprint of a record key."""
+    return int.from_bytes(hashlib.blake2b(str(key).encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def encode_fingerprints(fingerprints: array) -> bytes:
+    """Serialize sorted fingerprints as little-endian uint64 values."""
+    if sys.byteorder == 'big':
+        fingerprints = array('Q', fingerprints)
+        fingerprints.byteswap()
+    return _MAGIC + fingerprints.tobytes()
+
+
+def decode_fingerprints(data: bytes) -> array:
+    """Deserialize the sorted fingerprints of an index file."""
+    if not data.startswith(_MAGIC):
+        raise ValueError("Not a dedup index file")
+    fingerprints = array('Q')
+    fingerprints.frombytes(data[len(_MAGIC):])
+    if sys.byteorder == 'big':
+        fingerprints.byteswap()
+    return fingerprints
+
+
+def _merge(existing: array, added: Set[int]) -> array:
+    """Merge new fingerprints into a sorted array, keeping it sorted and unique."""
+    merged = array('Q')
+    last = None
+    for value in heapq.merge(existing, sorted(added)):
+        if value != last:
+            merged.append(value)
+            last = value
+    return merged
+
+
+class DedupIndex:
+    """Keys of the records of one service already ingested, by day."""
+
+    def __init__(self, store: BlobStore, service_name: str,
+                 cache_ttl_seconds: float = DEFAULT_CACHE_TTL_SECONDS,
+                 clock: Callable[[], float] = time.monotonic):
+        """Initialize the index.
+
+        Args:
+            store: Blob store of the data bucket.
+            service_name: Service whose records are indexed.
+            cache_ttl_seconds: Age after which a cached day file is re-read.
+            clock: Monotonic clock, in seconds.
+        """
+        self.store = store
+        self.prefix = f"{INDEX_PREFIX}/{urllib.parse.quote(service_name, safe='')}/"
+        self.cache_ttl_seconds = cache_ttl_seconds
+        self.clock = clock
+        self._days: Dict[date, array] = {}
+        self._added: Dict[date, Set[int]] = {}
+        self.stats = {'lookups': 0, 'seen': 0, 'days_loaded': 0, 'days_written': 0, 'keys_written': 0}
+
+    def _name(self, day: date) -> str:
+        return f"{self.prefix}{day:%Y/%m/%d}{INDEX_SUFFIX}"
+
+    def _load(self, day: date) -> array:
+        fingerprints = self._days.get(day)
+        if fingerprints is not None:
+            return fingerprints
+        name = self._name(day)
+        now = self.clock()
+        with _cache_lock:
+            cached = _cache.get(name)
+        if cached is not None and now - cached[0] < self.cache_ttl_seconds:
+            fingerprints = cached[1]
+        else:
+            data = self.store.get(name)
+            fingerprints = decode_fingerprints(data) if data else array('Q')
+            self._remember(name, now, fingerprints)
+            self.stats['days_loaded'] += 1
+        self._days[day] = fingerprints
+        return fingerprints
+
+    @staticmethod
+    def _remember(name: str, loaded_at: float, fingerprints: array) -> None:
+        with _cache_lock:
+            _cache.pop(name, None)
+            _cache[name] = (loaded_at, fingerprints)
+            while len(_cache) > MAX_CACHED_DAYS:
+                # Dicts keep insertion order, so the first entry is the least recently loaded
+                del _cache[next(iter(_cache))]
+
+    def seen(self, key: Any, day: Optional[date]) -> bool:
+        """Whether a record was ingested before or already seen in this run.
+
+        Records not seen before are remembered for this run, so a record
+        repeated within one run is reported as seen the second time.
+        """
+        if key is None or key == '' or day is None:
+            return False
+        self.stats['lookups'] += 1
+        key = fingerprint(key)
+        fingerprints = self._load(day)
+        index = bisect.bisect_left(fingerprints, key)
+        added = self._added.setdefault(day, set())
+        if (index < len(fingerprints) and fingerprints[index] == key) or key in added:
+            self.stats['seen'] += 1
+            return True
+        added.add(key)
+        return False
+
+    def add(self, keys: Iterable[Tuple[Any, Optional[date]]]) -> None:
+        """Remember records that were ingested without being looked up first."""
+        for key, day in keys:
+            if key is None or key == '' or day is None:
+                continue
+            self._added.setdefault(day, set()).add(fingerprint(key))
+
+    def flush(self) -> None:
+        """Write the record keys of this run to the day files."""
+        for day, added in sorted(self._added.items()):
+            if not added:
+                continue
+            # Re-read the file so keys written by another run since it was loaded are kept
+            name = self._name(day)
+            data = self.store.get(name)
+            merged = _merge(decode_fingerprints(data) if data else array('Q'), added)
+            self.store.put(name, encode_fingerprints(merged))
+            self._remember(name, self.clock(), merged)
+            self._days[day] = merged
+            self.stats['days_written'] += 1
+            self.stats['keys_written'] += len(added)
+        self._added = {}
+
+    def discard(self) -> None:
+        """Forget the record keys of this run without writing them."""
+        self._added = {}
+
+    def summary(self) -> Dict[str, Any]:
+        """Get index counters for logging."""
+        return {f"dedup_{key}": value for key, value in self.stats.items()}
@@ -1,20 +1,38 @@
 import functions_framework
 import os
-import json
+import sys
 import logging
 import importlib
 import time
-from datetime import datetime
+from datetime import date, datetime
 import google.cloud.bigquery as bigquery
 import google.cloud.secretmanager as secretmanager
 import google.cloud.logging
 
+from adapters import json_codec
+from adapters.usage_record import COST_FIELDS, RAW_FIELDS, UsageRecord
+from aggregation import HourlyAggregator
+from blob_store import open_blob_store
+from cost_rollup import RollupMarkers, refresh_daily_rollup, refresh_marked_rollups, rollup_dates
+from dead_letters import DeadLetterWriter
+from dedup_index import DedupIndex
+from normalizer import NormalizationStats, RecordNormalizer
+from pipeline import CollectionPipeline, DEFAULT_CHUNK_SIZE, DEFAULT_MAX_PENDING_PAGES
+from raw_response_policy import RawResponseOffloader, RawResponsePolicy
+from response_cache import ResponseCache
+from spool import WriteAheadSpool
+from window_reconciliation import (WindowDigests, WindowReconciler, WindowStaging, reconcile_window,
+                                   replace_windows)
+
 # Setup structured logging
 logging_client = google.cloud.logging.Client()
 logging_client.setup_logging()
 logger = logging.getLogger('costwise-data-collection')
 logger.setLevel(logging.INFO)
 
+# Compiled once per instance from cost_data_schema.json
+record_normalizer = RecordNormalizer.from_schema_file()
+
 
 @functions_framework.http
 def collect_data(request):
@@ -38,18 +56,30 @@ def collect_data(request):
         dataset_id = os.environ.get("DATASET_ID")
         service_config_table_id = os.environ.get("SERVICE_CONFIG_TABLE_ID")
         cost_data_table_id = os.environ.get("COST_DATA_TABLE_ID")
+        cost_data_raw_table_id = os.environ.get("COST_DATA_RAW_TABLE_ID") or f"{cost_data_table_id}_raw"
+        cost_rollup_table_id = os.environ.get("COST_ROLLUP_TABLE_ID") or f"{cost_data_table_id}_daily"
+        data_bucket_name = os.environ.get("DATA_BUCKET_NAME")
         
         logger.info(f"Configuration loaded", extra={
             "request_id": request_id,
             "project_id": project_id,
             "dataset_id": dataset_id,
             "service_config_table_id": service_config_table_id,
-            "cost_data_table_id": cost_data_table_id
+            "cost_data_table_id": cost_data_table_id,
+            "cost_data_raw_table_id": cost_data_raw_table_id,
+            "cost_rollup_table_id": cost_rollup_table_id,
+            "data_bucket_name": data_bucket_name
         })
 
         # Initialize clients
         bq_client = bigquery.Client(project=project_id)
         sm_client = secretmanager.SecretManagerServiceClient()
+        data_store = open_blob_store(data_bucket_name)
+        dead_letters = DeadLetterWriter(data_store, 'data_collection') if data_store is not None else None
+        
+        # A request may collect a fixed window for every service, e.g. to backfill finalized days
+        request_json = request.get_json(silent=True) or {}
+        window_override = {key: request_json[key] for key in ("start_time", "end_time") if request_json.get(key)}
 
         # Query service configurations from BigQuery
         query = f"""SELECT * FROM `{project_id}.{dataset_id}.{service_config_table_id}` WHERE active = TRUE"""
@@ -241,6 +271,9 @@ def collect_data(request):
                     })
                     additional_config = {}
                 
+                if window_override:
+                    additional_config = {**additional_config, **window_override}
+                
                 # Set a default hours_lookback if not specified
                 if "hours_lookback" not in additional_config:
                     additional_config["hours_lookback"] = 24
@@ -249,177 +282,463 @@ def collect_data(request):
                         "service_name": service_name
                     })
                 
-                # Add retry logic for API calls
-                max_retries = 3
-                retry_count = 0
+                # Normalize each record in a single pass as it comes off the pipeline
+                collected_at = datetime.utcnow()
+                interned_service_name = sys.intern(service_name)
+                normalization_stats = NormalizationStats()
+                
+                # Trim, sample or offload raw_response according to the service's policy
+                raw_response_policy = RawResponsePolicy.from_config(additional_config)
+                raw_offloader = None
+                if raw_response_policy is not None and raw_response_policy.offload:
+                    if data_store is None:
+                        logger.warning(f"raw_response offload requested for {service_name} but DATA_BUCKET_NAME is not set", extra={
+                            "request_id": request_id,
+                            "service_name": service_name,
+                            "event_type": "raw_response_offload_disabled"
+                        })
+                    else:
+                        raw_offloader = RawResponseOffloader(data_store, interned_service_name, collected_at)
                 
-                while retry_count < max_retries:
+                # Optionally collapse per-request records into hourly buckets before inserting
+                aggregator = HourlyAggregator.from_config(additional_config)
+                chunk_size = additional_config.get("insert_chunk_size", DEFAULT_CHUNK_SIZE)
+                
+                def flush_offloaded(records_count):
+                    # Write the offloaded payloads; failures are logged and the rows keep their references
                     try:
-                        collection_start = time.time()
-                        service_data = adapter.collect_data(
-                            endpoint=service_config["data_collection_endpoint"],
-                            additional_config=additional_config,
+                        raw_offloader.flush()
+                    except Exception as e:
+                        logger.error(f"Failed to offload raw responses for {service_name}: {str(e)}", extra={
+                            "request_id": request_id,
+                            "service_name": service_name,
+                            "records_count": records_count,
+                            "error": str(e),
+                            "event_type": "raw_response_offload_error"
+                        })
+                
+                # Replace the hours whose data changed since the last run instead of appending rows
+                reconciler = None
+                staging = None
+                if additional_config.get("reconcile_windows"):
+                    if data_store is None:
+                        logger.warning(f"Window reconciliation requested for {service_name} but DATA_BUCKET_NAME is not set", extra={
+                            "request_id": request_id,
+                            "service_name": service_name,
+                            "event_type": "reconciliation_disabled"
+                        })
+                    else:
+                        # Collect whole hours, so every hour compared is complete
+                        window_start, window_end = reconcile_window(*adapter.collection_window(additional_config))
+                        additional_config = {
+                            **additional_config,
+                            "start_time": f"{window_start:%Y-%m-%dT%H:%M:%S}Z",
+                            "end_time": f"{window_end:%Y-%m-%dT%H:%M:%S}Z"
+                        }
+                        reconciler = WindowReconciler(
+                            WindowDigests(data_store, interned_service_name),
+                            window_start,
+                            window_end,
+                            aggregator=aggregator
                         )
-                        collection_duration = time.time() - collection_start
-                        
-                        logger.info(f"Data collection complete for {service_name}", extra={
+                        # Rows of every hour are staged in the data bucket until the changed hours are known
+                        staging = WindowStaging(data_store, interned_service_name, window_start, window_end)
+                
+                # Drop records an earlier run already ingested before they are inserted;
+                # reconciliation compares whole hours, so it needs every record
+                dedup_index = None
+                if data_store is not None and reconciler is None and additional_config.get("dedup_index", True):
+                    dedup_index = DedupIndex(data_store, interned_service_name)
+                
+                def index_key(request_id, row_id, timestamp):
+                    # The row ID covers service, model, request ID, timestamp and feature, so line items
+                    # that share a synthetic request ID stay apart; without a request ID it is random
+                    if request_id is None or request_id == '':
+                        return None, None
+                    return row_id, date.fromisoformat(timestamp[:10])
+                
+                def normalize(item):
+                    # Adapters written against the old interface may still return dicts
+                    if isinstance(item, dict):
+                        item = UsageRecord.from_dict(item)
+                    if not record_normalizer.normalize(item, interned_service_name, collected_at, normalization_stats):
+                        return None
+                    # Only valid records are looked up, so a rejected record is not remembered as ingested
+                    if dedup_index is not None and dedup_index.seen(*index_key(item.request_id, item.row_id, item.timestamp)):
+                        return None
+                    if raw_response_policy is not None:
+                        raw_response_policy.apply(item, raw_offloader)
+                        # Buckets are only inserted at the end, so bound the offload buffer here
+                        if aggregator is not None and raw_offloader is not None and len(raw_offloader.lines) >= chunk_size:
+                            flush_offloaded(len(raw_offloader.lines))
+                    return item
+                
+                table_ref = bq_client.dataset(dataset_id).table(cost_data_table_id)
+                raw_table_ref = bq_client.dataset(dataset_id).table(cost_data_raw_table_id)
+                
+                # Days that received rows in this run; their rollup rows are refreshed afterwards
+                touched_dates = set()
+                dead_lettered = {"rows": 0}
+                # Chunks that landed neither in BigQuery nor in the dead-letter store
+                unsaved_chunks = {"count": 0}
+                
+                def dead_letter(table_id, rows, errors=None, error=None):
+                    # Keep rows BigQuery did not accept so they can be replayed instead of re-collected;
+                    # returns whether the rows are safe in the dead-letter store
+                    if dead_letters is None:
+                        return False
+                    try:
+                        if error is not None:
+                            count = dead_letters.write_failed(table_id, rows, error, request_id)
+                        else:
+                            count = dead_letters.write_rejected(table_id, rows, errors, request_id)
+                    except Exception as e:
+                        logger.error(f"Failed to dead-letter rows for {service_name}: {str(e)}", extra={
                             "request_id": request_id,
                             "service_name": service_name,
-                            "records_count": len(service_data),
-                            "collection_duration_seconds": round(collection_duration, 2),
-                            "event_type": "data_collection_complete"
+                            "records_count": len(rows),
+                            "error": str(e),
+                            "event_type": "dead_letter_error"
                         })
-                        break  # Success, exit the retry loop
-                        
+                        return False
+                    dead_lettered["rows"] += count
+                    logger.warning(f"Dead-lettered {count} rows for {service_name}", extra={
+                        "request_id": request_id,
+                        "service_name": service_name,
+                        "table_id": table_id,
+                        "records_count": count,
+                        "event_type": "rows_dead_lettered"
+                    })
+                    return True
+                
+                def insert_raw(raw_rows):
+                    # Raw payloads go to the sibling table; a failure here only loses debugging data
+                    if not raw_rows:
+                        return
+                    try:
+                        errors = bq_client.insert_rows_json(raw_table_ref, raw_rows,
+                                                            row_ids=[row['row_id'] for row in raw_rows])
                     except Exception as e:
-                        retry_count += 1
-                        logger.warning(f"Data collection attempt {retry_count} failed: {str(e)}", extra={
+                        dead_letter(cost_data_raw_table_id, raw_rows, error=e)
+                        errors = [str(e)]
+                    else:
+                        if errors:
+                            dead_letter(cost_data_raw_table_id, raw_rows, errors=errors)
+                    if errors:
+                        logger.error(f"Error inserting raw payloads for {service_name}: {errors}", extra={
                             "request_id": request_id,
                             "service_name": service_name,
+                            "records_count": len(raw_rows),
+                            "errors": str(errors),
+                            "event_type": "bigquery_raw_insert_error"
+                        })
+                
+                def insert_rows(rows, raw_rows):
+                    # Insert cost rows and then their raw payloads; returns the insert errors and
+                    # whether every row has landed in BigQuery or the dead-letter store
+                    insert_start = time.time()
+                    try:
+                        # The row ID doubles as the streaming insert ID for best-effort deduplication
+                        errors = bq_client.insert_rows_json(table_ref, rows, row_ids=[row['row_id'] for row in rows])
+                    except Exception as e:
+                        logger.error(f"BigQuery insertion error for {service_name}: {str(e)}", extra={
+                            "request_id": request_id,
+                            "service_name": service_name,
+                            "records_count": len(rows),
                             "error": str(e),
                             "error_type": type(e).__name__,
-                            "retry_count": retry_count,
-                            "max_retries": max_retries
+                            "event_type": "bigquery_insert_exception"
                         })
-                        
-                        if retry_count >= max_retries:
-                            logger.error(f"All retry attempts failed for {service_name}", extra={
+                        saved = dead_letter(cost_data_table_id, rows, error=e)
+                        if raw_rows:
+                            saved = dead_letter(cost_data_raw_table_id, raw_rows, error=e) and saved
+                        return [str(e)], saved
+                    
+                    if errors:
+                        logger.error(f"Error inserting rows for {service_name}: {errors}", extra={
+                            "request_id": request_id,
+                            "service_name": service_name,
+                            "records_count": len(rows),
+                            "errors": str(errors),
+                            "event_type": "bigquery_insert_error"
+                        })
+                        saved = dead_letter(cost_data_table_id, rows, errors=errors)
+                        if raw_rows:
+                            saved = dead_letter(cost_data_raw_table_id, raw_rows,
+                                                error=RuntimeError("cost rows were rejected")) and saved
+                        return errors, saved
+                    
+                    touched_dates.update(rollup_dates(row['timestamp'] for row in rows))
+                    insert_raw(raw_rows)
+                    logger.info(f"Inserted chunk of {len(rows)} records for {service_name}", extra={
+                        "request_id": request_id,
+                        "service_name": service_name,
+                        "records_count": len(rows),
+                        "insert_duration_seconds": round(time.time() - insert_start, 2),
+                        "event_type": "bigquery_insert_complete"
+                    })
+                    return errors, True
+                
+                # Spool each chunk before inserting it, so fetched rows survive a failed or timed-out insert
+                spool = None
+                if data_store is not None and additional_config.get("spool", True):
+                    spool = WriteAheadSpool(data_store, interned_service_name)
+                
+                def spool_append(rows, raw_rows):
+                    try:
+                        return spool.append({cost_data_table_id: rows, cost_data_raw_table_id: raw_rows})
+                    except Exception as e:
+                        logger.error(f"Failed to spool rows for {service_name}: {str(e)}", extra={
+                            "request_id": request_id,
+                            "service_name": service_name,
+                            "records_count": len(rows),
+                            "error": str(e),
+                            "event_type": "spool_write_error"
+                        })
+                        return None
+                
+                def spool_commit(name):
+                    try:
+                        spool.commit(name)
+                    except Exception as e:
+                        # The segment is drained again next run; its row IDs keep that idempotent
+                        logger.warning(f"Failed to commit spool segment {name}: {str(e)}", extra={
+                            "request_id": request_id,
+                            "service_name": service_name,
+                            "error": str(e),
+                            "event_type": "spool_commit_error"
+                        })
+                
+                # Segments staged for the window replacement; deleted once it succeeded
+                staged_segments = []
+                
+                def drain_spool():
+                    # Insert the segments earlier runs fetched but did not land, before calling the provider
+                    if spool is None:
+                        return 0
+                    drained = 0
+                    for name in spool.pending():
+                        try:
+                            rows_by_table = spool.read(name)
+                        except Exception as e:
+                            logger.error(f"Failed to read spool segment {name}: {str(e)}", extra={
                                 "request_id": request_id,
                                 "service_name": service_name,
                                 "error": str(e),
-                                "retries_exhausted": True
+                                "event_type": "spool_read_error"
                             })
-                            raise  # Re-raise the last exception after all retries failed
-                        
-                        # Wait before retrying (exponential backoff)
-                        time.sleep(2 ** retry_count)  # 2, 4, 8 seconds
+                            continue
+                        rows = rows_by_table.get(cost_data_table_id, [])
+                        raw_rows = rows_by_table.get(cost_data_raw_table_id, [])
+                        if staging is not None:
+                            # Reconciled services never stream; the rows go through the replacement's load
+                            drained += staging.append(rows, raw_rows)
+                            staged_segments.append(name)
+                            continue
+                        if rows:
+                            _, saved = insert_rows(rows, raw_rows)
+                        else:
+                            saved = True
+                        if saved:
+                            spool_commit(name)
+                            drained += len(rows)
+                            if dedup_index is not None:
+                                dedup_index.add(index_key(row.get('request_id'), row['row_id'], row['timestamp'])
+                                                for row in rows)
+                    if drained:
+                        logger.info(f"Drained {drained} spooled records for {service_name}", extra={
+                            "request_id": request_id,
+                            "service_name": service_name,
+                            "records_count": drained,
+                            "event_type": "spool_drained"
+                        })
+                    return drained
                 
-                # Validate the service data
-                if not service_data:
-                    logger.warning(f"Service {service_name} returned no data", extra={
-                        "request_id": request_id,
-                        "service_name": service_name,
-                        "event_type": "empty_data"
-                    })
-                    # Continue with empty data rather than raising an error
-                    service_data = []
+                def insert_chunk(batch):
+                    # Insert one chunk into BigQuery; failures are logged and the run continues
+                    if raw_offloader is not None:
+                        # Write the offloaded payloads first so the row references resolve
+                        flush_offloaded(len(batch))
+                    rows = [record.to_row(COST_FIELDS) for record in batch]
+                    raw_rows = [row for row in (record.to_row(RAW_FIELDS) for record in batch)
+                                if 'raw_response' in row or 'metadata' in row]
+                    segment = spool_append(rows, raw_rows) if spool is not None else None
+                    errors, saved = insert_rows(rows, raw_rows)
+                    if not saved:
+                        unsaved_chunks["count"] += 1
+                    elif segment is not None:
+                        spool_commit(segment)
+                    return errors
                 
-                # Transform data to standard format
-                logger.info(f"Transforming data for {service_name}", extra={
-                    "request_id": request_id,
-                    "service_name": service_name,
-                    "items_to_transform": len(service_data)
-                })
+                def stage_chunk(batch):
+                    if raw_offloader is not None:
+                        flush_offloaded(len(batch))
+                    staging.write((record.to_row(COST_FIELDS) for record in batch),
+                                  (row for row in (record.to_row(RAW_FIELDS) for record in batch)
+                                   if 'raw_response' in row or 'metadata' in row))
+                    return []
                 
-                for item in service_data:
-                    # Add required fields with validation
-                    item["service_name"] = service_config["service_name"]
-                    item["timestamp"] = datetime.utcnow().isoformat()
-                    
-                    # Ensure all required fields have values
-                    for field in ["model", "input_tokens", "output_tokens", "cost"]:
-                        if field not in item or item[field] is None:
-                            logger.warning(f"Missing required field '{field}' in data item, using default", extra={
+                # Stream pages from the adapter through bounded queues into chunked inserts,
+                # fetching the next page while the current one is being inserted
+                pipeline = CollectionPipeline(
+                    normalize=normalize,
+                    insert=stage_chunk if reconciler is not None else insert_chunk,
+                    chunk_size=chunk_size,
+                    max_pending_pages=additional_config.get("max_pending_pages", DEFAULT_MAX_PENDING_PAGES),
+                    aggregator=reconciler if reconciler is not None else aggregator
+                )
+                
+                # Serve requests for finalized windows from the cached provider responses
+                response_cache = None
+                if data_store is not None and additional_config.get("response_cache", True):
+                    response_cache = ResponseCache.from_config(data_store, additional_config)
+                    adapter.response_cache = response_cache
+                
+                collection_start = time.time()
+                records_drained = 0
+                try:
+                    records_drained = drain_spool()
+                    pipeline_result = pipeline.run(adapter.iter_pages(
+                        endpoint=service_config["data_collection_endpoint"],
+                        additional_config=additional_config,
+                    ))
+                    if reconciler is not None:
+                        # Only a complete run may replace hours, so this is skipped when fetching failed
+                        replace_summary = replace_windows(
+                            bq_client,
+                            f"{project_id}.{dataset_id}.{cost_data_table_id}",
+                            f"{project_id}.{dataset_id}.{cost_data_raw_table_id}",
+                            interned_service_name,
+                            reconciler.compare(),
+                            staging
+                        )
+                        if replace_summary:
+                            replaced_hours = [datetime.fromisoformat(hour) for hour in replace_summary['hours_replaced']]
+                            touched_dates.update(hour.date() for hour in replaced_hours)
+                            touched_dates.update(hour.date() for hour in staging.appended_hours)
+                            log = logger.warning if replace_summary['hours_failed'] else logger.info
+                            log(f"Replaced {len(replaced_hours)} changed hours for {service_name}", extra={
+                                "request_id": request_id,
+                                **replace_summary,
+                                "event_type": "windows_replaced"
+                            })
+                            # Spooled rows of hours that failed are dropped from the staging, so keep
+                            # their segments until every hour was replaced
+                            if not replace_summary['hours_failed']:
+                                for name in staged_segments:
+                                    spool_commit(name)
+                            try:
+                                reconciler.commit(replaced_hours)
+                            except Exception as e:
+                                logger.error(f"Failed to write window digests for {service_name}: {str(e)}", extra={
+                                    "request_id": request_id,
+                                    "service_name": service_name,
+                                    "error": str(e),
+                                    "event_type": "window_digest_error"
+                                })
+                finally:
+                    if staging is not None:
+                        try:
+                            staging.discard()
+                        except Exception as e:
+                            logger.warning(f"Failed to delete the staging objects for {service_name}: {str(e)}", extra={
                                 "request_id": request_id,
                                 "service_name": service_name,
-                                "item_id": item.get("request_id", "unknown")
+                                "error": str(e),
+                                "event_type": "reconcile_staging_error"
                             })
-                            
-                            # Set default values for missing fields
-                            if field == "model":
-                                item[field] = "unknown"
-                            elif field in ["input_tokens", "output_tokens"]:
-                                item[field] = 0
-                            elif field == "cost":
-                                item[field] = 0.0
-
-                # Skip BigQuery insertion if there's no data
-                if not service_data:
-                    logger.info(f"No data to insert for {service_name}, skipping BigQuery insertion", extra={
-                        "request_id": request_id,
-                        "service_name": service_name,
-                        "event_type": "bigquery_insert_skipped"
-                    })
-                else:
-                    # Validate and clean up data before insertion
-                    validated_data = []
-                    for item in service_data:
-                        # Convert numerical fields to the correct type to avoid BigQuery errors
+                    # Refresh the rollup even if the run failed part-way, so inserted rows are counted
+                    try:
+                        rollup_summary = refresh_daily_rollup(
+                            bq_client,
+                            f"{project_id}.{dataset_id}.{cost_data_table_id}",
+                            f"{project_id}.{dataset_id}.{cost_rollup_table_id}",
+                            interned_service_name,
+                            touched_dates
+                        )
+                        if rollup_summary:
+                            logger.info(f"Refreshed daily rollup for {service_name}", extra={
+                                "request_id": request_id,
+                                **rollup_summary,
+                                "event_type": "rollup_refreshed"
+                            })
+                    except Exception as e:
+                        logger.error(f"Failed to refresh daily rollup for {service_name}: {str(e)}", extra={
+                            "request_id": request_id,
+                            "service_name": service_name,
+                            "dates": sorted(day.isoformat() for day in touched_dates),
+                            "error": str(e),
+                            "event_type": "rollup_refresh_error"
+                        })
+                    # Record the entries this run used or wrote, even if it failed, so the size cap sees them
+                    if response_cache is not None:
                         try:
-                            item["input_tokens"] = int(item["input_tokens"])
-                            item["output_tokens"] = int(item["output_tokens"])
-                            
-                            if "total_tokens" in item:
-                                item["total_tokens"] = int(item["total_tokens"])
-                            else:
-                                item["total_tokens"] = item["input_tokens"] + item["output_tokens"]
-                                
-                            item["cost"] = float(item["cost"])
-                            
-                            if "input_cost" in item:
-                                item["input_cost"] = float(item["input_cost"])
-                            if "output_cost" in item:
-                                item["output_cost"] = float(item["output_cost"])
-                                
-                            validated_data.append(item)
-                        except (ValueError, TypeError) as e:
-                            logger.warning(f"Data validation error for item: {str(e)}", extra={
+                            response_cache.flush()
+                        except Exception as e:
+                            logger.error(f"Failed to update the response cache manifest for {service_name}: {str(e)}", extra={
                                 "request_id": request_id,
                                 "service_name": service_name,
-                                "item_id": item.get("request_id", "unknown"),
-                                "error": str(e)
+                                "error": str(e),
+                                "event_type": "response_cache_error"
                             })
-                    
-                    # Insert data into BigQuery with better error handling
-                    logger.info(f"Inserting {len(validated_data)} records into BigQuery for {service_name}", extra={
-                        "request_id": request_id,
-                        "service_name": service_name,
-                        "records_count": len(validated_data),
-                        "table": f"{project_id}.{dataset_id}.{cost_data_table_id}",
-                        "event_type": "bigquery_insert_start"
-                    })
-                    
-                    if validated_data:
-                        insert_start = time.time()
+                collection_duration = time.time() - collection_start
+                
+                if dedup_index is not None:
+                    # Only record the run's request IDs if every record it saw is safe, so a lost
+                    # chunk is collected again by the next run instead of being dropped as seen
+                    if unsaved_chunks["count"]:
+                        dedup_index.discard()
+                    else:
                         try:
-                            table_ref = bq_client.dataset(dataset_id).table(cost_data_table_id)
-                            errors = bq_client.insert_rows_json(table_ref, validated_data)
-                            insert_duration = time.time() - insert_start
-    
-                            if errors:
-                                error_message = f"Error inserting rows for {service_name}: {errors}"
-                                logger.error(error_message, extra={
-                                    "request_id": request_id,
-                                    "service_name": service_name,
-                                    "errors": str(errors),
-                                    "event_type": "bigquery_insert_error"
-                                })
-                                # Don't raise exception, continue with other services
-                                # This allows one service to fail while others still work
-                            else:
-                                logger.info(f"Successfully inserted data for {service_name}", extra={
-                                    "request_id": request_id,
-                                    "service_name": service_name,
-                                    "records_count": len(validated_data),
-                                    "insert_duration_seconds": round(insert_duration, 2),
-                                    "event_type": "bigquery_insert_complete"
-                                })
+                            dedup_index.flush()
                         except Exception as e:
-                            logger.error(f"BigQuery insertion error for {service_name}: {str(e)}", extra={
+                            logger.error(f"Failed to update the dedup index for {service_name}: {str(e)}", extra={
                                 "request_id": request_id,
                                 "service_name": service_name,
                                 "error": str(e),
-                                "error_type": type(e).__name__,
-                                "event_type": "bigquery_insert_exception"
+                                "event_type": "dedup_index_error"
                             })
-                            # Don't raise exception, continue with other services
-                            # This allows one service to fail while others still work
+                
+                if normalization_stats.problems:
+                    logger.warning(f"Normalization problems for {service_name}", extra={
+                        "request_id": request_id,
+                        "service_name": service_name,
+                        **normalization_stats.summary(),
+                        "event_type": "normalization_problems"
+                    })
+                
+                if not pipeline_result.records_fetched:
+                    logger.warning(f"Service {service_name} returned no data", extra={
+                        "request_id": request_id,
+                        "service_name": service_name,
+                        "event_type": "empty_data"
+                    })
+                
+                logger.info(f"Data collection complete for {service_name}", extra={
+                    "request_id": request_id,
+                    "service_name": service_name,
+                    **pipeline_result.summary(),
+                    "records_dead_lettered": dead_lettered["rows"],
+                    "records_drained": records_drained,
+                    **(spool.summary() if spool is not None else {}),
+                    **(dedup_index.summary() if dedup_index is not None else {}),
+                    **(response_cache.summary() if response_cache is not None else {}),
+                    **(reconciler.summary() if reconciler is not None else {}),
+                    **(raw_response_policy.summary() if raw_response_policy is not None else {}),
+                    **(aggregator.summary() if aggregator is not None else {}),
+                    "collection_duration_seconds": round(collection_duration, 2),
+                    "event_type": "data_collection_complete"
+                })
 
                 service_duration = time.time() - service_start_time
                 results.append(
                     {
                         "service": service_name,
-                        "records_collected": len(service_data),
+                        "records_collected": pipeline_result.records_fetched,
+                        "records_inserted": pipeline_result.records_inserted,
+                        "records_dead_lettered": dead_lettered["rows"],
+                        "records_drained": records_drained,
+                        "records_already_ingested": dedup_index.stats['seen'] if dedup_index is not None else 0,
                         "status": "success",
                         "duration_seconds": round(service_duration, 2)
                     }
@@ -453,9 +772,29 @@ def collect_data(request):
                     }
                 )
 
+        # Refresh the rollup days recorded by real-time ingestion, which does not wait for a MERGE
+        marked_rollups = {}
+        if data_store is not None:
+            try:
+                marked_rollups = refresh_marked_rollups(
+                    bq_client,
+                    f"{project_id}.{dataset_id}.{cost_data_table_id}",
+                    f"{project_id}.{dataset_id}.{cost_rollup_table_id}",
+                    RollupMarkers(data_store)
+                )
+            except Exception as e:
+                marked_rollups = {"error": str(e)}
+            if marked_rollups:
+                logger.info(f"Refreshed the daily rollup for ingested events", extra={
+                    "request_id": request_id,
+                    "rollups": marked_rollups,
+                    "event_type": "marked_rollups_refreshed"
+                })
+        
         total_duration = time.time() - start_time
         response_data = {
             "results": results,
+            "marked_rollups": marked_rollups,
             "total_duration_seconds": round(total_duration, 2),
             "timestamp": datetime.utcnow().isoformat(),
             "request_id": request_id
@@ -469,7 +808,7 @@ def collect_data(request):
         })
         
         return (
-            json.dumps(response_data),
+            json_codec.dumps(response_data),
             200,
             {"Content-Type": "application/json"},
         )
@@ -485,7 +824,7 @@ def collect_data(request):
             "event_type": "job_error"
         })
         
-        return json.dumps({
+        return json_codec.dumps({
             "error": error_message,
             "request_id": request_id,
             "timestamp": datetime.utcnow().isoformat()
@@ -0,0 +1,183 @@
+"""Single-pass usage record normalizer compiled from the cost data schema.
+
+The normalizer reads ``cost_data_schema.json`` once per instance and compiles
+it into a flat list of per-column steps (default, coerce, required check).
+Each record is then normalized in one pass. Validation problems are counted
+and a few samples are kept, so log volume does not grow with data volume.
+"""
+
+import json
+import os
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from adapters.pricing import parse_timestamp
+from adapters.usage_record import FIELDS, UsageRecord, make_row_id
+
+# Locations searched for the schema: an explicit override, the copy deployed
+# next to this module, and the Terraform source of truth in the repository
+SCHEMA_PATHS = (
+    os.environ.get('COST_DATA_SCHEMA_PATH'),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schemas', 'cost_data_schema.json'),
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'terraform', 'modules',
+                 'bigquery', 'schemas', 'cost_data_schema.json'),
+)
+
+# Defaults applied when a column is missing; the remaining columns stay NULL
+DEFAULTS = {
+    'model': 'unknown',
+    'input_tokens': 0,
+    'output_tokens': 0,
+    'cost': 0.0,
+}
+
+# Number of example problems kept per normalization run
+MAX_SAMPLES = 5
+
+
+def _to_timestamp(value: Any) -> str:
+    parsed = parse_timestamp(value)
+    if parsed is None:
+        raise ValueError(f"Unparseable timestamp: {value!r}")
+    return parsed.astimezone(timezone.utc).isoformat()
+
+
+def _to_string(value: Any) -> str:
+    return value if type(value) is str else str(value)
+
+
+# BigQuery column type -> coercion applied to non-null values
+COERCERS: Dict[str, Callable[[Any], Any]] = {
+    'INTEGER': int,
+    'INT64': int,
+    'FLOAT': float,
+    'FLOAT64': float,
+    'NUMERIC': float,
+    'STRING': _to_string,
+    'TIMESTAMP': _to_timestamp,
+}
+
+
+class NormalizationStats:
+    """Counters and sample problems collected while normalizing a batch."""
+
+    def __init__(self, max_samples: int = MAX_SAMPLES):
+        self.rows_in = 0
+        self.rows_out = 0
+        self.problems: Counter = Counter()
+        self.samples: List[Dict[str, Any]] = []
+        self.max_samples = max_samples
+
+    def record_problem(self, kind: str, field: str, record: UsageRecord, error: Optional[str] = None) -> None:
+        self.problems[f"{kind}:{field}"] += 1
+        if len(self.samples) < self.max_samples:
+            sample = {"problem": kind, "field": field, "item_id": record.request_id or "unknown"}
+            if error:
+                sample["error"] = error
+            self.samples.append(sample)
+
+    @property
+    def rows_rejected(self) -> int:
+        return self.rows_in - self.rows_out
+
+    def summary(self) -> Dict[str, Any]:
+        """Summarize the run for a single structured log entry."""
+        return {
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "rows_rejected": self.rows_rejected,
+            "problems": dict(self.problems),
+            "samples": self.samples
+        }
+
+
+class RecordNormalizer:
+    """Normalizes usage records in place according to the cost data schema."""
+
+    def __init__(self, schema: List[Dict[str, Any]]):
+        """Compile the normalizer.
+
+        Args:
+            schema: The BigQuery schema as loaded from cost_data_schema.json.
+        """
+        steps: List[Tuple[str, Optional[Callable[[Any], Any]], Any, bool]] = []
+        for column in schema:
+            name = column['name']
+            if name not in FIELDS or name in ('service_name', 'timestamp', 'total_tokens', 'row_id'):
+                # Not produced by the adapters, or handled explicitly in normalize()
+                continue
+            steps.append((
+                name,
+                COERCERS.get(column.get('type', '').upper()),
+                DEFAULTS.get(name),
+                column.get('mode', 'NULLABLE').upper() == 'REQUIRED' or name in DEFAULTS
+            ))
+        self.steps = steps
+
+    @classmethod
+    def from_schema_file(cls, path: Optional[str] = None) -> 'RecordNormalizer':
+        """Compile a normalizer from the first schema file found."""
+        for candidate in ([path] if path else SCHEMA_PATHS):
+            if candidate and os.path.exists(candidate):
+                with open(candidate) as schema_file:
+                    return cls(json.load(schema_file))
+        raise FileNotFoundError("cost_data_schema.json not found; set COST_DATA_SCHEMA_PATH")
+
+    def normalize(self, record: UsageRecord, service_name: str, collected_at: datetime,
+                  stats: NormalizationStats) -> bool:
+        """Default, coerce and validate one record in a single pass.
+
+        Args:
+            record: The record to normalize in place.
+            service_name: Interned service name to stamp on the record.
+            collected_at: Fallback timestamp for records without a provider time.
+            stats: Counters that collect validation problems.
+
+        Returns:
+            True if the record is valid and should be inserted.
+        """
+        stats.rows_in += 1
+        record.service_name = service_name
+
+        # Keep the request time reported by the provider so the row lands in the
+        # right partition and matches the price version it was costed with
+        timestamp = parse_timestamp(record.timestamp)
+        if timestamp is None:
+            if record.timestamp is not None:
+                stats.record_problem("invalid", "timestamp", record, str(record.timestamp))
+            timestamp = parse_timestamp(collected_at)
+        # Aggregation, reconciliation and the dedup index read the UTC hour and day
+        # straight from the string, so offsets sent by the provider are converted here
+        record.timestamp = timestamp.astimezone(timezone.utc).isoformat()
+        if record.row_id is None:
+            record.row_id = make_row_id(service_name, record.model, record.request_id, record.timestamp,
+                                        record.feature)
+
+        for name, coerce, default, required in self.steps:
+            value = getattr(record, name)
+            if value is None:
+                if required:
+                    stats.record_problem("missing", name, record)
+                    if default is None:
+                        return False
+                    setattr(record, name, default)
+                continue
+            if coerce is not None:
+                try:
+                    setattr(record, name, coerce(value))
+                except (ValueError, TypeError) as e:
+                    stats.record_problem("invalid", name, record, str(e))
+                    return False
+
+        if record.total_tokens is None:
+            record.total_tokens = record.input_tokens + record.output_tokens
+        else:
+            try:
+                record.total_tokens = int(record.total_tokens)
+            except (ValueError, TypeError) as e:
+                stats.record_problem("invalid", "total_tokens", record, str(e))
+                return False
+
+        stats.rows_out += 1
+        return True
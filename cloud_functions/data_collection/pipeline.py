@@ -0,0 +1,179 @@
+"""Bounded-memory collection pipeline.
+
+Pages fetched by an adapter flow through a bounded queue into normalization
+and chunked inserts. A producer thread fetches page N+1 from the provider
+while the calling thread normalizes and inserts page N; when the queue is
+full the producer blocks, so peak memory depends on the page and chunk
+sizes rather than on the size of the collection window. With an optional
+aggregator, normalized records are collapsed into buckets and only the
+bucket rows are inserted.
+"""
+
+import logging
+import queue
+import threading
+from typing import Any, Callable, Iterable, List, Optional, Sequence
+
+from aggregation import HourlyAggregator
+from adapters.usage_record import UsageRecord
+
+logger = logging.getLogger('costwise-data-collection')
+
+# BigQuery recommends at most 500 rows per insertAll request
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_MAX_PENDING_PAGES = 2
+
+_END = object()
+
+
+class PipelineResult:
+    """Counters describing one pipeline run."""
+
+    def __init__(self):
+        self.pages = 0
+        self.records_fetched = 0
+        self.records_normalized = 0
+        self.records_inserted = 0
+        self.chunks = 0
+        self.failed_chunks = 0
+
+    def summary(self) -> dict:
+        return {
+            "pages": self.pages,
+            "records_fetched": self.records_fetched,
+            "records_normalized": self.records_normalized,
+            "records_inserted": self.records_inserted,
+            "chunks": self.chunks,
+            "failed_chunks": self.failed_chunks
+        }
+
+
+class _Failure:
+    """Wraps an exception raised by the producer thread."""
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class CollectionPipeline:
+    """Streams adapter pages through normalization into chunked inserts."""
+
+    def __init__(self, normalize: Callable[[Any], Optional[UsageRecord]],
+                 insert: Callable[[List[UsageRecord]], Sequence[Any]],
+                 chunk_size: int = DEFAULT_CHUNK_SIZE,
+                 max_pending_pages: int = DEFAULT_MAX_PENDING_PAGES,
+                 aggregator: Optional[HourlyAggregator] = None):
+        """Initialize the pipeline.
+
+        Args:
+            normalize: Returns the normalized record, or None to drop the item.
+            insert: Inserts one batch and returns the insert errors, if any.
+            chunk_size: Maximum number of rows per insert.
+            max_pending_pages: Fetched pages allowed to wait for the consumer.
+            aggregator: Optional aggregator (or window reconciler) whose
+                rows are inserted instead of the individual records.
+        """
+        self.normalize = normalize
+        self.insert = insert
+        self.chunk_size = max(1, int(chunk_size))
+        self.max_pending_pages = max(1, int(max_pending_pages))
+        self.aggregator = aggregator
+
+    def _produce(self, pages: Iterable[List[Any]], pending: queue.Queue, stop: threading.Event) -> None:
+        def put(item: Any) -> bool:
+            # Block while the consumer is behind, but give up once it has stopped
+            while not stop.is_set():
+                try:
+                    pending.put(item, timeout=0.5)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        try:
+            for page in pages:
+                if not put(page):
+                    return
+            put(_END)
+        except BaseException as e:  # Propagated to the consumer thread
+            put(_Failure(e))
+
+    def _flush(self, batch: List[UsageRecord], result: PipelineResult) -> None:
+        result.chunks += 1
+        errors = self.insert(batch)
+        if errors:
+            result.failed_chunks += 1
+        else:
+            result.records_inserted += len(batch)
+
+    def _drain_aggregator(self, batch: List[UsageRecord], result: PipelineResult,
+                          evict: bool = False) -> List[UsageRecord]:
+        # Move the bucket rows into chunked inserts and return the partial batch
+        for record in (self.aggregator.evict() if evict else self.aggregator.drain()):
+            batch.append(record)
+            if len(batch) >= self.chunk_size:
+                self._flush(batch, result)
+                batch = []
+        return batch
+
+    def run(self, pages: Iterable[List[Any]]) -> PipelineResult:
+        """Run the pipeline to completion.
+
+        Args:
+            pages: An iterable of record pages, typically ``adapter.iter_pages(...)``.
+
+        Returns:
+            The run counters.
+
+        Raises:
+            Exception: Any error raised while fetching pages, after already
+                fetched pages have been inserted.
+        """
+        result = PipelineResult()
+        pending: queue.Queue = queue.Queue(maxsize=self.max_pending_pages)
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(pages, pending, stop),
+                                    name='collection-producer', daemon=True)
+        producer.start()
+
+        batch = []
+        failure = None
+        try:
+            while True:
+                page = pending.get()
+                if page is _END:
+                    break
+                if isinstance(page, _Failure):
+                    failure = page.error
+                    break
+
+                result.pages += 1
+                result.records_fetched += len(page)
+                for item in page:
+                    record = self.normalize(item)
+                    if record is None:
+                        continue
+                    result.records_normalized += 1
+                    if self.aggregator is not None:
+                        self.aggregator.add(record)
+                        if self.aggregator.is_full():
+                            batch = self._drain_aggregator(batch, result, evict=True)
+                        continue
+                    batch.append(record)
+                    if len(batch) >= self.chunk_size:
+                        self._flush(batch, result)
+                        batch = []
+                # Drop the page before waiting for the next one
+                del page
+
+            if self.aggregator is not None:
+                batch = self._drain_aggregator(batch, result)
+            if len(batch):
+                self._flush(batch, result)
+        finally:
+            stop.set()
+            producer.join()
+
+        if failure is not None:
+            raise failure
+        return result
@@ -0,0 +1,187 @@
+"""Per-service size policy for the ``raw_response`` column.
+
+Adapters keep the whole provider item in ``raw_response``, which is usually
+the largest column of ``cost_data``. A service can limit it with a
+``raw_response_policy`` object in its ``additional_config``::
+
+    "raw_response_policy": {
+        "fields": ["id", "model", "usage"],
+        "max_bytes": 2048,
+        "sample_rate": 0.1,
+        "offload": true
+    }
+
+- ``fields``: keep only these top-level keys inline.
+- ``max_bytes``: inline payloads larger than this are replaced by a
+  truncated text prefix.
+- ``sample_rate``: fraction of rows that keep an inline payload. Sampling is
+  keyed on the provider request ID, so reruns keep the same rows.
+- ``offload``: write the full payload of every row to the data bucket as
+  gzipped JSON lines and store a reference (``uri`` and ``line``) inline.
+"""
+
+import gzip
+import random
+import uuid
+import zlib
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from adapters import json_codec
+from adapters.usage_record import UsageRecord
+from blob_store import BlobStore
+
+POLICY_CONFIG_KEY = 'raw_response_policy'
+
+# Blob name prefix for offloaded payloads
+OFFLOAD_PREFIX = 'raw_responses'
+
+
+class RawResponseOffloader:
+    """Buffers full raw payloads and writes them as one blob per insert chunk.
+
+    References handed out by ``add`` point into the blob that the next
+    ``flush`` writes, so ``flush`` must run before the rows are inserted.
+    """
+
+    def __init__(self, store: BlobStore, service_name: str, collected_at: datetime):
+        """Initialize the offloader.
+
+        Args:
+            store: The blob store of the data bucket.
+            service_name: The service whose payloads are offloaded.
+            collected_at: Start time of the collection run, used in blob names.
+        """
+        self.store = store
+        self.name_prefix = (f"{OFFLOAD_PREFIX}/{service_name}/{collected_at.strftime('%Y/%m/%d')}/"
+                            f"{collected_at.strftime('%H%M%S')}-{uuid.uuid4().hex[:12]}")
+        self.sequence = 0
+        self.lines: List[bytes] = []
+        self.blobs_written = 0
+        self.bytes_written = 0
+
+    def _blob_name(self) -> str:
+        return f"{self.name_prefix}-{self.sequence:05d}.jsonl.gz"
+
+    def add(self, request_id: Optional[str], payload: Any) -> Dict[str, Any]:
+        """Buffer one payload and return its reference."""
+        reference = {"uri": self.store.uri(self._blob_name()), "line": len(self.lines)}
+        self.lines.append(json_codec.dumps_bytes({"request_id": request_id, "raw_response": payload}))
+        return reference
+
+    def flush(self) -> Optional[str]:
+        """Write the buffered payloads and start a new blob.
+
+        Returns:
+            The URI of the written blob, or None if nothing was buffered.
+        """
+        if not self.lines:
+            return None
+        data = gzip.compress(b'\n'.join(self.lines) + b'\n')
+        name = self._blob_name()
+        self.lines = []
+        self.sequence += 1
+        uri = self.store.put(name, data, content_type='application/jsonl+gzip')
+        self.blobs_written += 1
+        self.bytes_written += len(data)
+        return uri
+
+
+class RawResponsePolicy:
+    """Applies the raw_response policy of one service to usage records."""
+
+    def __init__(self, fields: Optional[List[str]] = None, max_bytes: Optional[int] = None,
+                 sample_rate: float = 1.0, offload: bool = False):
+        self.fields = frozenset(fields) if fields else None
+        self.max_bytes = int(max_bytes) if max_bytes else None
+        self.sample_rate = min(1.0, max(0.0, float(sample_rate)))
+        self.offload = bool(offload)
+        self.stats: Counter = Counter()
+
+    @classmethod
+    def from_config(cls, additional_config: Dict[str, Any]) -> Optional['RawResponsePolicy']:
+        """Build the policy from a service's ``additional_config``.
+
+        Returns:
+            The policy, or None if the service does not configure one.
+        """
+        config = additional_config.get(POLICY_CONFIG_KEY)
+        if not config:
+            return None
+        if not isinstance(config, dict):
+            raise ValueError(f"{POLICY_CONFIG_KEY} must be an object, got {type(config).__name__}")
+        return cls(
+            fields=config.get('fields'),
+            max_bytes=config.get('max_bytes'),
+            sample_rate=config.get('sample_rate', 1.0),
+            offload=config.get('offload', False)
+        )
+
+    def is_sampled(self, request_id: Optional[str]) -> bool:
+        """Decide whether a row keeps its inline payload."""
+        if self.sample_rate >= 1.0:
+            return True
+        if self.sample_rate <= 0.0:
+            return False
+        if request_id:
+            return zlib.crc32(str(request_id).encode('utf-8')) < self.sample_rate * 0x100000000
+        return random.random() < self.sample_rate
+
+    def _inline(self, payload: Any) -> Any:
+        if self.fields is not None and isinstance(payload, dict):
+            payload = {key: value for key, value in payload.items() if key in self.fields}
+        if self.max_bytes is None:
+            return payload
+
+        encoded = json_codec.encode_json_value(payload)
+        size = len(encoded.encode('utf-8'))
+        if size <= self.max_bytes:
+            # Marked as encoded, so encode_json_value passes it through unchanged
+            return json_codec.EncodedJSON(encoded)
+        self.stats['truncated'] += 1
+        prefix = encoded.encode('utf-8')[:self.max_bytes].decode('utf-8', 'ignore')
+        return {"truncated": True, "original_bytes": size, "text": prefix}
+
+    def apply(self, record: UsageRecord, offloader: Optional[RawResponseOffloader] = None) -> None:
+        """Apply the policy to a normalized record in place.
+
+        Args:
+            record: The record whose ``raw_response`` is rewritten.
+            offloader: Receives the full payload when offloading is enabled.
+        """
+        payload = record.raw_response
+        if payload is None:
+            return
+        self.stats['rows'] += 1
+
+        reference = None
+        if self.offload and offloader is not None:
+            reference = offloader.add(record.request_id, payload)
+            self.stats['offloaded'] += 1
+
+        inline = None
+        if self.is_sampled(record.request_id):
+            inline = self._inline(payload)
+        else:
+            self.stats['sampled_out'] += 1
+
+        if reference is None:
+            record.raw_response = inline
+        elif inline is None:
+            record.raw_response = {"offload": reference}
+        elif isinstance(inline, json_codec.EncodedJSON):
+            # Splice the already encoded payload instead of decoding it again
+            record.raw_response = json_codec.EncodedJSON(
+                f'{{"offload":{json_codec.dumps(reference)},"payload":{inline}}}')
+        else:
+            record.raw_response = {"offload": reference, "payload": inline}
+
+    def summary(self) -> Dict[str, Any]:
+        """Summarize the policy counters for a structured log entry."""
+        return {
+            "raw_response_rows": self.stats['rows'],
+            "raw_response_sampled_out": self.stats['sampled_out'],
+            "raw_response_truncated": self.stats['truncated'],
+            "raw_response_offloaded": self.stats['offloaded']
+        }
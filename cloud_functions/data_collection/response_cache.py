@@ -0,0 +1,204 @@
+"""Cache of provider API responses for finalized collection windows.
+
+Provider usage data for a window stops changing once the window is older
+than the provider's finalization lag, yet backfills and re-collections fetch
+such windows again. Responses to requests whose window ended more than
+``finality_hours`` ago are kept gzip-compressed in the data bucket::
+
+    response_cache/<adapter>/<key>.json.gz
+
+The key hashes the adapter, a fingerprint of its API key, the URL and the
+query parameters, which include the window and the page cursor. Responses
+for windows that may still change are never cached.
+
+Entries are compressed and decompressed in blocks as they are streamed, so
+a large backfill response is never held in memory.
+
+A manifest (``response_cache/manifest.json``) records the size and last use
+of every entry. It is merged and written once per run, and the least
+recently used entries are deleted while the cache is larger than
+``max_bytes``. Runs of different services share the manifest, so it is
+written with a generation precondition and merged again when another run
+changed it in the meantime.
+
+The data bucket's retention lifecycle rule also deletes cached entries the
+manifest may still list. A missing entry is a cache miss: the response is
+fetched and cached again, and entries found missing are dropped from the
+manifest.
+"""
+
+import gzip
+import hashlib
+import time
+import urllib.parse
+from datetime import datetime, timezone
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, Optional, Set
+
+from adapters import json_codec
+from adapters.json_stream import STREAM_CHUNK_BYTES
+from blob_store import BlobStore
+
+CACHE_PREFIX = 'response_cache'
+CACHE_SUFFIX = '.json.gz'
+MANIFEST_NAME = f'{CACHE_PREFIX}/manifest.json'
+
+# Providers finalize usage data within this many hours
+DEFAULT_FINALITY_HOURS = 48
+
+# Total compressed size of the cache
+DEFAULT_MAX_BYTES = 5 * 1024 ** 3
+
+# Attempts to write the manifest while concurrent runs keep changing it
+MANIFEST_WRITE_ATTEMPTS = 10
+
+
+class CacheWriter:
+    """Compresses a response body into the cache as it is read."""
+
+    def __init__(self, cache: 'ResponseCache', name: str):
+        self.cache = cache
+        self.name = name
+        self._upload = cache.store.open_write(name, content_type='application/gzip')
+        self._gzip = gzip.GzipFile(fileobj=self._upload, mode='wb', compresslevel=6)
+
+    def write(self, chunk: bytes) -> None:
+        self._gzip.write(chunk)
+
+    def commit(self) -> None:
+        """Store the response; call only after the whole body was read."""
+        self._gzip.close()
+        self._upload.commit()
+        self.cache._stored(self.name, self._upload.size)
+
+    def abort(self) -> None:
+        """Discard a response that was not read to the end."""
+        self._gzip.close()
+        self._upload.abort()
+
+
+def _iter_decompressed(reader: BinaryIO) -> Iterator[bytes]:
+    try:
+        with gzip.GzipFile(fileobj=reader, mode='rb') as body:
+            while True:
+                block = body.read(STREAM_CHUNK_BYTES)
+                if not block:
+                    break
+                yield block
+    finally:
+        reader.close()
+
+
+class ResponseCache:
+    """Provider responses for finalized windows, shared by all services."""
+
+    def __init__(self, store: BlobStore, finality_hours: float = DEFAULT_FINALITY_HOURS,
+                 max_bytes: int = DEFAULT_MAX_BYTES, clock: Callable[[], float] = time.time):
+        """Initialize the cache.
+
+        Args:
+            store: Blob store of the data bucket.
+            finality_hours: Age after which a window's data no longer changes.
+            max_bytes: Total compressed size above which entries are evicted.
+            clock: Wall clock, in seconds.
+        """
+        self.store = store
+        self.finality_hours = finality_hours
+        self.max_bytes = max_bytes
+        self.clock = clock
+        # name -> [size, last_used] of the entries used or written by this run
+        self._touched: Dict[str, list] = {}
+        # Entries this run found missing, e.g. deleted by the bucket's lifecycle rule
+        self._missing: Set[str] = set()
+        self.stats = {'hits': 0, 'misses': 0, 'bytes_written': 0, 'evicted': 0}
+
+    @classmethod
+    def from_config(cls, store: BlobStore, additional_config: Dict[str, Any]) -> 'ResponseCache':
+        """Create a cache with the service's ``finality_hours``."""
+        return cls(store, float(additional_config.get('finality_hours', DEFAULT_FINALITY_HOURS)))
+
+    def is_final(self, window_end: datetime) -> bool:
+        """Whether the data of a window that ended at ``window_end`` can no longer change."""
+        if window_end.tzinfo is None:
+            window_end = window_end.replace(tzinfo=timezone.utc)
+        return window_end.timestamp() <= self.clock() - self.finality_hours * 3600
+
+    def name(self, adapter: str, api_key: str, url: str, params: Dict[str, Any]) -> str:
+        """Get the blob name of the cached response to a request."""
+        key_material = json_codec.dumps_bytes({
+            "api_key": hashlib.blake2b(api_key.encode('utf-8'), digest_size=16).hexdigest(),
+            "url": url,
+            "params": sorted((str(key), str(value)) for key, value in params.items())
+        })
+        digest = hashlib.sha256(key_material).hexdigest()
+        return f"{CACHE_PREFIX}/{urllib.parse.quote(adapter, safe='')}/{digest}{CACHE_SUFFIX}"
+
+    def get(self, name: str) -> Optional[Iterator[bytes]]:
+        """Open a cached response body, or return None on a miss.
+
+        Returns:
+            The decompressed body as an iterator of blocks.
+        """
+        opened = self.store.open_read(name)
+        if opened is None:
+            self.stats['misses'] += 1
+            self._missing.add(name)
+            return None
+        reader, size = opened
+        self.stats['hits'] += 1
+        self._touched[name] = [size, self.clock()]
+        return _iter_decompressed(reader)
+
+    def writer(self, name: str) -> CacheWriter:
+        """Start caching a response body."""
+        return CacheWriter(self, name)
+
+    def _stored(self, name: str, size: int) -> None:
+        self.stats['bytes_written'] += size
+        self._touched[name] = [size, self.clock()]
+
+    def flush(self) -> None:
+        """Record this run's use of entries and evict the least recently used ones over the size cap.
+
+        Raises:
+            RuntimeError: If concurrent runs kept changing the manifest.
+        """
+        if not self._touched and not self._missing:
+            return
+        for _ in range(MANIFEST_WRITE_ATTEMPTS):
+            data, generation = self.store.get_with_generation(MANIFEST_NAME)
+            entries = json_codec.loads(data) if data else {}
+            evicted = self._merge(entries)
+            if self.store.put_if_generation(MANIFEST_NAME, json_codec.dumps_bytes(entries), generation,
+                                            content_type='application/json'):
+                break
+        else:
+            raise RuntimeError(f"{MANIFEST_NAME} changed on each of {MANIFEST_WRITE_ATTEMPTS} attempts")
+        # Delete evicted entries only once the manifest that drops them was written
+        for name in evicted:
+            self.store.delete(name)
+        self.stats['evicted'] += len(evicted)
+        self._touched = {}
+        self._missing = set()
+
+    def _merge(self, entries: Dict[str, list]) -> List[str]:
+        """Merge this run's entries into a manifest and get the entries to evict."""
+        for name in self._missing:
+            if name not in self._touched:
+                entries.pop(name, None)
+        for name, (size, last_used) in self._touched.items():
+            previous = entries.get(name)
+            entries[name] = [size, max(last_used, previous[1]) if previous else last_used]
+        evicted = []
+        total = sum(size for size, _ in entries.values())
+        if total > self.max_bytes:
+            for name, (size, _) in sorted(entries.items(), key=lambda entry: entry[1][1]):
+                if total <= self.max_bytes:
+                    break
+                del entries[name]
+                evicted.append(name)
+                total -= size
+        return evicted
+
+    def summary(self) -> Dict[str, Any]:
+        """Get cache counters for logging."""
+        return {f"response_cache_{key}": value for key, value in self.stats.items()}
@@ -0,0 +1,108 @@
+"""Write-ahead spool for collected rows.
+
+Provider usage APIs are rate limited, so rows fetched from them should not
+be lost because the BigQuery side of a run failed or the function timed
+out while inserting. Before a chunk is inserted, its cost and raw payload
+rows are appended to the spool as one segment in the data bucket::
+
+    spool/<service>/<run_id>/<sequence>.ndjson.gz
+
+The segment is committed (deleted) once its rows have landed in BigQuery or
+in the dead-letter store. Segments left behind by earlier runs are drained
+at the start of the next run for the service, before it calls the provider.
+"""
+
+import gzip
+import time
+import urllib.parse
+import uuid
+from typing import Any, Callable, Dict, List
+
+from adapters import json_codec
+from blob_store import BlobStore
+
+SPOOL_PREFIX = 'spool'
+SEGMENT_SUFFIX = '.ndjson.gz'
+
+# Runs younger than this may still be inserting their segments; it must be
+# longer than the collection function's timeout
+DEFAULT_MIN_AGE_SECONDS = 300
+
+# Segments drained per run, so a large backlog cannot use up the run's timeout
+DEFAULT_DRAIN_MAX_SEGMENTS = 50
+
+Row = Dict[str, Any]
+
+
+class WriteAheadSpool:
+    """Spool segments of one service, written by one run."""
+
+    def __init__(self, store: BlobStore, service_name: str, clock: Callable[[], float] = time.time):
+        """Initialize the spool.
+
+        Args:
+            store: Blob store of the data bucket.
+            service_name: Service whose rows are spooled.
+            clock: Wall clock, in seconds; the run ID starts with its value.
+        """
+        self.store = store
+        self.clock = clock
+        self.prefix = f"{SPOOL_PREFIX}/{urllib.parse.quote(service_name, safe='')}/"
+        self.run_id = f"{int(clock()):010d}-{uuid.uuid4().hex[:8]}"
+        self._sequence = 0
+        self.stats = {'segments_written': 0, 'segments_committed': 0, 'rows_spooled': 0}
+
+    def append(self, rows_by_table: Dict[str, List[Row]]) -> str:
+        """Write rows as a new segment and return its name."""
+        self._sequence += 1
+        name = f"{self.prefix}{self.run_id}/{self._sequence:06d}{SEGMENT_SUFFIX}"
+        lines = []
+        for table_id, rows in rows_by_table.items():
+            for row in rows:
+                lines.append(json_codec.dumps_bytes({"table": table_id, "row": row}))
+        # Fastest compression level: the segment is usually deleted seconds later
+        self.store.put(name, gzip.compress(b'\n'.join(lines) + b'\n', compresslevel=1),
+                       content_type='application/gzip')
+        self.stats['segments_written'] += 1
+        self.stats['rows_spooled'] += len(lines)
+        return name
+
+    def commit(self, name: str) -> None:
+        """Mark a segment as landed."""
+        self.store.delete(name)
+        self.stats['segments_committed'] += 1
+
+    def pending(self, min_age_seconds: float = DEFAULT_MIN_AGE_SECONDS,
+                limit: int = DEFAULT_DRAIN_MAX_SEGMENTS) -> List[str]:
+        """List uncommitted segments of earlier runs, oldest first."""
+        cutoff = self.clock() - min_age_seconds
+        names = []
+        for name in self.store.list(self.prefix):
+            run_id = name[len(self.prefix):].split('/', 1)[0]
+            if run_id == self.run_id or not name.endswith(SEGMENT_SUFFIX):
+                continue
+            try:
+                started = int(run_id.split('-', 1)[0])
+            except ValueError:
+                continue
+            if started <= cutoff:
+                names.append(name)
+                if len(names) >= limit:
+                    break
+        return names
+
+    def read(self, name: str) -> Dict[str, List[Row]]:
+        """Read the rows of a segment by table."""
+        data = self.store.get(name)
+        rows_by_table: Dict[str, List[Row]] = {}
+        if data is None:
+            return rows_by_table
+        for line in gzip.decompress(data).split(b'\n'):
+            if line.strip():
+                entry = json_codec.loads(line)
+                rows_by_table.setdefault(entry["table"], []).append(entry["row"])
+        return rows_by_table
+
+    def summary(self) -> Dict[str, Any]:
+        """Get spool counters for logging."""
+        return {f"spool_{key}": value for key, value in self.stats.items()}
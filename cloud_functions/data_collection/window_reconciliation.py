@@ -0,0 +1,486 @@
+"""Hour-window reconciliation of re-collected usage data.
+
+Services that set ``reconcile_windows`` in their ``additional_config`` are
+collected by replacing whole hours instead of appending rows. The collector
+computes a digest of the normalized records of every (service, hour) it
+fetches and keeps the digests in the data bucket, one file per service and
+day::
+
+    window_digests/<service>/<yyyy>/<mm>/<dd>.json
+
+Only the running digest of each hour is kept in memory. The rows of every
+hour in the window are streamed as gzipped NDJSON to staging objects in the
+data bucket while the run fetches, since which hours changed is only known
+at the end::
+
+    reconcile_staging/<service>/<run>/cost.ndjson.gz
+    reconcile_staging/<service>/<run>/raw.ndjson.gz
+
+Changed hours, including hours that had rows before and have none now, are
+then replaced in a BigQuery transaction: the staging objects are loaded
+into staging tables with load jobs, and a multi-statement query deletes the
+service's rows of those hours and inserts the staged rows of those hours,
+in both the cost table and the raw payload table. Nothing is streamed;
+spooled rows an earlier run did not land are loaded through the same
+staging objects. BigQuery rejects DML on rows still in the streaming
+buffer, so when the transaction fails for that reason each hour is retried
+in its own transaction, and the hours that still fail keep their old
+digests and are replaced by a later run.
+
+The digest is the sum, modulo 2**128, of a hash of each record's columns
+other than ``row_id``, so it does not depend on the order the provider
+returns records in and counts repeated records.
+"""
+
+import gzip
+import hashlib
+import urllib.parse
+import uuid
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import google.cloud.bigquery as bigquery
+from google.api_core.exceptions import GoogleAPICallError
+
+from adapters import json_codec
+from adapters.usage_record import COST_FIELDS, JSON_FIELDS, UsageRecord
+from aggregation import HourlyAggregator
+from blob_store import BlobStore, BlobUpload
+
+DIGEST_PREFIX = 'window_digests'
+DIGEST_SUFFIX = '.json'
+STAGING_PREFIX = 'reconcile_staging'
+
+# Staging tables are dropped after the transaction; the expiry covers runs that die first
+STAGING_EXPIRATION_HOURS = 24
+
+_DIGEST_FIELDS = tuple(name for name in COST_FIELDS if name != 'row_id')
+_DIGEST_MODULUS = 1 << 128
+
+
+def record_digest(record: UsageRecord) -> int:
+    """Get the 128-bit hash of a normalized record's columns, other than ``row_id``."""
+    values = repr(tuple(getattr(record, name) for name in _DIGEST_FIELDS))
+    return int.from_bytes(hashlib.blake2b(values.encode('utf-8'), digest_size=16).digest(), 'big')
+
+
+def reconcile_window(start_time: datetime, end_time: datetime) -> Tuple[datetime, datetime]:
+    """Widen a collection window to whole hours, so every hour in it is complete."""
+    start = start_time.replace(minute=0, second=0, microsecond=0)
+    end = end_time.replace(minute=0, second=0, microsecond=0)
+    if end < end_time:
+        end += timedelta(hours=1)
+    return start, end
+
+
+class WindowDigests:
+    """Stored hour digests of one service."""
+
+    def __init__(self, store: BlobStore, service_name: str):
+        """Initialize the digests.
+
+        Args:
+            store: Blob store of the data bucket.
+            service_name: Service whose hours are reconciled.
+        """
+        self.store = store
+        self.prefix = f"{DIGEST_PREFIX}/{urllib.parse.quote(service_name, safe='')}/"
+        self._days: Dict[date, Dict[str, Any]] = {}
+        self._updated: Dict[date, Dict[str, Any]] = {}
+
+    def _name(self, day: date) -> str:
+        return f"{self.prefix}{day:%Y/%m/%d}{DIGEST_SUFFIX}"
+
+    def _load(self, day: date) -> Dict[str, Any]:
+        entries = self._days.get(day)
+        if entries is None:
+            data = self.store.get(self._name(day))
+            entries = json_codec.loads(data) if data else {}
+            self._days[day] = entries
+        return entries
+
+    def get(self, hour: datetime) -> Optional[str]:
+        """Get the stored digest of an hour, or None if it was never reconciled."""
+        entry = self._load(hour.date()).get(f"{hour:%H}")
+        return entry["digest"] if entry else None
+
+    def set(self, hour: datetime, digest: str, rows: int) -> None:
+        """Remember the digest of a replaced hour, until ``flush``."""
+        self._updated.setdefault(hour.date(), {})[f"{hour:%H}"] = {"digest": digest, "rows": rows}
+
+    def flush(self) -> None:
+        """Write the digests of the replaced hours."""
+        for day, updates in sorted(self._updated.items()):
+            # Re-read the file so hours written by another run since it was loaded are kept
+            name = self._name(day)
+            data = self.store.get(name)
+            entries = json_codec.loads(data) if data else {}
+            entries.update(updates)
+            self.store.put(name, json_codec.dumps_bytes(entries), content_type='application/json')
+            self._days[day] = entries
+        self._updated = {}
+
+
+class WindowReconciler:
+    """Tracks the digest of each hour of a run and passes its records on.
+
+    Used in place of the pipeline's aggregator: ``add`` folds a record into
+    its hour's digest and passes it on (through the service's aggregator,
+    if it aggregates) to be staged, so no records are held. Once the run
+    has fetched everything, ``compare`` finds the hours whose digest
+    changed, and ``commit`` stores the digests of the hours that were
+    replaced.
+    """
+
+    def __init__(self, digests: WindowDigests, start_time: datetime, end_time: datetime,
+                 aggregator: Optional[HourlyAggregator] = None):
+        """Initialize the reconciler.
+
+        Args:
+            digests: Stored digests of the service.
+            start_time: Start of the collection window, on an hour boundary (naive UTC).
+            end_time: End of the collection window, on an hour boundary (naive UTC).
+            aggregator: Optional aggregator the records go through before they are staged.
+        """
+        self.digests = digests
+        self.start_time = start_time.replace(tzinfo=timezone.utc)
+        self.end_time = end_time.replace(tzinfo=timezone.utc)
+        self.aggregator = aggregator
+        # Running digest and record count of each hour
+        self._hours: Dict[datetime, List[int]] = {}
+        self._pending: List[UsageRecord] = []
+        self.changed: Dict[datetime, Tuple[str, int]] = {}
+        self.stats = {'hours_unchanged': 0, 'hours_changed': 0, 'hours_emptied': 0,
+                      'records_unchanged': 0, 'records_outside_window': 0}
+
+    def is_full(self) -> bool:
+        """Whether records are waiting to be passed on."""
+        return bool(self._pending) or (self.aggregator is not None and self.aggregator.is_full())
+
+    def add(self, record: UsageRecord) -> None:
+        """Fold a normalized record into its hour's digest and pass it on."""
+        hour = datetime.strptime(record.timestamp[:13], '%Y-%m-%dT%H').replace(tzinfo=timezone.utc)
+        if not self.start_time <= hour < self.end_time:
+            # Hours outside the window may be incomplete; the runs that cover them reconcile them
+            self.stats['records_outside_window'] += 1
+            return
+        entry = self._hours.get(hour)
+        if entry is None:
+            entry = self._hours[hour] = [0, 0]
+        entry[0] = (entry[0] + record_digest(record)) % _DIGEST_MODULUS
+        entry[1] += 1
+        if self.aggregator is None:
+            self._pending.append(record)
+        else:
+            self.aggregator.add(record)
+
+    def evict(self) -> Iterator[UsageRecord]:
+        """Yield the records waiting to be passed on, and the buckets the aggregator evicts."""
+        pending, self._pending = self._pending, []
+        yield from pending
+        if self.aggregator is not None and self.aggregator.is_full():
+            yield from self.aggregator.evict()
+
+    def drain(self) -> Iterator[UsageRecord]:
+        """Yield every record still waiting to be passed on."""
+        pending, self._pending = self._pending, []
+        yield from pending
+        if self.aggregator is not None:
+            yield from self.aggregator.drain()
+
+    def hours(self) -> Iterator[datetime]:
+        """Iterate over the hours of the window."""
+        hour = self.start_time
+        while hour < self.end_time:
+            yield hour
+            hour += timedelta(hours=1)
+
+    def compare(self) -> Set[datetime]:
+        """Compare the run's hour digests with the stored ones and get the hours that changed.
+
+        An hour that was reconciled before but has no records now changed to
+        empty, so its rows are deleted.
+        """
+        self.changed = {}
+        for hour in self.hours():
+            digest, count = self._hours.get(hour, (0, 0))
+            digest_hex = f"{digest:032x}"
+            stored = self.digests.get(hour)
+            if stored == digest_hex or (stored is None and not count):
+                self.stats['hours_unchanged'] += 1
+                self.stats['records_unchanged'] += count
+                continue
+            self.stats['hours_changed'] += 1
+            if not count:
+                self.stats['hours_emptied'] += 1
+            self.changed[hour] = (digest_hex, count)
+        return set(self.changed)
+
+    def commit(self, hours: Iterable[datetime]) -> None:
+        """Store the digests of the changed hours that were replaced."""
+        for hour in hours:
+            digest_hex, count = self.changed[hour]
+            self.digests.set(hour, digest_hex, count)
+        self.digests.flush()
+
+    def summary(self) -> Dict[str, Any]:
+        """Get reconciliation counters for logging."""
+        return {f"reconcile_{key}": value for key, value in self.stats.items()}
+
+
+class _StagedTable:
+    """Rows of one table, streamed to a gzipped NDJSON staging object."""
+
+    def __init__(self, store: BlobStore, name: str):
+        self.store = store
+        self.name = name
+        self.rows = 0
+        self._upload: Optional[BlobUpload] = None
+        self._file: Optional[gzip.GzipFile] = None
+        self.committed = False
+
+    def write(self, rows: Iterable[Dict[str, Any]]) -> None:
+        for row in rows:
+            if self._file is None:
+                self._upload = self.store.open_write(self.name, content_type='application/gzip')
+                self._file = gzip.GzipFile(fileobj=self._upload, mode='wb')
+            # Streaming inserts take JSON columns as encoded strings, load jobs as values
+            row = {name: json_codec.loads(value) if name in JSON_FIELDS and isinstance(value, str) else value
+                   for name, value in row.items()}
+            self._file.write(json_codec.dumps_bytes(row))
+            self._file.write(b'\n')
+            self.rows += 1
+
+    def commit(self) -> bool:
+        """Publish the object; returns whether there are rows to load."""
+        if self._file is None:
+            return False
+        self._file.close()
+        self._upload.commit()
+        self._file = None
+        self.committed = True
+        return True
+
+    def discard(self) -> None:
+        if self._file is not None:
+            try:
+                self._file.close()
+            finally:
+                self._upload.abort()
+                self._file = None
+        if self.committed:
+            self.store.delete(self.name)
+            self.committed = False
+
+
+class WindowStaging:
+    """Staging objects of one run's cost and raw payload rows."""
+
+    def __init__(self, store: BlobStore, service_name: str, start_time: datetime, end_time: datetime):
+        """Initialize the staging objects.
+
+        Args:
+            store: Blob store of the data bucket.
+            service_name: Service whose hours are reconciled.
+            start_time: Start of the reconciled window, on an hour boundary (naive UTC).
+            end_time: End of the reconciled window, on an hour boundary (naive UTC).
+        """
+        prefix = f"{STAGING_PREFIX}/{urllib.parse.quote(service_name, safe='')}/{uuid.uuid4().hex}/"
+        self.cost = _StagedTable(store, f"{prefix}cost.ndjson.gz")
+        self.raw = _StagedTable(store, f"{prefix}raw.ndjson.gz")
+        self.start_time = start_time.replace(tzinfo=timezone.utc)
+        self.end_time = end_time.replace(tzinfo=timezone.utc)
+        # Hours of the spooled rows outside the window, which are appended instead of replaced
+        self.appended_hours: Set[datetime] = set()
+        self.rows_appended = 0
+
+    def write(self, rows: Iterable[Dict[str, Any]], raw_rows: Iterable[Dict[str, Any]]) -> None:
+        """Stage the cost and raw payload rows of the run's window."""
+        self.cost.write(rows)
+        self.raw.write(raw_rows)
+
+    def append(self, rows: List[Dict[str, Any]], raw_rows: List[Dict[str, Any]]) -> int:
+        """Stage spooled rows from an earlier run; returns how many cost rows are appended.
+
+        Rows of hours in the window are dropped, since the run collects those
+        hours again. The others are inserted unless their ``row_id`` is
+        already in the table.
+        """
+        def outside(row: Dict[str, Any]) -> bool:
+            hour = datetime.strptime(row['timestamp'][:13], '%Y-%m-%dT%H').replace(tzinfo=timezone.utc)
+            if self.start_time <= hour < self.end_time:
+                return False
+            self.appended_hours.add(hour)
+            return True
+
+        rows = [row for row in rows if outside(row)]
+        self.cost.write(rows)
+        self.raw.write(row for row in raw_rows if outside(row))
+        self.rows_appended += len(rows)
+        return len(rows)
+
+    def commit(self) -> None:
+        """Publish the staging objects, so they can be loaded."""
+        self.cost.commit()
+        self.raw.commit()
+
+    def discard(self) -> None:
+        """Delete the staging objects."""
+        try:
+            self.cost.discard()
+        finally:
+            self.raw.discard()
+
+
+def is_streaming_buffer_error(error: BaseException) -> bool:
+    """Whether a DML error was caused by rows still in the streaming buffer."""
+    return 'streaming buffer' in str(error).lower()
+
+
+def _load_staging(bq_client: bigquery.Client, table: str, staged: _StagedTable) -> Tuple[str, List[str]]:
+    """Load a staging object into a new staging table with the schema of ``table``; returns its ID and columns."""
+    schema = bq_client.get_table(table).schema
+    staging = f"{table}_reconcile_{uuid.uuid4().hex[:12]}"
+    staging_table = bigquery.Table(staging, schema=schema)
+    staging_table.expires = datetime.now(timezone.utc) + timedelta(hours=STAGING_EXPIRATION_HOURS)
+    bq_client.create_table(staging_table)
+    if staged.committed:
+        job_config = bigquery.LoadJobConfig(
+            schema=schema,
+            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND
+        )
+        uri = staged.store.uri(staged.name)
+        if uri.startswith('gs://'):
+            load_job = bq_client.load_table_from_uri(uri, staging, job_config=job_config)
+        else:
+            # Local development stores are uploaded through the client
+            opened = staged.store.open_read(staged.name)
+            if opened is None:
+                raise FileNotFoundError(f"Staging object {staged.name} is missing")
+            reader, size = opened
+            with reader:
+                load_job = bq_client.load_table_from_file(reader, staging, size=size, job_config=job_config)
+        load_job.result()
+    return staging, [field.name for field in schema]
+
+
+def replace_windows(bq_client: bigquery.Client, cost_table: str, raw_table: str, service_name: str,
+                    hours: Set[datetime], staging: WindowStaging) -> Optional[Dict[str, Any]]:
+    """Replace a service's rows of some hours in the cost and raw payload tables.
+
+    The hours are replaced in one transaction. If it fails because some
+    rows are still in the streaming buffer, each hour is replaced in its own
+    transaction, and the hours that fail again are reported. Spooled rows
+    outside the window are appended in a separate transaction.
+
+    Args:
+        bq_client: BigQuery client.
+        cost_table: Fully qualified cost data table ID.
+        raw_table: Fully qualified raw payload table ID.
+        service_name: Service whose hours are replaced.
+        hours: Start of each hour to replace (aware UTC).
+        staging: The run's staged rows; published by this call.
+
+    Returns:
+        A summary of the replacement, with the hours replaced and the
+        hours that failed as ISO timestamps, or None if there was nothing
+        to replace or append.
+
+    Raises:
+        GoogleAPICallError: A job failed for another reason than the streaming buffer.
+    """
+    if not hours and not staging.rows_appended:
+        return None
+    staging.commit()
+    staging_tables = []
+    bytes_processed = 0
+    replaced: List[datetime] = []
+    failed: List[datetime] = []
+    try:
+        tables = []
+        for table, staged in ((cost_table, staging.cost), (raw_table, staging.raw)):
+            staging_table, columns = _load_staging(bq_client, table, staged)
+            staging_tables.append(staging_table)
+            tables.append((table, staging_table, ', '.join(f"`{name}`" for name in columns)))
+
+        def run(statements: List[str], params: List[Any]) -> None:
+            nonlocal bytes_processed
+            job_config = bigquery.QueryJobConfig(query_parameters=[
+                bigquery.ScalarQueryParameter("service_name", "STRING", service_name), *params])
+            query_job = bq_client.query('\n'.join(statements), job_config=job_config)
+            query_job.result()
+            bytes_processed += query_job.total_bytes_processed or 0
+
+        def replace(batch: List[datetime]) -> None:
+            statements = ["BEGIN TRANSACTION;"]
+            for table, staging_table, column_list in tables:
+                statements.append(f"""DELETE FROM `{table}`
+WHERE timestamp >= @range_start AND timestamp < @range_end
+  AND service_name = @service_name
+  AND TIMESTAMP_TRUNC(timestamp, HOUR) IN UNNEST(@hours);""")
+                statements.append(f"""INSERT INTO `{table}` ({column_list})
+SELECT {column_list} FROM `{staging_table}`
+WHERE TIMESTAMP_TRUNC(timestamp, HOUR) IN UNNEST(@hours);""")
+            statements.append("COMMIT TRANSACTION;")
+            run(statements, [
+                bigquery.ArrayQueryParameter("hours", "TIMESTAMP", batch),
+                bigquery.ScalarQueryParameter("range_start", "TIMESTAMP", batch[0]),
+                bigquery.ScalarQueryParameter("range_end", "TIMESTAMP", batch[-1] + timedelta(hours=1)),
+            ])
+
+        ordered = sorted(hours)
+        if ordered:
+            try:
+                replace(ordered)
+                replaced = ordered
+            except GoogleAPICallError as e:
+                if not is_streaming_buffer_error(e):
+                    raise
+                if len(ordered) == 1:
+                    failed = ordered
+                else:
+                    # Hours whose rows have left the buffer can be replaced on their own
+                    for hour in ordered:
+                        try:
+                            replace([hour])
+                        except GoogleAPICallError as hour_error:
+                            if not is_streaming_buffer_error(hour_error):
+                                raise
+                            failed.append(hour)
+                        else:
+                            replaced.append(hour)
+
+        if staging.rows_appended:
+            appended = sorted(staging.appended_hours)
+            statements = ["BEGIN TRANSACTION;"]
+            for table, staging_table, column_list in tables:
+                # INSERT is allowed on buffered rows; the row_id check skips rows an earlier insert landed
+                statements.append(f"""INSERT INTO `{table}` ({column_list})
+SELECT {column_list} FROM `{staging_table}`
+WHERE (timestamp < @window_start OR timestamp >= @window_end)
+  AND row_id NOT IN (
+    SELECT row_id FROM `{table}`
+    WHERE timestamp >= @append_start AND timestamp < @append_end
+      AND service_name = @service_name AND row_id IS NOT NULL
+  );""")
+            statements.append("COMMIT TRANSACTION;")
+            run(statements, [
+                bigquery.ScalarQueryParameter("window_start", "TIMESTAMP", staging.start_time),
+                bigquery.ScalarQueryParameter("window_end", "TIMESTAMP", staging.end_time),
+                bigquery.ScalarQueryParameter("append_start", "TIMESTAMP", appended[0]),
+                bigquery.ScalarQueryParameter("append_end", "TIMESTAMP", appended[-1] + timedelta(hours=1)),
+            ])
+    finally:
+        for staging_table in staging_tables:
+            bq_client.delete_table(staging_table, not_found_ok=True)
+
+    return {
+        "service_name": service_name,
+        "hours_replaced": [hour.isoformat() for hour in replaced],
+        "hours_failed": [hour.isoformat() for hour in failed],
+        "rows_staged": staging.cost.rows,
+        "raw_rows_staged": staging.raw.rows,
+        "rows_appended": staging.rows_appended,
+        "bytes_processed": bytes_processed
+    }
@@ -0,0 +1,320 @@
+"""Blob storage for data that does not belong in BigQuery rows.
+
+The functions write raw provider payloads, dead-lettered rows and other
+bulky artifacts to the data bucket (``DATA_BUCKET_NAME``). ``open_blob_store``
+returns a store for a ``gs://`` bucket or, for local development, a
+directory on disk.
+
+This module is duplicated in each Cloud Function source directory that
+uses the data bucket, since the functions are deployed independently.
+"""
+
+import os
+import threading
+import uuid
+from typing import BinaryIO, List, Optional, Tuple
+
+try:
+    from google.api_core.exceptions import NotFound, PreconditionFailed
+    from google.cloud import storage
+except ImportError:  # pragma: no cover - optional dependency
+    NotFound = PreconditionFailed = None
+    storage = None
+
+
+class BlobStore:
+    """Minimal interface over an object store."""
+
+    def put(self, name: str, data: bytes, content_type: str = 'application/octet-stream') -> str:
+        """Write a blob and return its URI."""
+        raise NotImplementedError
+
+    def get(self, name: str) -> Optional[bytes]:
+        """Read a blob, or return None if it does not exist."""
+        raise NotImplementedError
+
+    def get_with_generation(self, name: str) -> Tuple[Optional[bytes], int]:
+        """Read a blob along with its generation, for a later ``put_if_generation``.
+
+        Returns:
+            The blob's data and generation, or (None, 0) if it does not exist.
+        """
+        raise NotImplementedError
+
+    def put_if_generation(self, name: str, data: bytes, generation: int,
+                          content_type: str = 'application/octet-stream') -> bool:
+        """Write a blob only if its generation is still ``generation`` (0: it must not exist).
+
+        Returns:
+            False if the blob was changed by someone else; nothing was written.
+        """
+        raise NotImplementedError
+
+    def uri(self, name: str) -> str:
+        """Get the URI of a blob."""
+        raise NotImplementedError
+
+    def list(self, prefix: str = '') -> List[str]:
+        """List the names of the blobs under a prefix, in name order."""
+        raise NotImplementedError
+
+    def delete(self, name: str) -> None:
+        """Delete a blob; deleting a missing blob is not an error."""
+        raise NotImplementedError
+
+    def open_read(self, name: str) -> Optional[Tuple[BinaryIO, int]]:
+        """Open a blob for streaming reads.
+
+        Returns:
+            The readable file and the blob's size, or None if it does not exist.
+        """
+        raise NotImplementedError
+
+    def open_write(self, name: str, content_type: str = 'application/octet-stream') -> 'BlobUpload':
+        """Start writing a blob in blocks; it only becomes visible on ``commit``."""
+        raise NotImplementedError
+
+
+class BlobUpload:
+    """A blob written in blocks, so large blobs are never held in memory."""
+
+    def __init__(self, file: BinaryIO):
+        self.file = file
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self.file.write(data)
+        self.size += len(data)
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def commit(self) -> None:
+        """Publish the blob under its name."""
+        raise NotImplementedError
+
+    def abort(self) -> None:
+        """Discard what was written."""
+        raise NotImplementedError
+
+
+# Blocks transferred per request by streaming reads and writes; GCS needs a multiple of 256 KiB
+STREAM_CHUNK_BYTES = 4 * 1024 * 1024
+
+
+class _GCSUpload(BlobUpload):
+    """Streams to a temporary object that is copied to the blob's name on commit."""
+
+    def __init__(self, bucket: object, name: str, content_type: str):
+        self.bucket = bucket
+        self.name = name
+        self.content_type = content_type
+        self.temp_blob = bucket.blob(f"{name}.{uuid.uuid4().hex[:12]}.tmp")
+        super().__init__(self.temp_blob.open('wb', chunk_size=STREAM_CHUNK_BYTES, ignore_flush=True,
+                                             content_type=content_type))
+
+    def commit(self) -> None:
+        self.file.close()
+        self.bucket.copy_blob(self.temp_blob, self.bucket, self.name)
+        self._delete_temp()
+
+    def abort(self) -> None:
+        try:
+            # An upload cannot be cancelled, so finish it and delete the temporary object
+            self.file.close()
+        finally:
+            self._delete_temp()
+
+    def _delete_temp(self) -> None:
+        try:
+            self.temp_blob.delete()
+        except NotFound:
+            pass
+
+
+class _LocalUpload(BlobUpload):
+    """Streams to a temporary file that is renamed to the blob's path on commit."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.temp_path = f"{path}.{uuid.uuid4().hex[:12]}.tmp"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        super().__init__(open(self.temp_path, 'wb'))
+
+    def commit(self) -> None:
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+
+    def abort(self) -> None:
+        self.file.close()
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+
+class GCSBlobStore(BlobStore):
+    """Blob store backed by a Cloud Storage bucket."""
+
+    def __init__(self, bucket_name: str, client: Optional[object] = None):
+        if client is None:
+            if storage is None:
+                raise ImportError("google-cloud-storage is required for gs:// blob stores")
+            client = storage.Client()
+        self.bucket_name = bucket_name
+        self.bucket = client.bucket(bucket_name)
+
+    def put(self, name: str, data: bytes, content_type: str = 'application/octet-stream') -> str:
+        self.bucket.blob(name).upload_from_string(data, content_type=content_type)
+        return self.uri(name)
+
+    def get(self, name: str) -> Optional[bytes]:
+        blob = self.bucket.blob(name)
+        if not blob.exists():
+            return None
+        return blob.download_as_bytes()
+
+    def get_with_generation(self, name: str) -> Tuple[Optional[bytes], int]:
+        while True:
+            blob = self.bucket.get_blob(name)
+            if blob is None:
+                return None, 0
+            try:
+                return blob.download_as_bytes(), blob.generation
+            except NotFound:
+                # Replaced or deleted after it was looked up; read the current generation
+                continue
+
+    def put_if_generation(self, name: str, data: bytes, generation: int,
+                          content_type: str = 'application/octet-stream') -> bool:
+        try:
+            self.bucket.blob(name).upload_from_string(data, content_type=content_type,
+                                                      if_generation_match=generation)
+        except PreconditionFailed:
+            return False
+        return True
+
+    def uri(self, name: str) -> str:
+        return f"gs://{self.bucket_name}/{name}"
+
+    def list(self, prefix: str = '') -> List[str]:
+        return sorted(blob.name for blob in self.bucket.list_blobs(prefix=prefix))
+
+    def delete(self, name: str) -> None:
+        try:
+            self.bucket.delete_blob(name)
+        except NotFound:
+            pass
+
+    def open_read(self, name: str) -> Optional[Tuple[BinaryIO, int]]:
+        blob = self.bucket.get_blob(name)
+        if blob is None:
+            return None
+        return blob.open('rb', chunk_size=STREAM_CHUNK_BYTES), blob.size
+
+    def open_write(self, name: str, content_type: str = 'application/octet-stream') -> BlobUpload:
+        return _GCSUpload(self.bucket, name, content_type)
+
+
+class LocalBlobStore(BlobStore):
+    """Blob store backed by a local directory, for development.
+
+    Generations are file modification times; conditional writes are only
+    atomic within one process.
+    """
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        self._lock = threading.Lock()
+
+    def _generation(self, name: str) -> int:
+        try:
+            return os.stat(self._path(name)).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root, *name.split('/'))
+
+    def put(self, name: str, data: bytes, content_type: str = 'application/octet-stream') -> str:
+        path = self._path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so readers never see a partial blob
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'wb') as blob_file:
+            blob_file.write(data)
+        os.replace(temp_path, path)
+        return self.uri(name)
+
+    def get(self, name: str) -> Optional[bytes]:
+        path = self._path(name)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as blob_file:
+            return blob_file.read()
+
+    def get_with_generation(self, name: str) -> Tuple[Optional[bytes], int]:
+        with self._lock:
+            generation = self._generation(name)
+            return (self.get(name) if generation else None), generation
+
+    def put_if_generation(self, name: str, data: bytes, generation: int,
+                          content_type: str = 'application/octet-stream') -> bool:
+        with self._lock:
+            if self._generation(name) != generation:
+                return False
+            self.put(name, data, content_type)
+            return True
+
+    def uri(self, name: str) -> str:
+        return f"file://{self._path(name)}"
+
+    def list(self, prefix: str = '') -> List[str]:
+        names = []
+        for directory, _, file_names in os.walk(self.root):
+            relative = os.path.relpath(directory, self.root).replace(os.sep, '/')
+            for file_name in file_names:
+                if file_name.endswith('.tmp'):
+                    continue
+                name = file_name if relative == '.' else f"{relative}/{file_name}"
+                if name.startswith(prefix):
+                    names.append(name)
+        return sorted(names)
+
+    def delete(self, name: str) -> None:
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
+
+    def open_read(self, name: str) -> Optional[Tuple[BinaryIO, int]]:
+        path = self._path(name)
+        try:
+            return open(path, 'rb'), os.path.getsize(path)
+        except FileNotFoundError:
+            return None
+
+    def open_write(self, name: str, content_type: str = 'application/octet-stream') -> BlobUpload:
+        return _LocalUpload(self._path(name))
+
+
+def open_blob_store(location: Optional[str]) -> Optional[BlobStore]:
+    """Open the blob store for a bucket name, ``gs://`` URI or local path.
+
+    Args:
+        location: A bucket name, ``gs://bucket``, ``file:///path`` or a
+            filesystem path.
+
+    Returns:
+        The blob store, or None if no location is configured.
+    """
+    if not location:
+        return None
+    if location.startswith('file://'):
+        return LocalBlobStore(location[len('file://'):])
+    if location.startswith(('/', '.')):
+        return LocalBlobStore(location)
+    if location.startswith('gs://'):
+        location = location[len('gs://'):]
+    return GCSBlobStore(location.strip('/'))
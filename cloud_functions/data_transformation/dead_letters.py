@@ -0,0 +1,117 @@
+"""Dead-letter store for rows BigQuery did not accept.
+
+Rows rejected by ``insert_rows_json``, and the rows of inserts that failed
+outright, are written to the data bucket instead of being dropped. Each
+write is one gzip-compressed NDJSON object under
+``dead_letters/<table>/<yyyy>/<mm>/<dd>/``, with one entry per row::
+
+    {"table": "cost_data", "source": "data_collection", "request_id": "...",
+     "failed_at": "2024-08-01T12:00:00+00:00", "reason": "invalid",
+     "errors": [...], "row": {...}}
+
+The admin function's ``replay_dead_letters`` action re-validates these rows
+and loads them back into their tables, so a failed insert is recovered by
+replaying its rows rather than by re-collecting the whole window.
+
+This module is duplicated in each Cloud Function source directory that
+uses the data bucket, since the functions are deployed independently.
+"""
+
+import gzip
+import json
+import uuid
+from datetime import date, datetime, timezone
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from blob_store import BlobStore
+
+DEAD_LETTER_PREFIX = 'dead_letters'
+DEAD_LETTER_SUFFIX = '.ndjson.gz'
+
+Row = Dict[str, Any]
+
+
+def rejected_rows(rows: Sequence[Row], errors: Iterable[Any]) -> List[Tuple[Row, List[Dict[str, Any]]]]:
+    """Pair the rows named in ``insert_rows_json`` errors with their error details."""
+    errors_by_index: Dict[int, List[Dict[str, Any]]] = {}
+    for entry in errors or ():
+        if isinstance(entry, dict) and isinstance(entry.get('index'), int):
+            errors_by_index.setdefault(entry['index'], []).extend(entry.get('errors') or [])
+    return [(rows[index], row_errors) for index, row_errors in sorted(errors_by_index.items())
+            if 0 <= index < len(rows)]
+
+
+def dead_letter_prefix(table: Optional[str] = None, day: Optional[date] = None) -> str:
+    """Get the blob name prefix of the dead letters of a table, optionally for one day."""
+    prefix = f"{DEAD_LETTER_PREFIX}/"
+    if table:
+        prefix += f"{table}/"
+        if day:
+            prefix += f"{day:%Y/%m/%d}/"
+    return prefix
+
+
+def parse_dead_letters(data: bytes) -> Iterator[Dict[str, Any]]:
+    """Read the entries of a dead-letter object."""
+    for line in gzip.decompress(data).split(b'\n'):
+        if line.strip():
+            yield json.loads(line)
+
+
+class DeadLetterWriter:
+    """Writes failed rows of one function to the dead-letter store."""
+
+    def __init__(self, store: BlobStore, source: str):
+        """Initialize the writer.
+
+        Args:
+            store: Blob store of the data bucket.
+            source: Name of the writing function, kept with every entry.
+        """
+        self.store = store
+        self.source = source
+
+    def write(self, table: str, failures: Sequence[Tuple[Row, List[Dict[str, Any]]]],
+              request_id: Optional[str] = None) -> Optional[str]:
+        """Write rows with their errors as one object.
+
+        Args:
+            table: Table the rows were meant for, e.g. ``cost_data``.
+            failures: Each row with the errors BigQuery reported for it.
+            request_id: Request that tried to insert the rows.
+
+        Returns:
+            The URI of the object, or None if there was nothing to write.
+        """
+        if not failures:
+            return None
+        failed_at = datetime.now(timezone.utc)
+        lines = []
+        for row, errors in failures:
+            reasons = [error.get('reason') for error in errors if isinstance(error, dict) and error.get('reason')]
+            lines.append(json.dumps({
+                "table": table,
+                "source": self.source,
+                "request_id": request_id,
+                "failed_at": failed_at.isoformat(),
+                "reason": reasons[0] if reasons else 'unknown',
+                "errors": errors,
+                "row": row
+            }, separators=(',', ':'), default=str).encode('utf-8'))
+        name = (f"{dead_letter_prefix(table, failed_at.date())}"
+                f"{failed_at:%H%M%S}-{uuid.uuid4().hex[:12]}{DEAD_LETTER_SUFFIX}")
+        return self.store.put(name, gzip.compress(b'\n'.join(lines) + b'\n'), content_type='application/gzip')
+
+    def write_rejected(self, table: str, rows: Sequence[Row], errors: Iterable[Any],
+                       request_id: Optional[str] = None) -> int:
+        """Write the rows rejected by an insert; returns how many were written."""
+        failures = rejected_rows(rows, errors)
+        self.write(table, failures, request_id)
+        return len(failures)
+
+    def write_failed(self, table: str, rows: Sequence[Row], error: BaseException,
+                     request_id: Optional[str] = None) -> int:
+        """Write every row of an insert that failed outright; returns how many were written."""
+        details = [{"reason": 'insert_failed', "message": f"{type(error).__name__}: {error}"}]
+        self.write(table, [(row, details) for row in rows], request_id)
+        return len(rows)
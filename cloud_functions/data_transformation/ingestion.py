@@ -0,0 +1,247 @@
+"""Usage events posted by applications to the transformation endpoint.
+
+Applications send batches of usage events as NDJSON, one event per line,
+optionally gzip- or zstd-compressed (``Content-Encoding: gzip`` or ``zstd``)::
+
+    {"event_id": "evt_123", "timestamp": "2024-08-01T12:00:00Z", "model": "gpt-4o",
+     "input_tokens": 812, "output_tokens": 96, "input_cost": 0.002, "output_cost": 0.001}
+
+or as a JSON object with a ``data`` array of events. An event may name its
+own ``service_name``, so one batch can mix services; events without one
+belong to the service named by the request. Bodies are decompressed and
+parsed as they are read from the request stream, so memory is bounded by
+the largest single event rather than by the upload.
+
+``event_id`` (or ``request_id``) makes delivery idempotent: the row ID is
+derived from it, so a retried event is written once.
+"""
+
+import gzip
+import hashlib
+import uuid
+from datetime import datetime, timezone
+from typing import Any, BinaryIO, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import json_codec
+from json_stream import iter_array_items
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+NDJSON_CONTENT_TYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+
+# Size of the blocks read from the (decompressed) request stream
+READ_BLOCK_BYTES = 64 * 1024
+
+# NDJSON lines longer than this are rejected instead of buffered; a row this
+# large could not be inserted anyway
+MAX_EVENT_BYTES = 8 * 1024 * 1024
+
+# insertAll rejects requests over 10 MB; the estimate below ignores JSON
+# escaping, so leave generous room
+MAX_INSERT_BYTES = 5 * 1024 * 1024
+
+# Errors raised while decompressing or parsing a request body
+BODY_ERRORS = (OSError, EOFError, ValueError) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+
+def make_row_id(service_name, model, request_id, timestamp, feature=None):
+    """Build the row ID linking a cost row to its raw payload (same scheme as the collector)."""
+    if request_id is None:
+        return uuid.uuid4().hex
+    parts = [service_name or '', model or '', str(request_id), str(timestamp or '')]
+    if feature is not None and feature != '':
+        parts.append(str(feature))
+    return hashlib.sha256('\x1f'.join(parts).encode('utf-8')).hexdigest()[:32]
+
+def is_ndjson(content_type: Optional[str]) -> bool:
+    """Whether a request body is NDJSON, judging by its content type."""
+    return (content_type or '').split(';')[0].strip().lower() in NDJSON_CONTENT_TYPES
+
+
+def open_body(stream: BinaryIO, content_encoding: Optional[str] = None) -> BinaryIO:
+    """Wrap a request stream so reads return the decompressed body."""
+    encoding = (content_encoding or '').strip().lower()
+    if encoding in ('', 'identity'):
+        return stream
+    if encoding in ('gzip', 'x-gzip'):
+        return gzip.GzipFile(fileobj=stream, mode='rb')
+    if encoding == 'zstd' and zstandard is not None:
+        return zstandard.ZstdDecompressor().stream_reader(stream, read_across_frames=True)
+    raise ValueError(f"Unsupported Content-Encoding: {content_encoding}")
+
+
+def iter_blocks(reader: BinaryIO, block_size: int = READ_BLOCK_BYTES) -> Iterator[bytes]:
+    """Read a stream in blocks until it is exhausted."""
+    while True:
+        block = reader.read(block_size)
+        if not block:
+            return
+        yield block
+
+
+def iter_ndjson(blocks: Iterable[bytes], max_line_bytes: int = MAX_EVENT_BYTES) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """Parse NDJSON events from a stream of byte blocks, skipping blank lines.
+
+    Yields:
+        The 1-based line number and the event.
+
+    Raises:
+        ValueError: If a line is not a JSON object or is too long.
+    """
+    line_number = 0
+    pending = b''
+
+    def parse(line: bytes) -> Optional[Dict[str, Any]]:
+        if not line.strip():
+            return None
+        try:
+            event = json_codec.loads(line)
+        except ValueError as e:
+            raise ValueError(f"Line {line_number}: invalid JSON: {e}") from None
+        if not isinstance(event, dict):
+            raise ValueError(f"Line {line_number}: expected a JSON object")
+        return event
+
+    for block in blocks:
+        lines = (pending + block if pending else block).split(b'\n')
+        pending = lines.pop()
+        if len(pending) > max_line_bytes:
+            raise ValueError(f"Line {line_number + len(lines) + 1}: longer than {max_line_bytes} bytes")
+        for line in lines:
+            line_number += 1
+            event = parse(line)
+            if event is not None:
+                yield line_number, event
+    line_number += 1
+    event = parse(pending)
+    if event is not None:
+        yield line_number, event
+
+
+def iter_json_events(blocks: Iterable[bytes], fields: Dict[str, Any]) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """Parse the events of a JSON ``{"service_name": ..., "data": [...]}`` body incrementally.
+
+    Args:
+        blocks: The body as a stream of byte blocks.
+        fields: Receives the other top-level keys as they are parsed; a
+            ``service_name`` placed before ``data`` applies to its events.
+
+    Yields:
+        The 1-based position of the event in ``data`` and the event.
+
+    Raises:
+        ValueError: If the body is not a JSON object or an event is not an object.
+    """
+    for position, event in enumerate(iter_array_items(blocks, ('data',), fields), start=1):
+        if not isinstance(event, dict):
+            raise ValueError(f"Item {position}: expected a JSON object")
+        yield position, event
+
+
+def normalize_timestamp(value: Any, default: str) -> str:
+    """Get the UTC ISO timestamp of an ISO 8601 string or epoch seconds.
+
+    Strings without an offset are taken as UTC.
+
+    Raises:
+        ValueError: If the value is neither.
+    """
+    if value is None or value == '':
+        return default
+    try:
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            parsed = datetime.fromtimestamp(value, tz=timezone.utc)
+        elif isinstance(value, str):
+            text = value.strip()
+            if text.endswith('Z'):
+                text = text[:-1] + '+00:00'
+            parsed = datetime.fromisoformat(text)
+            if parsed.tzinfo is None:
+                parsed = parsed.replace(tzinfo=timezone.utc)
+        else:
+            raise ValueError
+    except (ValueError, OverflowError, OSError):
+        raise ValueError(f"invalid timestamp {value!r}") from None
+    return parsed.astimezone(timezone.utc).isoformat()
+
+
+def event_to_rows(service_name: str, event: Dict[str, Any],
+                  received_at: str) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+    """Transform one usage event into a cost row and its raw payload row.
+
+    Args:
+        service_name: Service the event belongs to.
+        event: The usage event.
+        received_at: ISO timestamp used for events without a timestamp.
+
+    Returns:
+        The cost row and the raw payload row, or None if the event has no
+        raw payload or metadata.
+
+    Raises:
+        ValueError: If the event's timestamp cannot be parsed.
+    """
+    event_id = event.get('event_id', event.get('request_id'))
+    model = event.get('model', 'unknown')
+    feature = event.get('feature', 'chat')
+    timestamp = normalize_timestamp(event.get('timestamp'), received_at)
+    # Key the row on the event's own timestamp so a retry maps to the same row
+    row_id = make_row_id(service_name, model, event_id, event.get('timestamp'), feature)
+    input_tokens = event.get('input_tokens', 0)
+    output_tokens = event.get('output_tokens', 0)
+    input_cost = event.get('input_cost', 0.0)
+    output_cost = event.get('output_cost', 0.0)
+
+    row = {
+        "timestamp": timestamp,
+        "service_name": service_name,
+        "model": model,
+        "feature": feature,
+        "request_id": event_id,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "total_tokens": input_tokens + output_tokens,
+        "input_cost": input_cost,
+        "output_cost": output_cost,
+        "cost": input_cost + output_cost,
+        "price_version": event.get('price_version', None),
+        "response_time_ms": event.get('response_time_ms', 0),
+        "project": event.get('project', None),
+        "user_id": event.get('user_id', None),
+        "row_id": row_id
+    }
+
+    raw_row = None
+    if event.get('raw_response') is not None or event.get('metadata') is not None:
+        # Raw payloads are stored in the sibling table, keyed by row_id; client
+        # strings are JSON string values, not encoded documents
+        raw_row = {
+            "row_id": row_id,
+            "timestamp": timestamp,
+            "service_name": service_name,
+            "raw_response": json_codec.dumps(event.get('raw_response', {})),
+            "metadata": json_codec.dumps(event.get('metadata', {}))
+        }
+    return row, raw_row
+
+
+def _estimate_row_size(row: Dict[str, Any]) -> int:
+    return 2 + sum(len(key) + 4 + (len(value) + 2 if isinstance(value, str) else 24) for key, value in row.items())
+
+
+def split_by_size(rows: List[Dict[str, Any]], max_bytes: int = MAX_INSERT_BYTES) -> Iterator[List[Dict[str, Any]]]:
+    """Split rows into insert requests whose estimated JSON size stays under ``max_bytes``."""
+    chunk: List[Dict[str, Any]] = []
+    size = 0
+    for row in rows:
+        row_size = _estimate_row_size(row)
+        if chunk and size + row_size > max_bytes:
+            yield chunk
+            chunk, size = [], 0
+        chunk.append(row)
+        size += row_size
+    if chunk:
+        yield chunk
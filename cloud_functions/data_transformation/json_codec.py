@@ -0,0 +1,87 @@
+"""Pluggable JSON codec.
+
+Provider responses, BigQuery JSON columns and HTTP responses all go through
+``dumps``/``loads`` here. ``orjson`` is used when it is installed and the
+standard library ``json`` module otherwise; both backends produce compact
+output and encode datetimes as ISO 8601 strings, so the result does not
+depend on which one is active.
+
+This module is duplicated in each Cloud Function source directory, since
+the functions are deployed independently.
+"""
+
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, Optional, Union
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+BACKEND = 'orjson' if orjson is not None else 'json'
+
+_ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS if orjson is not None else 0
+
+
+def _default(value: Any) -> Any:
+    """Encode the types that the standard library cannot serialize."""
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps_bytes(value: Any) -> bytes:
+    """Serialize a value to UTF-8 encoded JSON."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(value, default=_default, option=_ORJSON_OPTIONS)
+        except orjson.JSONEncodeError:
+            # Integers wider than 64 bits and similar edge cases
+            pass
+    return json.dumps(value, default=_default, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def dumps(value: Any) -> str:
+    """Serialize a value to a JSON string."""
+    if orjson is not None:
+        return dumps_bytes(value).decode('utf-8')
+    return json.dumps(value, default=_default, separators=(',', ':'), ensure_ascii=False)
+
+
+def loads(data: Union[str, bytes, bytearray, memoryview]) -> Any:
+    """Parse a JSON document from a string or bytes."""
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return json.loads(data)
+
+
+class EncodedJSON(str):
+    """Text that already holds an encoded JSON document.
+
+    Only internal paths that encoded a payload themselves wrap it, so it is
+    stored in a JSON column as is instead of being encoded again.
+    """
+
+    __slots__ = ()
+
+
+def encode_json_value(value: Any) -> Optional[str]:
+    """Encode a value for a JSON column without double-encoding.
+
+    ``EncodedJSON`` text and bytes are assumed to hold JSON already and are
+    returned as text; any other string is encoded as a JSON string. None
+    stays None so the column is left NULL.
+    """
+    if value is None or isinstance(value, EncodedJSON):
+        return value
+    if isinstance(value, (bytes, bytearray)):
+        return value.decode('utf-8')
+    return dumps(value)
@@ -0,0 +1,143 @@
+"""Incremental parsing of large JSON request bodies.
+
+Batches posted to the transformation endpoint hold their events in a
+``data`` array that can be larger than the function's memory. ``iter_array_items``
+walks the object straight from the request stream and yields the array
+elements one at a time, so memory stays bounded by the largest single event.
+
+This is the incremental parser of ``data_collection/adapters/json_stream.py``
+without its ``requests`` helper.
+"""
+
+import codecs
+import json
+from typing import Any, Dict, Iterable, Iterator, Optional, Sequence
+
+_WHITESPACE = ' \t\n\r'
+_NUMBER_START = '-0123456789'
+_NUMBER_CHARS = '+-.0123456789eE'
+_COMPACT_THRESHOLD = 256 * 1024
+
+
+class _Reader:
+    """Character buffer over a stream of byte chunks."""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self) -> bool:
+        """Read the next chunk into the buffer; returns False at end of stream."""
+        if self.eof:
+            return False
+        for chunk in self.chunks:
+            if not chunk:
+                continue
+            text = self.decoder.decode(chunk) if isinstance(chunk, bytes) else chunk
+            if self.pos > _COMPACT_THRESHOLD:
+                # Drop the consumed prefix so the buffer does not grow with the document
+                self.buffer = self.buffer[self.pos:]
+                self.pos = 0
+            self.buffer += text
+            return True
+        self.buffer += self.decoder.decode(b'', final=True)
+        self.eof = True
+        return False
+
+    def peek(self) -> Optional[str]:
+        """Skip whitespace and return the next character without consuming it."""
+        while True:
+            buffer, pos = self.buffer, self.pos
+            while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+                pos += 1
+            self.pos = pos
+            if pos < len(buffer):
+                return buffer[pos]
+            if not self.fill():
+                return None
+
+    def expect(self, char: str) -> None:
+        if self.peek() != char:
+            raise ValueError(f"Expected {char!r} at offset {self.pos} of JSON stream")
+        self.pos += 1
+
+    def number_end(self) -> int:
+        """Get the offset just past the number token that starts at ``pos``."""
+        buffer, end = self.buffer, self.pos
+        while end < len(buffer) and buffer[end] in _NUMBER_CHARS:
+            end += 1
+        return end
+
+    def value(self) -> Any:
+        """Decode the next complete JSON value."""
+        while True:
+            char = self.peek()
+            # A number is only complete once a delimiter follows it: a chunk may end
+            # after any of its characters, e.g. "1." with "5e10" still to come
+            if char is not None and char in _NUMBER_START and self.number_end() == len(self.buffer):
+                if self.fill():
+                    continue
+            try:
+                value, end = self.json_decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.fill():
+                    continue
+                raise
+            self.pos = end
+            return value
+
+def iter_array_items(chunks: Iterable[bytes], array_keys: Sequence[str] = ('data', 'items'),
+                     fields: Optional[Dict[str, Any]] = None) -> Iterator[Any]:
+    """Yield the elements of a top-level array from a streamed JSON object.
+
+    Args:
+        chunks: The response body as an iterable of byte chunks.
+        array_keys: Keys whose array is streamed; the first one found is used.
+        fields: Optional dict that receives every other top-level key (for
+            example ``has_more`` and ``next_page``). It is complete once the
+            iterator is exhausted.
+
+    Yields:
+        The decoded elements of the array.
+    """
+    if fields is None:
+        fields = {}
+    reader = _Reader(chunks)
+    streamed = False
+
+    reader.expect('{')
+    while True:
+        char = reader.peek()
+        if char == '}':
+            reader.pos += 1
+            return
+        if char == ',':
+            reader.pos += 1
+            continue
+        if char is None:
+            raise ValueError("Unexpected end of JSON stream")
+
+        key = reader.value()
+        reader.expect(':')
+
+        if not streamed and key in array_keys and reader.peek() == '[':
+            streamed = True
+            reader.pos += 1
+            while True:
+                char = reader.peek()
+                if char == ']':
+                    reader.pos += 1
+                    break
+                if char == ',':
+                    reader.pos += 1
+                    continue
+                if char is None:
+                    raise ValueError("Unexpected end of JSON stream")
+                yield reader.value()
+        else:
+            fields[key] = reader.value()
+
@@ -1,12 +1,131 @@
 import functions_framework
+import logging
 import os
-import json
-from datetime import datetime
+import threading
+from datetime import datetime, timezone
 import google.cloud.bigquery as bigquery
 
+import json_codec
+from blob_store import open_blob_store
+from cost_rollup import RollupMarkers, rollup_dates
+from ingestion import (BODY_ERRORS, event_to_rows, is_ndjson, iter_blocks, iter_json_events, iter_ndjson,
+                       open_body, split_by_size)
+from dead_letters import DeadLetterWriter
+from micro_batch import DEFAULT_MAX_AGE_SECONDS, DEFAULT_MAX_ROWS, MicroBatcher
+
+logger = logging.getLogger('costwise-transform')
+
+# The batcher is shared by all requests of an instance
+_ingest = None
+_ingest_lock = threading.Lock()
+
+
+def get_ingest():
+    """Create the BigQuery client and micro-batcher of this instance."""
+    global _ingest
+    with _ingest_lock:
+        if _ingest is not None:
+            return _ingest
+
+        project_id = os.environ.get('PROJECT_ID')
+        dataset_id = os.environ.get('DATASET_ID')
+        cost_data_table_id = os.environ.get('COST_DATA_TABLE_ID')
+        cost_data_raw_table_id = os.environ.get('COST_DATA_RAW_TABLE_ID') or f"{cost_data_table_id}_raw"
+
+        bq_client = bigquery.Client(project=project_id)
+        data_store = open_blob_store(os.environ.get('DATA_BUCKET_NAME'))
+        dead_letters = DeadLetterWriter(data_store, 'data_transformation') if data_store is not None else None
+        table_ref = bq_client.dataset(dataset_id).table(cost_data_table_id)
+        raw_table_ref = bq_client.dataset(dataset_id).table(cost_data_raw_table_id)
+
+        # The rollup days are refreshed by the collector, so requests never wait for a MERGE
+        rollup_markers = RollupMarkers(data_store) if data_store is not None else None
+        if rollup_markers is None:
+            logger.warning("DATA_BUCKET_NAME is not set; the daily rollup is not refreshed for ingested events", extra={
+                "event_type": "rollup_markers_disabled"
+            })
+
+        def insert(table, table_id, chunk):
+            """Insert a chunk, dead-lettering the rows BigQuery does not accept.
+
+            Returns the rows that were inserted. Raises only if the failed
+            rows could not be dead-lettered either, so the request fails and
+            the client retries it.
+            """
+            try:
+                errors = bq_client.insert_rows_json(table, chunk, row_ids=[row["row_id"] for row in chunk])
+            except Exception as e:
+                if dead_letters is None:
+                    raise
+                dead_letters.write_failed(table_id, chunk, e)
+                logger.warning(f"Dead-lettered {len(chunk)} rows after a failed insert: {str(e)}", extra={
+                    "table_id": table_id,
+                    "records_count": len(chunk),
+                    "event_type": "rows_dead_lettered"
+                })
+                return []
+            if not errors:
+                return chunk
+            if dead_letters is None:
+                raise RuntimeError(f"Error inserting rows into {table_id}: {errors}")
+            count = dead_letters.write_rejected(table_id, chunk, errors)
+            logger.warning(f"Dead-lettered {count} rows rejected by BigQuery", extra={
+                "table_id": table_id,
+                "records_count": count,
+                "errors": str(errors)[:1000],
+                "event_type": "rows_dead_lettered"
+            })
+            # Rows not named in the errors were inserted
+            rejected = {error.get("index") for error in errors if isinstance(error, dict)}
+            return [row for index, row in enumerate(chunk) if index not in rejected]
+
+        def flush(rows, raw_rows):
+            # Raw payloads can be large, so split inserts to stay under the insertAll request limit
+            inserted = []
+            for chunk in split_by_size(rows):
+                inserted.extend(insert(table_ref, cost_data_table_id, chunk))
+
+            for chunk in split_by_size(raw_rows):
+                insert(raw_table_ref, cost_data_raw_table_id, chunk)
+
+            if rollup_markers is None:
+                return
+            timestamps_by_service = {}
+            for row in inserted:
+                timestamps_by_service.setdefault(row["service_name"], []).append(row["timestamp"])
+            for service_name, timestamps in timestamps_by_service.items():
+                dates = rollup_dates(timestamps)
+                try:
+                    rollup_markers.mark(service_name, dates)
+                except Exception as e:
+                    # The rows are written; only the rollup of these days lags until it is repaired
+                    logger.error(f"Failed to record rollup days for {service_name}: {str(e)}", extra={
+                        "service_name": service_name,
+                        "dates": sorted(day.isoformat() for day in dates),
+                        "error": str(e),
+                        "event_type": "rollup_marker_error"
+                    })
+
+        batcher = MicroBatcher(
+            flush,
+            max_rows=int(os.environ.get('INGEST_MAX_BATCH_ROWS') or DEFAULT_MAX_ROWS),
+            max_age_seconds=float(os.environ.get('INGEST_MAX_BATCH_AGE_MS') or DEFAULT_MAX_AGE_SECONDS * 1000) / 1000
+        )
+        _ingest = batcher
+        return _ingest
+
+
 @functions_framework.http
 def transform_data(request):
-    """HTTP Cloud Function to transform AI service data.
+    """HTTP Cloud Function to transform and ingest AI service usage data.
+
+    Accepts either a JSON body with a ``data`` array, or a batch of NDJSON
+    usage events, optionally gzip- or zstd-compressed. Each event belongs to
+    its own ``service_name`` if it has one, otherwise to the body's
+    ``service_name`` or the ``service_name`` query parameter, so a batch can
+    mix services. The body is parsed as it streams in and submitted to the
+    instance's micro-batcher in chunks, so a large upload is never held in
+    memory; the request is acknowledged once every chunk is written.
     Args:
         request (flask.Request): The request object.
     Returns:
@@ -14,63 +133,88 @@ def transform_data(request):
         Response object using `make_response`
     """
     try:
-        # Get environment variables
-        project_id = os.environ.get('PROJECT_ID')
-        dataset_id = os.environ.get('DATASET_ID')
-        cost_data_table_id = os.environ.get('COST_DATA_TABLE_ID')
-        
-        # Initialize BigQuery client
-        bq_client = bigquery.Client(project=project_id)
-        
-        # Extract and validate request data
-        request_json = request.get_json(silent=True)
-        if not request_json or 'service_name' not in request_json:
-            return json.dumps({"error": "Invalid request: missing service_name"}), 400, {'Content-Type': 'application/json'}
-        
-        service_name = request_json['service_name']
-        raw_data = request_json.get('data', [])
-        
-        if not raw_data:
-            return json.dumps({"error": "No data provided for transformation"}), 400, {'Content-Type': 'application/json'}
-        
-        # Transform data based on service type
-        transformed_data = []
-        
-        for item in raw_data:
-            # Apply common transformations
-            transformed_item = {
-                "timestamp": datetime.utcnow().isoformat(),
-                "service_name": service_name,
-                "model": item.get('model', 'unknown'),
-                "feature": item.get('feature', 'chat'),
-                "request_id": item.get('request_id', None),
-                "input_tokens": item.get('input_tokens', 0),
-                "output_tokens": item.get('output_tokens', 0),
-                "total_tokens": item.get('input_tokens', 0) + item.get('output_tokens', 0),
-                "input_cost": item.get('input_cost', 0.0),
-                "output_cost": item.get('output_cost', 0.0),
-                "cost": item.get('input_cost', 0.0) + item.get('output_cost', 0.0),
-                "response_time_ms": item.get('response_time_ms', 0),
-                "project": item.get('project', None),
-                "user_id": item.get('user_id', None),
-                "raw_response": json.dumps(item.get('raw_response', {})),
-                "metadata": json.dumps(item.get('metadata', {}))
-            }
-            
-            transformed_data.append(transformed_item)
-        
-        # Insert transformed data into BigQuery
-        table_ref = bq_client.dataset(dataset_id).table(cost_data_table_id)
-        errors = bq_client.insert_rows_json(table_ref, transformed_data)
-        
-        if errors:
-            return json.dumps({"error": f"Error inserting rows: {errors}"}), 500, {'Content-Type': 'application/json'}
-        
-        return json.dumps({
+        received_at = datetime.now(timezone.utc).isoformat()
+        default_service = request.args.get('service_name') or request.headers.get('X-Service-Name')
+
+        batcher = get_ingest()
+        counts = {"accepted": 0, "duplicates": 0}
+        service_counts = {}
+        rows = []
+        raw_payloads = {}
+
+        def submit():
+            accepted, duplicates = batcher.submit(rows, raw_payloads)
+            counts["accepted"] += accepted
+            counts["duplicates"] += duplicates
+            rows.clear()
+            raw_payloads.clear()
+
+        # Extract, validate and transform the events as the body is read
+        fields = {}
+        ndjson = is_ndjson(request.headers.get('Content-Type'))
+        try:
+            blocks = iter_blocks(open_body(request.stream, request.headers.get('Content-Encoding')))
+            if ndjson:
+                events = iter_ndjson(blocks)
+            else:
+                events = iter_json_events(blocks, fields)
+        except BODY_ERRORS as e:
+            return json_codec.dumps({"error": f"Invalid request body: {str(e)}"}), 400, {'Content-Type': 'application/json'}
+
+        def resolve_services():
+            # A JSON body's service_name may follow its data array (clients that sort keys),
+            # so events without any service wait for the end of the body
+            deferred = []
+            for position, item in events:
+                service_name = item.get('service_name') or fields.get('service_name') or default_service
+                if not service_name and not ndjson:
+                    deferred.append((position, item))
+                    continue
+                yield position, item, service_name
+            for position, item in deferred:
+                yield position, item, fields.get('service_name')
+
+        resolved = resolve_services()
+        while True:
+            try:
+                position, item, service_name = next(resolved, (None, None, None))
+                if item is None:
+                    break
+                if not service_name:
+                    raise ValueError(f"Event {position}: missing service_name")
+                try:
+                    transformed_item, raw_payload = event_to_rows(service_name, item, received_at)
+                except ValueError as e:
+                    raise ValueError(f"Event {position}: {e}") from None
+            except BODY_ERRORS as e:
+                # Chunks already submitted stay written; a retry of the whole body skips them as duplicates
+                return json_codec.dumps({
+                    "error": f"Invalid request body: {str(e)}",
+                    "records_transformed": counts["accepted"]
+                }), 400, {'Content-Type': 'application/json'}
+
+            rows.append(transformed_item)
+            if raw_payload is not None:
+                raw_payloads[transformed_item["row_id"]] = raw_payload
+            service_counts[service_name] = service_counts.get(service_name, 0) + 1
+            if len(rows) >= batcher.max_rows:
+                submit()
+
+        if not service_counts:
+            if not default_service and not fields.get('service_name'):
+                return json_codec.dumps({"error": "Invalid request: missing service_name"}), 400, {'Content-Type': 'application/json'}
+            return json_codec.dumps({"error": "No data provided for transformation"}), 400, {'Content-Type': 'application/json'}
+
+        if rows:
+            submit()
+
+        return json_codec.dumps({
             "success": True,
-            "records_transformed": len(transformed_data),
-            "service": service_name
+            "records_transformed": counts["accepted"],
+            "duplicates": counts["duplicates"],
+            "service": next(iter(service_counts)) if len(service_counts) == 1 else None,
+            "services": service_counts
         }), 200, {'Content-Type': 'application/json'}
-        
+
     except Exception as e:
-        return json.dumps({"error": str(e)}), 500, {'Content-Type': 'application/json'}
+        return json_codec.dumps({"error": str(e)}), 500, {'Content-Type': 'application/json'}
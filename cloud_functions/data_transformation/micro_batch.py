@@ -0,0 +1,162 @@
+"""Per-instance micro-batching of ingested usage rows.
+
+Concurrent requests add their rows to a shared batch, which is written with
+one insert when it reaches ``max_rows`` or ``max_age_seconds``. Each request
+waits until the batches holding its rows are written before acknowledging,
+so an acknowledged event is always in BigQuery, while the insert cost is
+shared by all requests of the batch. There is no background thread: the
+request that fills a batch, or the first one to see it expire, writes it.
+This keeps working when the instance CPU is throttled between requests.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+# BigQuery recommends at most 500 rows per insertAll request
+DEFAULT_MAX_ROWS = 500
+DEFAULT_MAX_AGE_SECONDS = 0.25
+DEFAULT_RECENT_IDS = 100000
+
+Row = Dict[str, Any]
+
+
+class _Batch:
+    """Rows waiting for the same insert."""
+
+    __slots__ = ('created', 'rows', 'raw_rows', 'done', 'error')
+
+    def __init__(self, created: float):
+        self.created = created
+        self.rows: List[Row] = []
+        self.raw_rows: List[Row] = []
+        self.done = threading.Event()
+        self.error: Optional[BaseException] = None
+
+
+class RecentIds:
+    """Bounded set of the row IDs this instance wrote most recently.
+
+    Clients retry requests whose acknowledgement they did not receive, so
+    repeated events are dropped here before they reach BigQuery. Rows that
+    slip through (e.g. a retry landing on another instance) carry the same
+    insert ID, which BigQuery also deduplicates on a best-effort basis.
+    """
+
+    def __init__(self, max_size: int = DEFAULT_RECENT_IDS):
+        self.max_size = max(1, int(max_size))
+        self._ids: 'OrderedDict[str, None]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, row_id: str) -> bool:
+        with self._lock:
+            return row_id in self._ids
+
+    def add_all(self, row_ids: Iterable[str]) -> None:
+        with self._lock:
+            for row_id in row_ids:
+                self._ids[row_id] = None
+                self._ids.move_to_end(row_id)
+            while len(self._ids) > self.max_size:
+                self._ids.popitem(last=False)
+
+
+class MicroBatcher:
+    """Groups rows from concurrent requests into shared inserts."""
+
+    def __init__(self, flush: Callable[[List[Row], List[Row]], None], max_rows: int = DEFAULT_MAX_ROWS,
+                 max_age_seconds: float = DEFAULT_MAX_AGE_SECONDS, clock: Callable[[], float] = time.monotonic):
+        """Initialize the batcher.
+
+        Args:
+            flush: Writes a batch, given its cost rows and raw payload rows.
+                It must raise if any row was not written.
+            max_rows: Cost rows that fill a batch.
+            max_age_seconds: Longest time a batch stays open.
+            clock: Monotonic clock, in seconds.
+        """
+        self.flush = flush
+        self.max_rows = max(1, int(max_rows))
+        self.max_age_seconds = max(0.0, float(max_age_seconds))
+        self.clock = clock
+        self.recent_ids = RecentIds()
+        self._current: Optional[_Batch] = None
+        self._lock = threading.Lock()
+        self.stats = {'batches': 0, 'rows': 0, 'failed_batches': 0}
+
+    def _write(self, batch: _Batch) -> None:
+        try:
+            self.flush(batch.rows, batch.raw_rows)
+            self.recent_ids.add_all(row['row_id'] for row in batch.rows)
+            self.stats['rows'] += len(batch.rows)
+        except BaseException as e:
+            batch.error = e
+            self.stats['failed_batches'] += 1
+        finally:
+            self.stats['batches'] += 1
+            batch.done.set()
+
+    def _wait(self, batch: _Batch) -> None:
+        while not batch.done.is_set():
+            remaining = batch.created + self.max_age_seconds - self.clock()
+            if remaining > 0 and batch.done.wait(remaining):
+                break
+            with self._lock:
+                # The batch expired; write it unless another request already took it
+                claimed = self._current is batch
+                if claimed:
+                    self._current = None
+            if claimed:
+                self._write(batch)
+            else:
+                batch.done.wait()
+
+    def submit(self, rows: List[Row], raw_rows: Dict[str, Row]) -> Tuple[int, int]:
+        """Add rows to the open batch and wait until they are written.
+
+        Args:
+            rows: Cost rows, each with a ``row_id``.
+            raw_rows: Raw payload rows by ``row_id``; rows without a payload
+                have no entry.
+
+        Returns:
+            The number of rows written and of rows dropped as duplicates.
+
+        Raises:
+            Exception: The error of the first batch holding these rows that
+                failed to be written. The whole request can be retried, since
+                rows are deduplicated by ``row_id``.
+        """
+        touched: List[_Batch] = []
+        full: List[_Batch] = []
+        seen = set()
+        duplicates = 0
+        with self._lock:
+            for row in rows:
+                row_id = row['row_id']
+                if row_id in seen or row_id in self.recent_ids:
+                    duplicates += 1
+                    continue
+                seen.add(row_id)
+                batch = self._current
+                if batch is None:
+                    batch = self._current = _Batch(self.clock())
+                batch.rows.append(row)
+                raw_row = raw_rows.get(row_id)
+                if raw_row is not None:
+                    batch.raw_rows.append(raw_row)
+                if not touched or touched[-1] is not batch:
+                    touched.append(batch)
+                if len(batch.rows) >= self.max_rows:
+                    self._current = None
+                    full.append(batch)
+
+        for batch in full:
+            self._write(batch)
+        for batch in touched:
+            self._wait(batch)
+        for batch in touched:
+            if batch.error is not None:
+                raise batch.error
+        return len(seen), duplicates
@@ -0,0 +1,8 @@
+"""Reverse proxy that meters OpenAI- and Anthropic-compatible API traffic."""
+
+from .app import Upstream, client_recorder, create_app, upstreams_from_env
+from .pricing_source import PricingSource, bigquery_loader, file_loader
+from .usage import UsageExtractor
+
+__all__ = ['PricingSource', 'Upstream', 'UsageExtractor', 'bigquery_loader', 'client_recorder', 'create_app',
+           'file_loader', 'upstreams_from_env']
@@ -0,0 +1,78 @@
+"""Run the metering proxy.
+
+Configuration is read from the environment:
+
+    PORT                     Listen port (default 8080)
+    INGEST_ENDPOINT          URL of the transformation function (required)
+    INGEST_SPILL_DIR         Directory for events that cannot be delivered
+    INGEST_USE_ID_TOKEN      Authenticate to the endpoint with a Google ID token (default false)
+    PRICING_FILE             JSON file of {service_name: models}; otherwise
+                             prices are read from PROJECT_ID, DATASET_ID and
+                             SERVICE_CONFIG_TABLE_ID
+    PRICING_REFRESH_SECONDS  Interval between price reloads (default 300)
+    OPENAI_UPSTREAM          OpenAI-compatible base URL (default https://api.openai.com)
+    OPENAI_SERVICE_NAME      Service name of OpenAI usage (default OpenAI)
+    OPENAI_STREAM_USAGE      Request usage in streamed OpenAI responses (default true)
+    ANTHROPIC_UPSTREAM       Anthropic-compatible base URL (default https://api.anthropic.com)
+    ANTHROPIC_SERVICE_NAME   Service name of Anthropic usage (default Claude)
+
+    python -m metering_proxy
+"""
+
+import asyncio
+import logging
+import os
+
+from aiohttp import web
+
+from .app import DEFAULT_PRICING_REFRESH_SECONDS, client_recorder, create_app, upstreams_from_env
+from .pricing_source import PricingSource, bigquery_loader, file_loader
+
+try:
+    import uvloop
+except ImportError:  # pragma: no cover - optional dependency
+    uvloop = None
+
+
+def id_token_provider(audience: str):
+    """Fetch ID tokens for an authenticated Cloud Function from the ambient credentials."""
+    import google.auth.transport.requests
+    import google.oauth2.id_token
+
+    auth_request = google.auth.transport.requests.Request()
+    return lambda: google.oauth2.id_token.fetch_id_token(auth_request, audience)
+
+
+def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+    upstreams = upstreams_from_env()
+    endpoint = os.environ['INGEST_ENDPOINT']
+    token_provider = None
+    if os.environ.get('INGEST_USE_ID_TOKEN', 'false').lower() == 'true':
+        token_provider = id_token_provider(endpoint)
+
+    pricing_file = os.environ.get('PRICING_FILE')
+    if pricing_file:
+        loader = file_loader(pricing_file)
+    else:
+        loader = bigquery_loader(
+            os.environ['PROJECT_ID'],
+            os.environ['DATASET_ID'],
+            os.environ.get('SERVICE_CONFIG_TABLE_ID', 'service_config'),
+            [upstream.service_name for upstream in upstreams.values()]
+        )
+
+    app = create_app(
+        upstreams,
+        PricingSource(loader),
+        client_recorder(endpoint, spill_dir=os.environ.get('INGEST_SPILL_DIR'), token_provider=token_provider),
+        include_stream_usage=os.environ.get('OPENAI_STREAM_USAGE', 'true').lower() != 'false',
+        pricing_refresh_seconds=float(os.environ.get('PRICING_REFRESH_SECONDS') or DEFAULT_PRICING_REFRESH_SECONDS)
+    )
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    web.run_app(app, port=int(os.environ.get('PORT', '8080')), access_log=None)
+
+
+if __name__ == '__main__':
+    main()
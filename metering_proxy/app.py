@@ -0,0 +1,240 @@
+"""Metering reverse proxy for OpenAI- and Anthropic-compatible APIs.
+
+Requests to ``/openai/...`` and ``/anthropic/...`` are forwarded to the
+configured upstreams with the caller's own credentials. Response bytes are
+written to the client as they arrive and fed to a ``UsageExtractor`` on the
+way. Once the response is complete, its usage is priced and handed to a
+recorder that posts it to the ingestion endpoint in the background, so
+metering never delays the response.
+
+Requests can be attributed with the ``X-CostWise-Project``,
+``X-CostWise-User`` and ``X-CostWise-Feature`` headers, which are not
+forwarded upstream.
+"""
+
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, NamedTuple, Optional
+
+import aiohttp
+from aiohttp import web
+
+from . import json_codec
+from .pricing_source import PricingSource
+from .usage import UsageExtractor
+
+logger = logging.getLogger('costwise-metering-proxy')
+
+# Headers that apply to one connection and must not be forwarded
+HOP_BY_HOP_HEADERS = frozenset({
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailer',
+    'transfer-encoding', 'upgrade', 'host', 'content-length'
+})
+
+ATTRIBUTION_HEADERS = {
+    'x-costwise-project': 'project',
+    'x-costwise-user': 'user_id',
+    'x-costwise-feature': 'feature'
+}
+
+DEFAULT_PRICING_REFRESH_SECONDS = 300
+
+Recorder = Callable[..., None]
+
+
+class Upstream(NamedTuple):
+    """An API the proxy forwards to."""
+    flavor: str
+    base_url: str
+    service_name: str
+
+
+def _request_headers(request: web.Request) -> Dict[str, str]:
+    headers = {}
+    for name, value in request.headers.items():
+        lowered = name.lower()
+        if lowered in HOP_BY_HOP_HEADERS or lowered in ATTRIBUTION_HEADERS or lowered == 'accept-encoding':
+            continue
+        headers[name] = value
+    # Uncompressed responses can be metered without decompressing them
+    headers['Accept-Encoding'] = 'identity'
+    return headers
+
+
+def _response_headers(upstream_response: aiohttp.ClientResponse) -> Dict[str, str]:
+    headers = {}
+    for name, value in upstream_response.headers.items():
+        lowered = name.lower()
+        if lowered in HOP_BY_HOP_HEADERS and lowered != 'content-length':
+            continue
+        headers[name] = value
+    return headers
+
+
+def _prepare_body(upstream: Upstream, body: bytes, include_stream_usage: bool) -> bytes:
+    """Ask OpenAI to report usage at the end of streamed responses."""
+    if upstream.flavor != 'openai' or not include_stream_usage or b'"stream"' not in body:
+        return body
+    try:
+        document = json_codec.loads(body)
+    except ValueError:
+        return body
+    if not isinstance(document, dict) or document.get('stream') is not True or 'stream_options' in document:
+        return body
+    document['stream_options'] = {'include_usage': True}
+    return json_codec.dumps_bytes(document)
+
+
+async def proxy_handler(request: web.Request) -> web.StreamResponse:
+    """Forward a request to its upstream and meter the response."""
+    app = request.app
+    upstream = app['upstreams'].get(request.match_info['provider'])
+    if upstream is None:
+        return web.json_response({"error": f"Unknown provider: {request.match_info['provider']}"}, status=404)
+
+    started = time.perf_counter()
+    body = await request.read()
+    body = _prepare_body(upstream, body, app['include_stream_usage'])
+    url = f"{upstream.base_url}/{request.match_info['path']}"
+    if request.query_string:
+        url = f"{url}?{request.query_string}"
+
+    response = None
+    extractor = None
+    try:
+        async with app['session'].request(request.method, url, headers=_request_headers(request),
+                                          data=body or None, allow_redirects=False) as upstream_response:
+            if upstream_response.status < 400:
+                content_type = upstream_response.headers.get('Content-Type', '')
+                extractor = UsageExtractor(streaming='text/event-stream' in content_type)
+            response = web.StreamResponse(status=upstream_response.status, reason=upstream_response.reason,
+                                          headers=_response_headers(upstream_response))
+            await response.prepare(request)
+            async for chunk in upstream_response.content.iter_any():
+                await response.write(chunk)
+                if extractor is not None:
+                    extractor.feed(chunk)
+            await response.write_eof()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        if response is not None and response.prepared:
+            # Headers are already sent; all that is left is to drop the connection
+            raise
+        return web.json_response({"error": f"Upstream request failed: {e}"}, status=502)
+
+    if extractor is not None:
+        try:
+            record_usage(app, upstream, request, extractor, round((time.perf_counter() - started) * 1000))
+        except Exception:
+            logger.exception("Failed to record usage")
+    return response
+
+
+def record_usage(app: web.Application, upstream: Upstream, request: web.Request,
+                 extractor: UsageExtractor, response_time_ms: int) -> None:
+    """Price the usage of a completed response and hand it to the recorder."""
+    extractor.finish()
+    if not extractor.found:
+        return
+    model = extractor.model or 'unknown'
+    input_tokens = extractor.input_tokens or 0
+    output_tokens = extractor.output_tokens or 0
+    cost = app['pricing'].index(upstream.service_name).calculate_cost(model, input_tokens, output_tokens,
+                                                                      time.time())
+    fields = {
+        header_field: request.headers[header]
+        for header, header_field in ATTRIBUTION_HEADERS.items() if header in request.headers
+    }
+    app['recorder'](
+        upstream.service_name,
+        model=model,
+        input_tokens=input_tokens,
+        output_tokens=output_tokens,
+        event_id=extractor.request_id,
+        input_cost=cost['input_cost'],
+        output_cost=cost['output_cost'],
+        price_version=cost['price_version'],
+        response_time_ms=response_time_ms,
+        metadata={"path": request.match_info['path'], "streamed": extractor.streaming, **extractor.details},
+        **fields
+    )
+
+
+async def _refresh_pricing(app: web.Application) -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(app['pricing_refresh_seconds'])
+        try:
+            await loop.run_in_executor(None, app['pricing'].reload)
+        except Exception:
+            logger.exception("Failed to reload model prices; keeping the previous ones")
+
+
+async def _on_startup(app: web.Application) -> None:
+    app['session'] = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=0, ttl_dns_cache=300),
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=600),
+        auto_decompress=False
+    )
+    await asyncio.get_running_loop().run_in_executor(None, app['pricing'].reload)
+    app['pricing_task'] = asyncio.create_task(_refresh_pricing(app))
+
+
+async def _on_cleanup(app: web.Application) -> None:
+    app['pricing_task'].cancel()
+    await app['session'].close()
+
+
+def create_app(upstreams: Dict[str, Upstream], pricing: PricingSource, recorder: Recorder,
+               include_stream_usage: bool = True,
+               pricing_refresh_seconds: float = DEFAULT_PRICING_REFRESH_SECONDS) -> web.Application:
+    """Build the proxy application.
+
+    Args:
+        upstreams: Upstream API for each path prefix, e.g. ``openai``.
+        pricing: Model prices of the upstream services.
+        recorder: Called with the service name and the usage event fields
+            of each metered response; must not block.
+        include_stream_usage: Add ``stream_options.include_usage`` to
+            streamed OpenAI requests so their usage can be metered.
+        pricing_refresh_seconds: Interval between price reloads.
+    """
+    app = web.Application()
+    app['upstreams'] = upstreams
+    app['pricing'] = pricing
+    app['recorder'] = recorder
+    app['include_stream_usage'] = include_stream_usage
+    app['pricing_refresh_seconds'] = pricing_refresh_seconds
+    app.router.add_route('*', '/{provider}/{path:.*}', proxy_handler)
+    app.on_startup.append(_on_startup)
+    app.on_cleanup.append(_on_cleanup)
+    return app
+
+
+def upstreams_from_env(environ: Optional[Dict[str, str]] = None) -> Dict[str, Upstream]:
+    """Read the upstream URLs and service names from the environment."""
+    environ = os.environ if environ is None else environ
+    return {
+        'openai': Upstream('openai', environ.get('OPENAI_UPSTREAM', 'https://api.openai.com').rstrip('/'),
+                           environ.get('OPENAI_SERVICE_NAME', 'OpenAI')),
+        'anthropic': Upstream('anthropic',
+                              environ.get('ANTHROPIC_UPSTREAM', 'https://api.anthropic.com').rstrip('/'),
+                              environ.get('ANTHROPIC_SERVICE_NAME', 'Claude')),
+    }
+
+
+def client_recorder(endpoint: str, spill_dir: Optional[str] = None, **client_options: Any) -> Recorder:
+    """Build a recorder that posts events with one ``CostWiseClient`` per service."""
+    from costwise_client import CostWiseClient
+
+    clients: Dict[str, CostWiseClient] = {}
+
+    def record(service_name: str, **event: Any) -> None:
+        client = clients.get(service_name)
+        if client is None:
+            client = clients[service_name] = CostWiseClient(endpoint, service_name, spill_dir=spill_dir,
+                                                            **client_options)
+        client.record(**event)
+
+    return record
@@ -0,0 +1,160 @@
+"""Effective-dated model pricing for AI service adapters.
+
+This module turns the ``models`` JSON stored in ``service_config`` into a
+sorted interval index so that every usage record is priced with the rate that
+was in effect when the request was made, not the rate configured today.
+
+A model entry may keep the flat ``input_price_per_1k``/``output_price_per_1k``
+fields and optionally add a ``price_versions`` list:
+
+    "gpt-4o": {
+        "input_price_per_1k": 5.0,
+        "output_price_per_1k": 15.0,
+        "price_versions": [
+            {"effective_from": "2024-05-13", "input_price_per_1k": 5.0, "output_price_per_1k": 15.0},
+            {"effective_from": "2024-08-06", "input_price_per_1k": 2.5, "output_price_per_1k": 10.0,
+             "version": "2024-08-price-cut"}
+        ]
+    }
+
+The flat fields act as the ``base`` version, used for records older than the
+first effective date (or for every record when no versions are configured).
+"""
+
+from bisect import bisect_right
+from datetime import datetime, timezone
+from typing import Any, Dict, List, NamedTuple, Optional
+
+try:
+    from . import json_codec
+except ImportError:
+    from adapters import json_codec
+
+BASE_VERSION = 'base'
+
+
+class PriceVersion(NamedTuple):
+    """A single price version for a model."""
+    version: str
+    input_price_per_1k: float
+    output_price_per_1k: float
+
+
+def parse_timestamp(value: Any) -> Optional[datetime]:
+    """Parse a record timestamp into a timezone-aware UTC datetime.
+
+    Args:
+        value: A datetime, Unix timestamp (seconds) or ISO 8601 string.
+
+    Returns:
+        The parsed datetime, or None if the value is empty or unparseable.
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime):
+        return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value, tz=timezone.utc)
+    if isinstance(value, str):
+        text = value.strip()
+        if text.endswith('Z'):
+            text = text[:-1] + '+00:00'
+        try:
+            parsed = datetime.fromisoformat(text)
+        except ValueError:
+            return None
+        return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+    return None
+
+
+class _ModelPriceIndex:
+    """Sorted interval index of the price versions for one model."""
+
+    __slots__ = ('starts', 'versions', 'base')
+
+    def __init__(self, model_info: Dict[str, Any]):
+        self.base = PriceVersion(
+            BASE_VERSION,
+            float(model_info.get('input_price_per_1k', 0.0) or 0.0),
+            float(model_info.get('output_price_per_1k', 0.0) or 0.0)
+        )
+
+        entries = []
+        for entry in model_info.get('price_versions') or []:
+            effective_from = parse_timestamp(entry.get('effective_from'))
+            if effective_from is None:
+                raise ValueError(f"Invalid effective_from in price version: {entry!r}")
+            entries.append((effective_from, PriceVersion(
+                str(entry.get('version') or effective_from.date().isoformat()),
+                float(entry.get('input_price_per_1k', self.base.input_price_per_1k) or 0.0),
+                float(entry.get('output_price_per_1k', self.base.output_price_per_1k) or 0.0)
+            )))
+        entries.sort(key=lambda pair: pair[0])
+
+        self.starts: List[datetime] = [start for start, _ in entries]
+        self.versions: List[PriceVersion] = [version for _, version in entries]
+
+    def lookup(self, timestamp: Optional[datetime]) -> PriceVersion:
+        if not self.versions:
+            return self.base
+        if timestamp is None:
+            # No record time available: use the latest known price
+            return self.versions[-1]
+        position = bisect_right(self.starts, timestamp) - 1
+        return self.versions[position] if position >= 0 else self.base
+
+
+class PricingIndex:
+    """Effective-dated price lookup for all models of a service.
+
+    Per-model indexes are built lazily on first use and cached, so a lookup
+    costs one dict access plus an O(log versions) bisect on the record time.
+    """
+
+    def __init__(self, models: Any):
+        """Initialize the pricing index.
+
+        Args:
+            models: The ``models`` config, as a dict or a JSON string.
+        """
+        if isinstance(models, str):
+            models = json_codec.loads(models) if models else {}
+        self.models: Dict[str, Any] = models or {}
+        self._cache: Dict[str, _ModelPriceIndex] = {}
+
+    def _index_for(self, model: str) -> _ModelPriceIndex:
+        index = self._cache.get(model)
+        if index is None:
+            index = _ModelPriceIndex(self.models.get(model) or {})
+            self._cache[model] = index
+        return index
+
+    def lookup(self, model: str, timestamp: Any = None) -> PriceVersion:
+        """Get the price version in effect for a model at a point in time.
+
+        Args:
+            model: The model name.
+            timestamp: The record time (datetime, Unix seconds or ISO string).
+
+        Returns:
+            The matching PriceVersion; unknown models are priced at zero.
+        """
+        return self._index_for(model).lookup(parse_timestamp(timestamp))
+
+    def calculate_cost(self, model: str, input_tokens: int, output_tokens: int,
+                       timestamp: Any = None) -> Dict[str, Any]:
+        """Calculate the cost of a request using the price in effect at ``timestamp``.
+
+        Returns:
+            A dictionary containing input_cost, output_cost, total_cost and price_version.
+        """
+        price = self.lookup(model, timestamp)
+        input_cost = (input_tokens / 1000) * price.input_price_per_1k
+        output_cost = (output_tokens / 1000) * price.output_price_per_1k
+
+        return {
+            'input_cost': input_cost,
+            'output_cost': output_cost,
+            'total_cost': input_cost + output_cost,
+            'price_version': price.version
+        }
@@ -0,0 +1,72 @@
+"""Model prices for the services behind the proxy.
+
+Prices come from the ``models`` column of the service configuration table,
+the same configuration the collection adapters price with, so proxied and
+collected usage of a model cost the same. For local runs, a JSON file
+mapping service names to their ``models`` configuration can be used instead.
+"""
+
+import threading
+from typing import Any, Callable, Dict, Iterable
+
+from . import json_codec
+from .pricing import PricingIndex
+
+try:
+    import google.cloud.bigquery as bigquery
+except ImportError:  # pragma: no cover - optional dependency
+    bigquery = None
+
+
+class PricingSource:
+    """Holds a ``PricingIndex`` per service and swaps them in on reload."""
+
+    def __init__(self, loader: Callable[[], Dict[str, Any]]):
+        """Initialize the source.
+
+        Args:
+            loader: Returns the ``models`` configuration of each service.
+        """
+        self.loader = loader
+        self._indexes: Dict[str, PricingIndex] = {}
+        self._lock = threading.Lock()
+
+    def reload(self) -> int:
+        """Load the prices again; returns the number of services loaded."""
+        indexes = {service_name: PricingIndex(models) for service_name, models in self.loader().items()}
+        with self._lock:
+            self._indexes = indexes
+        return len(indexes)
+
+    def index(self, service_name: str) -> PricingIndex:
+        """Get the price index of a service; unknown services price at zero."""
+        index = self._indexes.get(service_name)
+        if index is None:
+            index = PricingIndex({})
+        return index
+
+
+def file_loader(path: str) -> Callable[[], Dict[str, Any]]:
+    """Load prices from a JSON file of ``{service_name: models}``."""
+    def load() -> Dict[str, Any]:
+        with open(path, 'rb') as pricing_file:
+            return json_codec.loads(pricing_file.read())
+    return load
+
+
+def bigquery_loader(project_id: str, dataset_id: str, table_id: str,
+                    service_names: Iterable[str]) -> Callable[[], Dict[str, Any]]:
+    """Load prices from the service configuration table."""
+    if bigquery is None:
+        raise ImportError("google-cloud-bigquery is required to load prices from BigQuery")
+    service_names = sorted(set(service_names))
+    client = bigquery.Client(project=project_id)
+    query = f"""SELECT service_name, models FROM `{project_id}.{dataset_id}.{table_id}`
+WHERE active = TRUE AND service_name IN UNNEST(@service_names)"""
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ArrayQueryParameter("service_names", "STRING", service_names)
+    ])
+
+    def load() -> Dict[str, Any]:
+        return {row['service_name']: row['models'] for row in client.query(query, job_config=job_config).result()}
+    return load
@@ -0,0 +1,118 @@
+"""Extraction of token usage from OpenAI- and Anthropic-style responses.
+
+Both APIs report usage in a ``usage`` object: OpenAI as ``prompt_tokens``/
+``completion_tokens`` (or ``input_tokens``/``output_tokens`` in the
+Responses API), Anthropic as ``input_tokens``/``output_tokens``. Streamed
+responses are server-sent events: OpenAI sends usage in the last chunk when
+``stream_options.include_usage`` is set, Anthropic sends the input tokens in
+``message_start`` and the cumulative output tokens in ``message_delta``.
+
+``UsageExtractor`` is fed the response bytes as they pass through the proxy.
+Only SSE lines holding a ``usage`` object are decoded, so the cost per chunk
+is one regular expression search.
+"""
+
+import re
+from typing import Any, Dict, Optional
+
+from . import json_codec
+
+# Buffered JSON bodies larger than this are passed through without metering
+MAX_BUFFERED_BODY = 8 * 1024 * 1024
+
+# A usage object, as opposed to the "usage": null of OpenAI stream chunks
+_USAGE_OBJECT = re.compile(rb'"usage"\s*:\s*\{')
+
+# Usage counters kept in the record metadata
+DETAIL_FIELDS = ('cache_creation_input_tokens', 'cache_read_input_tokens')
+
+
+class UsageExtractor:
+    """Accumulates the request ID, model and token usage of one response."""
+
+    def __init__(self, streaming: bool):
+        self.streaming = streaming
+        self.request_id: Optional[str] = None
+        self.model: Optional[str] = None
+        self.input_tokens: Optional[int] = None
+        self.output_tokens: Optional[int] = None
+        self.details: Dict[str, int] = {}
+        self._pending = b''
+        self._body = []
+        self._body_size = 0
+
+    @property
+    def found(self) -> bool:
+        """Whether any usage was seen."""
+        return self.input_tokens is not None or self.output_tokens is not None
+
+    def merge(self, document: Any) -> None:
+        """Merge a response document or stream event."""
+        if not isinstance(document, dict):
+            return
+        if document.get('type') in ('message_start', 'response.completed'):
+            # Anthropic and Responses API streams nest the message in the event
+            document = document.get('message') or document.get('response') or document
+        if self.request_id is None and isinstance(document.get('id'), str):
+            self.request_id = document['id']
+        if self.model is None and isinstance(document.get('model'), str):
+            self.model = document['model']
+
+        usage = document.get('usage')
+        if not isinstance(usage, dict):
+            return
+        input_tokens = usage.get('input_tokens', usage.get('prompt_tokens'))
+        output_tokens = usage.get('output_tokens', usage.get('completion_tokens'))
+        # Later events carry cumulative counts, so they replace earlier ones
+        if input_tokens is not None:
+            self.input_tokens = int(input_tokens)
+        if output_tokens is not None:
+            self.output_tokens = int(output_tokens)
+        for field in DETAIL_FIELDS:
+            if usage.get(field) is not None:
+                self.details[field] = int(usage[field])
+
+    def feed(self, chunk: bytes) -> None:
+        """Feed a chunk of the response body."""
+        if not self.streaming:
+            if self._body_size <= MAX_BUFFERED_BODY:
+                self._body.append(chunk)
+                self._body_size += len(chunk)
+            return
+
+        data = self._pending + chunk if self._pending else chunk
+        if b'\n' not in data:
+            self._pending = data
+            return
+        complete, _, self._pending = data.rpartition(b'\n')
+        if _USAGE_OBJECT.search(complete) is None:
+            return
+        for line in complete.split(b'\n'):
+            self._parse_line(line)
+
+    def _parse_line(self, line: bytes) -> None:
+        line = line.strip()
+        if not line.startswith(b'data:'):
+            return
+        payload = line[5:].strip()
+        if _USAGE_OBJECT.search(payload) is None:
+            return
+        try:
+            self.merge(json_codec.loads(payload))
+        except ValueError:
+            pass
+
+    def finish(self) -> None:
+        """Process the end of the body."""
+        if self.streaming:
+            if self._pending:
+                self._parse_line(self._pending)
+                self._pending = b''
+            return
+        if not self._body or self._body_size > MAX_BUFFERED_BODY:
+            return
+        try:
+            self.merge(json_codec.loads(b''.join(self._body)))
+        except ValueError:
+            pass
+        self._body = []
@@ -21,6 +21,7 @@ locals {
     
     # Storage resources
     function_bucket   = "${local.name_prefix}-functions-${random_id.suffix.hex}"
+    data_bucket       = "${local.name_prefix}-data-${random_id.suffix.hex}"
     
     # Service account
     service_account   = "${local.name_prefix}-sa"
@@ -29,6 +30,7 @@ locals {
     data_collection_function   = "${local.name_prefix}-data-collection"
     data_transform_function    = "${local.name_prefix}-data-transform"
     admin_function             = "${local.name_prefix}-admin"
+    cost_query_function        = "${local.name_prefix}-cost-query"
     
     # Cloud Scheduler jobs
     collection_job    = "${local.name_prefix}-collection-job"
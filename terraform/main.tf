@@ -13,6 +13,8 @@ module "bigquery" {
   dataset_id                  = var.dataset_id != null ? var.dataset_id : local.names.dataset
   location                    = var.location
   cost_data_table_id          = var.cost_data_table_id
+  cost_data_raw_table_id      = var.cost_data_raw_table_id
+  cost_rollup_table_id        = var.cost_rollup_table_id
   service_config_table_id     = var.service_config_table_id
   cost_data_retention_days    = var.cost_data_retention_days
   labels                      = local.common_labels
@@ -54,6 +56,8 @@ module "storage" {
   project_id                  = var.project_id
   location                    = var.location
   function_source_bucket_name = var.function_source_bucket_name != null ? var.function_source_bucket_name : local.names.function_bucket
+  data_bucket_name            = local.names.data_bucket
+  data_retention_days         = var.data_retention_days
   function_service_account    = module.iam.service_account_email
   labels                      = local.common_labels
 }
@@ -68,7 +72,10 @@ module "cloud_functions" {
   service_account_email       = module.iam.service_account_email
   dataset_id                  = module.bigquery.dataset_id
   cost_data_table_id          = module.bigquery.cost_data_table_id
+  cost_data_raw_table_id      = module.bigquery.cost_data_raw_table_id
+  cost_rollup_table_id        = module.bigquery.cost_rollup_table_id
   service_config_table_id     = module.bigquery.service_config_table_id
+  data_bucket_name            = module.storage.data_bucket_name
   
   # Security-related settings
   enable_vpc_connector        = var.enable_vpc_connector
@@ -82,6 +89,7 @@ module "cloud_functions" {
   data_collection_function_name = local.names.data_collection_function
   data_transform_function_name  = local.names.data_transform_function
   admin_function_name           = local.names.admin_function
+  cost_query_function_name      = local.names.cost_query_function
   
   # Common labels
   labels                      = local.common_labels
@@ -62,6 +62,53 @@ resource "google_bigquery_table" "cost_data" {
   }, var.labels)
 }
 
+# Create a sibling table for the raw payloads of cost data rows, so queries on
+# the cost table only scan the narrow analytic columns
+resource "google_bigquery_table" "cost_data_raw" {
+  project   = var.project_id
+  dataset_id = google_bigquery_dataset.cost_monitoring.dataset_id
+  table_id   = var.cost_data_raw_table_id
+  
+  schema = file("${path.module}/schemas/cost_data_raw_schema.json")
+
+  time_partitioning {
+    type                     = "DAY"
+    field                    = "timestamp"
+    require_partition_filter = true
+    expiration_ms            = var.cost_data_retention_days * 24 * 60 * 60 * 1000
+  }
+
+  clustering = ["service_name", "row_id"]
+
+  description = "Raw API payloads and metadata for cost data rows, keyed by row_id"
+  labels = merge({
+    application = "costwise-ai"
+  }, var.labels)
+}
+
+# Create a daily rollup of the cost data, maintained by the functions with an
+# idempotent MERGE of the days touched by each insert
+resource "google_bigquery_table" "cost_daily_rollup" {
+  project   = var.project_id
+  dataset_id = google_bigquery_dataset.cost_monitoring.dataset_id
+  table_id   = var.cost_rollup_table_id
+  
+  schema = file("${path.module}/schemas/cost_daily_rollup_schema.json")
+
+  time_partitioning {
+    type          = "DAY"
+    field         = "date"
+    expiration_ms = var.cost_data_retention_days * 24 * 60 * 60 * 1000
+  }
+
+  clustering = ["service_name", "model"]
+
+  description = "Daily cost totals by service, model, feature and project"
+  labels = merge({
+    application = "costwise-ai"
+  }, var.labels)
+}
+
 # Create a table for service configurations
 resource "google_bigquery_table" "service_config" {
   project   = var.project_id
@@ -76,73 +123,144 @@ resource "google_bigquery_table" "service_config" {
   }, var.labels)
 }
 
-# Create a view for simplified cost analysis
-resource "google_bigquery_table" "cost_summary_view" {
-  project   = var.project_id
-  dataset_id = google_bigquery_dataset.cost_monitoring.dataset_id
-  table_id   = "cost_summary_view"
-  view {
-    query = <<SQL
+# Table-valued functions for dashboards and APIs. Each takes an inclusive
+# date range and optional service and model filters (NULL matches all), so
+# every query prunes to the partitions of the days it asks for
+locals {
+  dataset_ref = "${var.project_id}.${google_bigquery_dataset.cost_monitoring.dataset_id}"
+
+  range_arguments = [
+    { name = "start_date", type = "DATE" },
+    { name = "end_date", type = "DATE" },
+    { name = "service_filter", type = "STRING" },
+    { name = "model_filter", type = "STRING" },
+  ]
+}
+
+# Daily cost totals by service, model, feature and project, from the rollup
+resource "google_bigquery_routine" "cost_summary" {
+  project         = var.project_id
+  dataset_id      = google_bigquery_dataset.cost_monitoring.dataset_id
+  routine_id      = "cost_summary"
+  routine_type    = "TABLE_VALUED_FUNCTION"
+  language        = "SQL"
+  description     = "Daily cost totals by service, model, feature and project for a date range"
+  definition_body = <<SQL
 SELECT
-  DATE(timestamp) as date,
+  date,
   service_name,
   model,
-  feature,
-  project,
-  COUNT(*) as request_count,
-  SUM(input_tokens) as total_input_tokens,
-  SUM(output_tokens) as total_output_tokens,
-  SUM(total_tokens) as total_tokens,
-  SUM(cost) as total_cost
+  NULLIF(feature, '') as feature,
+  NULLIF(project, '') as project,
+  request_count,
+  total_input_tokens,
+  total_output_tokens,
+  total_tokens,
+  total_cost,
+  total_response_time_ms,
+  response_time_count,
+  SAFE_DIVIDE(total_response_time_ms, response_time_count) as avg_response_time_ms
 FROM
-  `${var.project_id}.${google_bigquery_dataset.cost_monitoring.dataset_id}.${var.cost_data_table_id}`
-GROUP BY
-  date, service_name, model, feature, project
-ORDER BY
-  date DESC, total_cost DESC
+  `${local.dataset_ref}.${google_bigquery_table.cost_daily_rollup.table_id}`
+WHERE
+  date BETWEEN start_date AND end_date
+  AND (service_filter IS NULL OR service_name = service_filter)
+  AND (model_filter IS NULL OR model = model_filter)
 SQL
-    use_legacy_sql = false
-  }
 
-  description = "Summarized daily cost data by service and model"
-  labels = merge({
-    application = "costwise-ai"
-  }, var.labels)
+  dynamic "arguments" {
+    for_each = local.range_arguments
+    content {
+      name      = arguments.value.name
+      data_type = jsonencode({ "typeKind" : arguments.value.type })
+    }
+  }
 }
 
-# Create a view for model comparison
-resource "google_bigquery_table" "model_comparison_view" {
-  project   = var.project_id
-  dataset_id = google_bigquery_dataset.cost_monitoring.dataset_id
-  table_id   = "model_comparison_view"
-  view {
-    query = <<SQL
+# Cost efficiency of each model over a date range, from the rollup
+resource "google_bigquery_routine" "model_comparison" {
+  project         = var.project_id
+  dataset_id      = google_bigquery_dataset.cost_monitoring.dataset_id
+  routine_id      = "model_comparison"
+  routine_type    = "TABLE_VALUED_FUNCTION"
+  language        = "SQL"
+  description     = "Comparison of different AI models by cost efficiency for a date range"
+  definition_body = <<SQL
 SELECT
   service_name,
   model,
-  COUNT(*) as request_count,
-  SUM(input_tokens) as total_input_tokens,
-  SUM(output_tokens) as total_output_tokens,
+  SUM(request_count) as request_count,
+  SUM(total_input_tokens) as total_input_tokens,
+  SUM(total_output_tokens) as total_output_tokens,
   SUM(total_tokens) as total_tokens,
-  SUM(cost) as total_cost,
-  SUM(cost) / SUM(total_tokens) * 1000 as cost_per_1k_tokens,
-  AVG(response_time_ms) as avg_response_time_ms
+  SUM(total_cost) as total_cost,
+  SAFE_DIVIDE(SUM(total_cost), SUM(total_tokens)) * 1000 as cost_per_1k_tokens,
+  SAFE_DIVIDE(SUM(total_response_time_ms), SUM(response_time_count)) as avg_response_time_ms
 FROM
-  `${var.project_id}.${google_bigquery_dataset.cost_monitoring.dataset_id}.${var.cost_data_table_id}`
+  `${local.dataset_ref}.${google_bigquery_table.cost_daily_rollup.table_id}`
 WHERE
-  timestamp >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 30 DAY)
+  date BETWEEN start_date AND end_date
+  AND (service_filter IS NULL OR service_name = service_filter)
+  AND (model_filter IS NULL OR model = model_filter)
 GROUP BY
   service_name, model
-ORDER BY
-  cost_per_1k_tokens ASC
 SQL
-    use_legacy_sql = false
+
+  dynamic "arguments" {
+    for_each = local.range_arguments
+    content {
+      name      = arguments.value.name
+      data_type = jsonencode({ "typeKind" : arguments.value.type })
+    }
   }
+}
 
-  description = "Comparison of different AI models by cost efficiency"
-  labels = merge({
-    application = "costwise-ai"
-  }, var.labels)
+# Individual cost rows over a date range. The timestamp range is derived from
+# the dates, so it satisfies the partition filter requirement of the cost table
+resource "google_bigquery_routine" "cost_details" {
+  project         = var.project_id
+  dataset_id      = google_bigquery_dataset.cost_monitoring.dataset_id
+  routine_id      = "cost_details"
+  routine_type    = "TABLE_VALUED_FUNCTION"
+  language        = "SQL"
+  description     = "Individual cost rows for a date range"
+  definition_body = <<SQL
+SELECT
+  timestamp,
+  service_name,
+  model,
+  request_id,
+  feature,
+  project,
+  user_id,
+  input_tokens,
+  output_tokens,
+  total_tokens,
+  input_cost,
+  output_cost,
+  cost,
+  price_version,
+  response_time_ms,
+  request_count,
+  min_response_time_ms,
+  max_response_time_ms,
+  row_id
+FROM
+  `${local.dataset_ref}.${google_bigquery_table.cost_data.table_id}`
+WHERE
+  timestamp >= TIMESTAMP(start_date)
+  AND timestamp < TIMESTAMP(DATE_ADD(end_date, INTERVAL 1 DAY))
+  AND (service_filter IS NULL OR service_name = service_filter)
+  AND (model_filter IS NULL OR model = model_filter)
+SQL
+
+  dynamic "arguments" {
+    for_each = local.range_arguments
+    content {
+      name      = arguments.value.name
+      data_type = jsonencode({ "typeKind" : arguments.value.type })
+    }
+  }
 }
 
 # Create directories for schema files
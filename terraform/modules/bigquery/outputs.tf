@@ -8,17 +8,32 @@ output "cost_data_table_id" {
   value       = google_bigquery_table.cost_data.table_id
 }
 
+output "cost_data_raw_table_id" {
+  description = "The ID of the raw payload table for cost data"
+  value       = google_bigquery_table.cost_data_raw.table_id
+}
+
+output "cost_rollup_table_id" {
+  description = "The ID of the daily cost rollup table"
+  value       = google_bigquery_table.cost_daily_rollup.table_id
+}
+
 output "service_config_table_id" {
   description = "The ID of the service config table"
   value       = google_bigquery_table.service_config.table_id
 }
 
-output "cost_summary_view_id" {
-  description = "The ID of the cost summary view"
-  value       = google_bigquery_table.cost_summary_view.table_id
+output "cost_summary_function_id" {
+  description = "The ID of the cost summary table function"
+  value       = google_bigquery_routine.cost_summary.routine_id
+}
+
+output "model_comparison_function_id" {
+  description = "The ID of the model comparison table function"
+  value       = google_bigquery_routine.model_comparison.routine_id
 }
 
-output "model_comparison_view_id" {
-  description = "The ID of the model comparison view"
-  value       = google_bigquery_table.model_comparison_view.table_id
+output "cost_details_function_id" {
+  description = "The ID of the cost details table function"
+  value       = google_bigquery_routine.cost_details.routine_id
 }
\ No newline at end of file
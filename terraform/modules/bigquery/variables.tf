@@ -18,6 +18,16 @@ variable "cost_data_table_id" {
   type        = string
 }
 
+variable "cost_data_raw_table_id" {
+  description = "The ID of the BigQuery table for raw payloads of cost data rows"
+  type        = string
+}
+
+variable "cost_rollup_table_id" {
+  description = "The ID of the BigQuery table for the daily cost rollup"
+  type        = string
+}
+
 variable "service_config_table_id" {
   description = "The ID of the BigQuery table for service configurations"
   type        = string
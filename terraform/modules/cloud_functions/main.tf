@@ -9,9 +9,10 @@ data "external" "source_hash" {
   program = ["bash", "-c", <<-EOT
     {
       echo -n '{'
-      echo -n '"data_collection":"'$(find ${path.module}/../../../cloud_functions/data_collection -type f -name "*.py" -print0 | sort -z | xargs -0 md5sum | md5sum | cut -d' ' -f1)'",'
+      echo -n '"data_collection":"'$(find ${path.module}/../../../cloud_functions/data_collection ${path.module}/../bigquery/schemas/cost_data_schema.json -type f \( -name "*.py" -o -name "*.json" \) -print0 | sort -z | xargs -0 md5sum | md5sum | cut -d' ' -f1)'",'
       echo -n '"data_transformation":"'$(find ${path.module}/../../../cloud_functions/data_transformation -type f -name "*.py" -print0 | sort -z | xargs -0 md5sum | md5sum | cut -d' ' -f1)'",'
-      echo -n '"admin":"'$(find ${path.module}/../../../cloud_functions/admin -type f -name "*.py" -print0 | sort -z | xargs -0 md5sum | md5sum | cut -d' ' -f1)'"'
+      echo -n '"admin":"'$(find ${path.module}/../../../cloud_functions/admin -type f -name "*.py" -print0 | sort -z | xargs -0 md5sum | md5sum | cut -d' ' -f1)'",'
+      echo -n '"cost_query":"'$(find ${path.module}/../../../cloud_functions/cost_query -type f -name "*.py" -print0 | sort -z | xargs -0 md5sum | md5sum | cut -d' ' -f1)'"'
       echo '}'
     } | tr -d '\n'
   EOT
@@ -25,16 +26,22 @@ resource "null_resource" "create_source_dirs" {
     data_collection_hash     = data.external.source_hash.result.data_collection
     data_transformation_hash = data.external.source_hash.result.data_transformation
     admin_hash               = data.external.source_hash.result.admin
+    cost_query_hash          = data.external.source_hash.result.cost_query
   }
   
   provisioner "local-exec" {
     command = <<-EOT
-      mkdir -p ${path.module}/src/data_collection ${path.module}/src/data_transformation ${path.module}/src/admin
+      mkdir -p ${path.module}/src/data_collection ${path.module}/src/data_transformation ${path.module}/src/admin ${path.module}/src/cost_query
       
       # Copy the latest source code from the project directories
       cp -r ${path.module}/../../../cloud_functions/data_collection/* ${path.module}/src/data_collection/
+      
+      # The collector compiles its row normalizer from the cost data table schema
+      mkdir -p ${path.module}/src/data_collection/schemas
+      cp ${path.module}/../bigquery/schemas/cost_data_schema.json ${path.module}/src/data_collection/schemas/
       cp -r ${path.module}/../../../cloud_functions/data_transformation/* ${path.module}/src/data_transformation/
       cp -r ${path.module}/../../../cloud_functions/admin/* ${path.module}/src/admin/
+      cp -r ${path.module}/../../../cloud_functions/cost_query/* ${path.module}/src/cost_query/
     EOT
   }
 }
@@ -97,7 +104,10 @@ resource "google_cloudfunctions2_function" "data_collection" {
       PROJECT_ID           = var.project_id
       DATASET_ID           = var.dataset_id
       COST_DATA_TABLE_ID   = var.cost_data_table_id
+      COST_ROLLUP_TABLE_ID = var.cost_rollup_table_id
+      COST_DATA_RAW_TABLE_ID = var.cost_data_raw_table_id
       SERVICE_CONFIG_TABLE_ID = var.service_config_table_id
+      DATA_BUCKET_NAME     = var.data_bucket_name
     }
     service_account_email = var.service_account_email
     
@@ -154,13 +164,21 @@ resource "google_cloudfunctions2_function" "data_transformation" {
 
   service_config {
     max_instance_count = 5
+    # Concurrent requests share the instance's micro-batches of usage events
+    max_instance_request_concurrency = 80
+    available_cpu      = "1"
     available_memory   = "512M"
     timeout_seconds    = 120
     environment_variables = {
       PROJECT_ID           = var.project_id
       DATASET_ID           = var.dataset_id
       COST_DATA_TABLE_ID   = var.cost_data_table_id
+      COST_ROLLUP_TABLE_ID = var.cost_rollup_table_id
+      COST_DATA_RAW_TABLE_ID = var.cost_data_raw_table_id
       SERVICE_CONFIG_TABLE_ID = var.service_config_table_id
+      INGEST_MAX_BATCH_ROWS = var.ingest_max_batch_rows
+      INGEST_MAX_BATCH_AGE_MS = var.ingest_max_batch_age_ms
+      DATA_BUCKET_NAME     = var.data_bucket_name
     }
     service_account_email = var.service_account_email
     
@@ -218,12 +236,81 @@ resource "google_cloudfunctions2_function" "admin" {
   service_config {
     max_instance_count = 1
     available_memory   = "256M"
-    timeout_seconds    = 60
+    timeout_seconds    = 540  # Long enough for partition-by-partition cost recomputes
     environment_variables = {
       PROJECT_ID           = var.project_id
       DATASET_ID           = var.dataset_id
       COST_DATA_TABLE_ID   = var.cost_data_table_id
+      COST_ROLLUP_TABLE_ID = var.cost_rollup_table_id
+      COST_DATA_RAW_TABLE_ID = var.cost_data_raw_table_id
       SERVICE_CONFIG_TABLE_ID = var.service_config_table_id
+      DATA_BUCKET_NAME     = var.data_bucket_name
+    }
+    service_account_email = var.service_account_email
+    
+    # Apply VPC connector if enabled
+    vpc_connector = var.enable_vpc_connector && var.vpc_connector_name != null ? var.vpc_connector_name : null
+    vpc_connector_egress_settings = var.enable_vpc_connector && var.vpc_connector_name != null ? var.vpc_connector_egress_settings : null
+  }
+}
+
+# Archive source code for the cost query function
+data "archive_file" "cost_query_source" {
+  type        = "zip"
+  source_dir  = "${path.module}/src/cost_query"
+  output_path = "/tmp/cost_query_${random_id.function_suffix.hex}.zip"
+
+  depends_on = [null_resource.create_source_dirs]
+}
+
+# Upload the cost query function source code
+resource "google_storage_bucket_object" "cost_query_archive" {
+  name   = "source/cost_query_${random_id.function_suffix.hex}_${data.external.source_hash.result.cost_query}.zip"
+  bucket = var.function_source_bucket_name
+  source = data.archive_file.cost_query_source.output_path
+}
+
+# Deploy the cost query Cloud Function
+resource "google_cloudfunctions2_function" "cost_query" {
+  project     = var.project_id
+  name        = var.cost_query_function_name
+  location    = var.region
+  description = "Answers cost questions as JSON from the daily rollup"
+  
+  labels = merge({
+    application = "costwise-ai"
+  }, var.labels)
+
+  build_config {
+    runtime     = "python310"
+    entry_point = "query_costs"  # Set the entry point
+    source {
+      storage_source {
+        bucket = var.function_source_bucket_name
+        object = google_storage_bucket_object.cost_query_archive.name
+      }
+    }
+  }
+  
+  lifecycle {
+    # Ensure a new revision is created when the source code changes
+    replace_triggered_by = [
+      google_storage_bucket_object.cost_query_archive
+    ]
+  }
+
+  service_config {
+    max_instance_count               = 3
+    # Serve concurrent requests from one instance so they share its result cache
+    max_instance_request_concurrency = 20
+    available_cpu                    = "1"
+    available_memory                 = "512M"
+    timeout_seconds                  = 60
+    environment_variables = {
+      PROJECT_ID              = var.project_id
+      DATASET_ID              = var.dataset_id
+      QUERY_CACHE_MAX_ENTRIES = var.query_cache_max_entries
+      QUERY_CACHE_TTL_SECONDS = var.query_cache_ttl_seconds
     }
     service_account_email = var.service_account_email
     
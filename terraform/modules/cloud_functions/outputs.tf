@@ -18,11 +18,17 @@ output "admin_function_url" {
   value       = google_cloudfunctions2_function.admin.service_config[0].uri
 }
 
+output "cost_query_function_url" {
+  description = "The URL of the cost query Cloud Function"
+  value       = google_cloudfunctions2_function.cost_query.service_config[0].uri
+}
+
 output "deployed_services" {
   description = "Map of deployed Cloud Functions"
   value = {
     data_collection    = google_cloudfunctions2_function.data_collection.name,
     data_transformation = google_cloudfunctions2_function.data_transformation.name,
-    admin              = google_cloudfunctions2_function.admin.name
+    admin              = google_cloudfunctions2_function.admin.name,
+    cost_query         = google_cloudfunctions2_function.cost_query.name
   }
 }
\ No newline at end of file
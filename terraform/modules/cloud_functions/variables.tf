@@ -28,11 +28,26 @@ variable "cost_data_table_id" {
   type        = string
 }
 
+variable "cost_data_raw_table_id" {
+  description = "The ID of the BigQuery table for raw payloads of cost data rows"
+  type        = string
+}
+
+variable "cost_rollup_table_id" {
+  description = "The ID of the BigQuery table for the daily cost rollup"
+  type        = string
+}
+
 variable "service_config_table_id" {
   description = "The ID of the BigQuery table for service configurations"
   type        = string
 }
 
+variable "data_bucket_name" {
+  description = "Name of the GCS bucket for data written by the Cloud Functions"
+  type        = string
+}
+
 variable "labels" {
   description = "Labels to apply to Cloud Function resources"
   type        = map(string)
@@ -83,4 +98,34 @@ variable "admin_function_name" {
   description = "Name for the admin function"
   type        = string
   default     = "costwise-ai-admin"
+}
+
+variable "cost_query_function_name" {
+  description = "Name for the cost query function"
+  type        = string
+  default     = "costwise-ai-cost-query"
+}
+
+variable "query_cache_max_entries" {
+  description = "Maximum number of query results cached by each cost query function instance"
+  type        = number
+  default     = 256
+}
+
+variable "query_cache_ttl_seconds" {
+  description = "How long the cost query function serves a cached result before querying BigQuery again"
+  type        = number
+  default     = 300
+}
+
+variable "ingest_max_batch_rows" {
+  description = "Usage events that fill a micro-batch of the transformation function"
+  type        = number
+  default     = 500
+}
+
+variable "ingest_max_batch_age_ms" {
+  description = "Longest time in milliseconds a micro-batch of the transformation function stays open"
+  type        = number
+  default     = 250
 }
\ No newline at end of file
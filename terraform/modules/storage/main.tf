@@ -43,3 +43,33 @@ resource "google_storage_bucket_iam_member" "function_source_access" {
   role   = "roles/storage.objectViewer"
   member = "serviceAccount:${var.function_service_account}"
 }
+
+# Create a bucket for data written by the functions, such as offloaded raw responses
+resource "google_storage_bucket" "data" {
+  project  = var.project_id
+  name     = "${var.data_bucket_name}-${random_pet.bucket_suffix.id}"
+  location = var.location
+  
+  uniform_bucket_level_access = true
+  force_destroy               = false
+  
+  lifecycle_rule {
+    condition {
+      age = var.data_retention_days
+    }
+    action {
+      type = "Delete"
+    }
+  }
+  
+  labels = merge({
+    application = "costwise-ai"
+  }, var.labels)
+}
+
+# Allow the functions to read and write the data bucket
+resource "google_storage_bucket_iam_member" "data_access" {
+  bucket = google_storage_bucket.data.name
+  role   = "roles/storage.objectAdmin"
+  member = "serviceAccount:${var.function_service_account}"
+}
@@ -6,4 +6,8 @@ output "function_source_bucket_name" {
 output "function_source_bucket_url" {
   description = "The URL of the bucket created for Cloud Function source code"
   value       = google_storage_bucket.function_source.url
-}
\ No newline at end of file
+}
+output "data_bucket_name" {
+  description = "The name of the bucket for data written by the Cloud Functions"
+  value       = google_storage_bucket.data.name
+}
@@ -13,6 +13,17 @@ variable "function_source_bucket_name" {
   type        = string
 }
 
+variable "data_bucket_name" {
+  description = "Name prefix of the GCS bucket for data written by the Cloud Functions"
+  type        = string
+}
+
+variable "data_retention_days" {
+  description = "Number of days to keep objects in the data bucket"
+  type        = number
+  default     = 90
+}
+
 variable "function_service_account" {
   description = "Email of the service account that needs access to the bucket"
   type        = string
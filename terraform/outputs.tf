@@ -26,6 +26,16 @@ output "cost_data_table_id" {
   value       = module.bigquery.cost_data_table_id
 }
 
+output "cost_data_raw_table_id" {
+  description = "The ID of the raw payload table for cost data"
+  value       = module.bigquery.cost_data_raw_table_id
+}
+
+output "cost_rollup_table_id" {
+  description = "The ID of the daily cost rollup table"
+  value       = module.bigquery.cost_rollup_table_id
+}
+
 output "service_config_table_id" {
   description = "The ID of the service configuration table"
   value       = module.bigquery.service_config_table_id
@@ -43,6 +53,11 @@ output "function_source_bucket" {
   value       = module.storage.function_source_bucket_name
 }
 
+output "data_bucket" {
+  description = "The GCS bucket storing offloaded raw responses and other function data"
+  value       = module.storage.data_bucket_name
+}
+
 # Cloud Function URLs
 output "data_collection_function_url" {
   description = "The URL of the data collection Cloud Function"
@@ -59,6 +74,11 @@ output "admin_function_url" {
   value       = module.cloud_functions.admin_function_url
 }
 
+output "cost_query_function_url" {
+  description = "The URL of the cost query Cloud Function"
+  value       = module.cloud_functions.cost_query_function_url
+}
+
 # Function names (for IAM permissions)
 output "data_collection_function_name" {
   description = "Name of the data collection function"
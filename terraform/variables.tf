@@ -46,6 +46,18 @@ variable "cost_data_table_id" {
   default     = "usage_costs"
 }
 
+variable "cost_data_raw_table_id" {
+  description = "The ID of the BigQuery table for raw payloads of cost data rows"
+  type        = string
+  default     = "usage_costs_raw"
+}
+
+variable "cost_rollup_table_id" {
+  description = "The ID of the BigQuery table for the daily cost rollup"
+  type        = string
+  default     = "usage_costs_daily"
+}
+
 variable "service_config_table_id" {
   description = "The ID of the BigQuery table for service configurations"
   type        = string
@@ -58,6 +70,12 @@ variable "cost_data_retention_days" {
   default     = 730  # 2 years
 }
 
+variable "data_retention_days" {
+  description = "Number of days to retain offloaded raw responses and other objects in the data bucket"
+  type        = number
+  default     = 90
+}
+
 # Service Account Configuration
 variable "service_account_id" {
   description = "The ID for the service account used by Cloud Functions (if not using auto-generated name)"
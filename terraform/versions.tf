@@ -9,7 +9,7 @@ terraform {
   required_providers {
     google = {
       source  = "hashicorp/google"
-      version = ">= 4.34.0"
+      version = ">= 4.60.0"
     }
     google-beta = {
       source  = "hashicorp/google-beta"